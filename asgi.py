@@ -0,0 +1,249 @@
+"""
+Asyncio (ASGI) serving mode of the insurance REST API.
+
+The same Flask routes and handlers of property.py are served, but every request
+is dispatched inside AsyncSession.run_sync(): the handlers get a session of the
+async engine (aiosqlite), so a request waiting on the database yields to the
+event loop instead of holding a worker thread, and one process can keep many
+client connections open.
+
+Streamed responses (getAll?stream=1) page through the database after the
+request, their body is iterated in a worker thread on the sync engine.
+
+The shard databases of the insured (INSURANCE_SHARDS) get an async engine each,
+the sessions are routed to them by property.RoutingSession.
+
+usage: uvicorn asgi:application
+       python asgi.py [--host 127.0.0.1] [--port 5000]
+"""
+import argparse
+import asyncio
+import io
+import sys
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import metrics
+import migrations
+import profiling
+import property
+
+
+def createAsyncEngine(config=None, pragmas=None):
+    """
+    Create a pooled async engine, sqlite urls use the aiosqlite driver
+    """
+    config = dict(property.DB_CONFIG, **(config or {}))
+    url = config.pop("url")
+
+    if not url.startswith("sqlite"):
+        newEngine = create_async_engine(url, **config)
+        property.setQueryCache(newEngine.sync_engine)
+        return newEngine
+
+    if url.startswith("sqlite:"):
+        url = "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    # aiosqlite defaults to a NullPool for file databases, keep the connections instead
+    newEngine = create_async_engine(url, poolclass=AsyncAdaptedQueuePool, **config)
+    property.setSqlitePragmas(newEngine.sync_engine, pragmas)
+    property.setQueryCache(newEngine.sync_engine)
+    return newEngine
+
+
+# WSGI environ of an ASGI http request
+def _environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+# runs in the greenlet of AsyncSession.run_sync(): the Flask request, with the
+# handlers' Session() being the sync facade of the async session
+def _dispatch(session, app, environ):
+    property.Session.registry.set(session)
+    ctx = app.request_context(environ)
+    error = None
+    try:
+        try:
+            ctx.push()
+            response = app.full_dispatch_request()
+        except Exception as e:
+            error = e
+            response = app.handle_exception(e)
+
+        body, status, headers = response.get_wsgi_response(environ)
+        if not response.is_streamed:
+            body = [b"".join(body)]
+        return int(status.split(" ", 1)[0]), headers, body, response.is_streamed
+    finally:
+        if app.should_ignore_error(error):
+            error = None
+        ctx.auto_pop(error)
+        property.Session.registry.clear()
+
+
+class AsyncApp(object):
+    """
+    ASGI application serving a Flask app of property.py on an async engine
+    """
+    def __init__(self, app=None, config=None, upgrade=True):
+        self.app = app or property.app
+        self.config = config
+        self.upgrade = upgrade
+        self.engine = None
+        self.shardEngines = {}
+
+    async def startup(self):
+        if self.engine is not None:
+            return
+        if self.upgrade:
+            # Create all tables or upgrade an existing database
+            migrations.upgrade(property.engine, property.Base.metadata, log=print)
+            property.checkStorage()
+        self.engine = createAsyncEngine(self.config)
+        metrics.instrumentEngine(self.engine.sync_engine)
+        profiling.instrumentEngine(self.engine.sync_engine)
+        session = property.SessionFactory()
+        try:
+            for shard in property.shardsInUse(session):
+                self.shardEngine(shard)
+        finally:
+            session.close()
+        await self.warmup()
+        # the purger is a thread on the sync engines, like the streamed responses
+        property.startPurger()
+
+    async def warmup(self):
+        """
+        Open the pooled connections of the async engines, so the first requests
+        do not pay for the connections and their pragmas
+        """
+        for asyncEngine in [self.engine] + list(self.shardEngines.values()):
+            pool = asyncEngine.sync_engine.pool
+            connections = [await asyncEngine.connect() for _ in range(pool.size() if hasattr(pool, "size") else 1)]
+            for connection in connections:
+                await connection.close()
+
+    def shardEngine(self, shard):
+        """
+        Sync facade of the async engine of a shard database, for RoutingSession.get_bind()
+        """
+        shardEngine = self.shardEngines.get(shard)
+        if shardEngine is None:
+            # created with its tables by the sync engine of property.py
+            property.shardEngine(shard)
+            shardEngine = createAsyncEngine(dict(self.config or {}, url=property.shardURL(shard)))
+            metrics.instrumentEngine(shardEngine.sync_engine)
+            profiling.instrumentEngine(shardEngine.sync_engine)
+            self.shardEngines[shard] = shardEngine
+        return shardEngine.sync_engine
+
+    async def shutdown(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+        for shardEngine in self.shardEngines.values():
+            await shardEngine.dispose()
+        self.shardEngines = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        # servers without lifespan support start the engine on the first request
+        await self.startup()
+
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        environ = _environ(scope, b"".join(chunks))
+
+        session = AsyncSession(self.engine, sync_session_class=property.RoutingSession, \
+                               info={"shardEngine": self.shardEngine})
+        try:
+            status, headers, body, streamed = await session.run_sync(_dispatch, self.app, environ)
+        finally:
+            await session.close()
+
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in headers],
+        })
+        if not streamed:
+            await send({"type": "http.response.body", "body": body[0]})
+            return
+
+        loop = asyncio.get_event_loop()
+        iterator = iter(body)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, iterator, None)
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(body, "close"):
+                await loop.run_in_executor(None, body.close)
+
+
+application = AsyncApp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the insurance API on asyncio (uvicorn)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    uvicorn.run(application, host=args.host, port=args.port, lifespan="on")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
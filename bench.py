@@ -0,0 +1,359 @@
+"""
+Benchmark for every REST route of property.py.
+
+Seeds a synthetic dataset (N risk types, M attributes, K insured per type),
+then drives each route at the given concurrency levels through the Flask
+test client on a scratch SQLite file, or through HTTP against a running
+server with --url. Reports throughput and p50/p95/p99 latency per route,
+writes the results as json and compares them against a saved baseline.
+
+usage: python bench.py --types 3 --attributes 10 --insured 1000 --requests 200 \
+           --concurrency 1,4,16 --output bench.json [--baseline old.json --threshold 0.2]
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+# drives the app in process, one test client per thread
+class TestClientDriver(object):
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        data = json.dumps(body) if body is not None else None
+        response = client.open(path, method=method, data=data, content_type="application/json", headers=headers)
+        return response.status_code, response.get_data()
+
+
+# drives a running server over HTTP
+class HttpDriver(object):
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def request(self, method, path, body=None, headers=None):
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = Request(self.url + path, data=data, method=method,
+                      headers=dict({"Content-Type": "application/json"}, **(headers or {})))
+        try:
+            with urlopen(req) as response:
+                return response.status, response.read()
+        except HTTPError as e:
+            return e.code, e.read()
+
+
+def _call(driver, method, path, body=None, headers=None):
+    status, data = driver.request(method, path, body, headers)
+    if status >= 400:
+        raise RuntimeError("%s %s failed with %d: %s" % (method, path, status, data[:200]))
+    return json.loads(data.decode("utf-8"))
+
+
+def _attributeValue(index, attribute, dataType):
+    return str(index % 100) if dataType == "int" else "value-%d-%d" % (index, attribute)
+
+
+def _record(index, attributes):
+    return {"attributes": [{"attributeName": name, "attributeValue": _attributeValue(index, i, dataType)}
+                           for i, (name, dataType) in enumerate(attributes)]}
+
+
+def _addInsured(driver, riskType, attributes, count, offset=0):
+    ids = []
+    for start in range(0, count, 500):
+        records = [_record(offset + i, attributes) for i in range(start, min(start + 500, count))]
+        response = _call(driver, "POST", "/risk/%s/addInsuredBatch" % riskType, records)
+        ids.extend(result["insuredID"] for result in response["results"] if result["status"] == "success")
+    return ids
+
+
+def seed(driver, types, attributes, insured):
+    """
+    Create the synthetic dataset, returns what the scenarios need to address it
+    """
+    data = {"types": [], "attributes": [], "insured": {}}
+    # the first attribute is a mandatory int, the others alternate between int and string
+    for i in range(attributes):
+        data["attributes"].append(("age" if i == 0 else "attr%d" % i, "int" if i % 2 == 0 else "string"))
+
+    for t in range(types):
+        riskType = "bench%d" % t
+        _call(driver, "POST", "/risk/create", {"type": riskType})
+        for i, (name, dataType) in enumerate(data["attributes"]):
+            _call(driver, "POST", "/risk/%s/addAttribute" % riskType,
+                  {"name": name, "dataType": dataType, "mandatory": "yes" if i == 0 else "no"})
+        data["types"].append(riskType)
+        data["insured"][riskType] = _addInsured(driver, riskType, data["attributes"], insured)
+
+    # scratch type for the schema changing routes
+    _call(driver, "POST", "/risk/create", {"type": "benchscratch"})
+    _call(driver, "POST", "/risk/benchscratch/addAttribute", {"name": "age", "dataType": "int", "mandatory": "yes"})
+
+    # one finished job for the job status route
+    _call(driver, "POST", "/risk/create", {"type": "benchjob"})
+    data["job"] = _call(driver, "POST", "/risk/delete/benchjob?async=1")["jobID"]
+
+    # one profiled request for the capture routes, with the token of the server
+    _call(driver, "GET", "/risk/%s/getAttributes" % data["types"][0],
+          headers={"X-Profile": os.environ.get("INSURANCE_PROFILE_TOKEN", "")})
+    profiles = _call(driver, "GET", "/profiles?limit=1")["profiles"]
+    data["profile"] = profiles[0]["id"] if profiles else "none"
+    return data
+
+
+def scenarios(driver, data):
+    """
+    (method, route, setup(count) -> pool, build(index, pool) -> (path, body)) for every route
+    """
+    riskType = data["types"][0]
+    attributes = data["attributes"]
+    insured = data["insured"][riskType]
+    unique = itertools.count()
+
+    def pick(i):
+        return insured[i % len(insured)]
+
+    def newAttributes(count):
+        names = ["del%d" % next(unique) for _ in range(count)]
+        for name in names:
+            _call(driver, "POST", "/risk/benchscratch/addAttribute", {"name": name, "dataType": "string", "mandatory": "no"})
+        return names
+
+    def newTypes(count):
+        names = ["deltype%d" % next(unique) for _ in range(count)]
+        for name in names:
+            _call(driver, "POST", "/risk/create", {"type": name})
+        return names
+
+    def newInsured(count):
+        return _addInsured(driver, "benchscratch", [("age", "int")], count)
+
+    return [
+        ("GET", "/risk/getAll", None, lambda i, pool: ("/risk/getAll", None)),
+        ("GET", "/risk/schemaCache", None, lambda i, pool: ("/risk/schemaCache", None)),
+        ("GET", "/metrics", None, lambda i, pool: ("/metrics", None)),
+        ("GET", "/risk/jobs/<jobID>", None, lambda i, pool: ("/risk/jobs/%d" % data["job"], None)),
+        ("GET", "/profiles", None, lambda i, pool: ("/profiles", None)),
+        ("GET", "/profiles/<captureID>", None, lambda i, pool: ("/profiles/%s" % data["profile"], None)),
+        ("POST", "/risk/create", None,
+            lambda i, pool: ("/risk/create", {"type": "newtype%d" % next(unique)})),
+        ("GET", "/risk/<riskId>/getAttributes", None,
+            lambda i, pool: ("/risk/%s/getAttributes" % riskType, None)),
+        ("POST", "/risk/<riskId>/addAttribute", None,
+            lambda i, pool: ("/risk/benchscratch/addAttribute", {"name": "new%d" % next(unique), "dataType": "string", "mandatory": "no"})),
+        ("POST", "/risk/<riskId>/addInsured", None,
+            lambda i, pool: ("/risk/%s/addInsured" % riskType, _record(i, attributes))),
+        ("POST", "/risk/<riskId>/addInsuredBatch", None,
+            lambda i, pool: ("/risk/%s/addInsuredBatch" % riskType, [_record(i * 50 + j, attributes) for j in range(50)])),
+        ("GET", "/risk/<riskId>/get/<insuredID>", None,
+            lambda i, pool: ("/risk/%s/get/%d" % (riskType, pick(i)), None)),
+        ("POST", "/risk/<riskId>/getMany", None,
+            lambda i, pool: ("/risk/%s/getMany" % riskType, {"insuredIDs": [pick(i + j) for j in range(50)]})),
+        ("POST", "/risk/<riskId>/search", None,
+            lambda i, pool: ("/risk/%s/search" % riskType, {"filters": [{"attributeName": "age", "op": ">", "value": 90}], "limit": 100})),
+        ("GET", "/risk/<riskId>/getAll", None,
+            lambda i, pool: ("/risk/%s/getAll?limit=100&after=%d" % (riskType, pick(i)), None)),
+        ("GET", "/risk/<riskId>/getAll?stream=1", None,
+            lambda i, pool: ("/risk/%s/getAll?stream=1" % riskType, None)),
+        ("GET", "/risk/<riskId>/stats", None,
+            lambda i, pool: ("/risk/%s/stats%s" % (riskType, ["", "?attribute=age", "?attribute=attr1"][i % 3]), None)),
+        ("GET", "/risk/changes", None,
+            lambda i, pool: ("/risk/changes?since=%d&limit=100" % (i * 97 % (len(insured) + 1)), None)),
+        ("GET", "/risk/<riskId>/export", None,
+            lambda i, pool: ("/risk/%s/export?format=%s" % (riskType, "csv" if i % 2 else "ndjson"), None)),
+        ("PUT", "/risk/<riskId>/update/<insuredID>", None,
+            lambda i, pool: ("/risk/%s/update/%d" % (riskType, pick(i)),
+                             {"attributes": {"attributeName": "age", "attributeValue": str(i % 100)}})),
+        ("PATCH", "/risk/<riskId>/update/<insuredID>", None,
+            lambda i, pool: ("/risk/%s/update/%d" % (riskType, pick(i)),
+                             {"attributes": [{"attributeName": name, "attributeValue": _attributeValue(i, a, dataType)}
+                                             for a, (name, dataType) in enumerate(attributes[:5])]})),
+        ("POST", "/risk/<riskId>/delete/<insuredID>", newInsured,
+            lambda i, pool: ("/risk/benchscratch/delete/%d" % pool[i], None)),
+        ("POST", "/risk/<riskId>/deleteAttribute", newAttributes,
+            lambda i, pool: ("/risk/benchscratch/deleteAttribute", {"name": pool[i]})),
+        ("POST", "/risk/delete/<riskId>", newTypes,
+            lambda i, pool: ("/risk/delete/%s" % pool[i], None)),
+    ]
+
+
+def _percentile(values, percent):
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+def run(driver, method, build, pool, requests, concurrency):
+    """
+    Send requests from concurrency threads, returns the route statistics
+    """
+    counter = itertools.count()
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        mine = []
+        failed = 0
+        while True:
+            i = next(counter)
+            if i >= requests:
+                break
+            path, body = build(i, pool)
+            start = time.perf_counter()
+            try:
+                status, _ = driver.request(method, path, body)
+            except Exception:
+                status = 599
+            mine.append(time.perf_counter() - start)
+            if status >= 400:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return OrderedDict([
+        ("requests", len(latencies)),
+        ("errors", errors[0]),
+        ("throughput", round(len(latencies) / elapsed, 2)),
+        ("p50_ms", round(_percentile(latencies, 50) * 1000, 3)),
+        ("p95_ms", round(_percentile(latencies, 95) * 1000, 3)),
+        ("p99_ms", round(_percentile(latencies, 99) * 1000, 3)),
+    ])
+
+
+def compare(results, baseline, threshold):
+    """
+    Regressions of p95 latency or throughput beyond threshold, as readable lines
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            regressions.append("%s: p95 %.3fms -> %.3fms" % (key, base["p95_ms"], result["p95_ms"]))
+        if result["throughput"] < base["throughput"] * (1 - threshold):
+            regressions.append("%s: throughput %.2f/s -> %.2f/s" % (key, base["throughput"], result["throughput"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every REST route")
+    parser.add_argument("--types", type=int, default=3, help="number of risk types to seed")
+    parser.add_argument("--attributes", type=int, default=10, help="attributes per risk type")
+    parser.add_argument("--insured", type=int, default=1000, help="insured per risk type")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route and concurrency level")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency levels")
+    parser.add_argument("--route", action="append", help="only benchmark this route, may be repeated")
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process test client")
+    parser.add_argument("--output", default="bench.json", help="json file for the results")
+    parser.add_argument("--baseline", help="json results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--storage", choices=["eav", "document"], help="storage of the insured values (in-process only)")
+    parser.add_argument("--stats-counters", action="store_true", help="keep the attribute summary counters (in-process only)")
+    parser.add_argument("--group-commit", type=float, default=0,
+                        help="commit insured writes in groups, every this many ms (in-process only)")
+    parser.add_argument("--soft-delete", action="store_true",
+                        help="mark deleted insured for the background purger (in-process only)")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="spread the insured of the risk types over this many shard databases (in-process only)")
+    args = parser.parse_args(argv)
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    scratch = None
+    if args.url:
+        driver = HttpDriver(args.url)
+    else:
+        # the engine of property.py is created on import from INSURANCE_DB_URL
+        scratch = tempfile.mkdtemp(prefix="insurance-bench-")
+        os.environ["INSURANCE_DB_URL"] = "sqlite:///" + os.path.join(scratch, "bench.db")
+        if args.storage:
+            os.environ["INSURANCE_STORAGE"] = args.storage
+        if args.stats_counters:
+            os.environ["INSURANCE_STATS_COUNTERS"] = "1"
+        if args.shards:
+            os.environ["INSURANCE_SHARDS"] = str(args.shards)
+        if args.soft_delete:
+            os.environ["INSURANCE_SOFT_DELETE"] = "1"
+        os.environ["INSURANCE_PROFILE_DIR"] = os.path.join(scratch, "profiles")
+        os.environ.setdefault("INSURANCE_PROFILE_TOKEN", "bench")
+        import migrations
+        import property
+        migrations.upgrade(property.engine, property.Base.metadata)
+        property.checkStorage()
+        property.startWriteQueue(args.group_commit)
+        property.startPurger()
+        driver = TestClientDriver(property.app)
+
+    try:
+        started = time.time()
+        data = seed(driver, args.types, args.attributes, args.insured)
+        print("seeded %d types x %d attributes x %d insured in %.1fs" % (
+            args.types, args.attributes, args.insured, time.time() - started))
+
+        routes = scenarios(driver, data)
+        if not args.url:
+            # every rule of the app should have a scenario
+            covered = set(route.split("?")[0] for _, route, _, _ in routes)
+            for rule in property.app.url_map.iter_rules():
+                if rule.endpoint != "static" and rule.rule not in covered:
+                    print("warning: no benchmark for %s" % rule.rule)
+
+        results = OrderedDict()
+        print("%-44s %6s %4s %10s %9s %9s %9s %6s" % ("route", "method", "c", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors"))
+        for method, route, setup, build in routes:
+            if args.route and route not in args.route:
+                continue
+            for level in levels:
+                pool = setup(args.requests) if setup else None
+                result = run(driver, method, build, pool, args.requests, level)
+                key = "%s %s @%d" % (method, route, level)
+                results[key] = OrderedDict([("method", method), ("route", route), ("concurrency", level)])
+                results[key].update(result)
+                print("%-44s %6s %4d %10.2f %9.3f %9.3f %9.3f %6d" % (route, method, level, result["throughput"],
+                      result["p50_ms"], result["p95_ms"], result["p99_ms"], result["errors"]))
+    finally:
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(OrderedDict([("config", vars(args)), ("results", results)]), f, indent=2)
+    print("results written to %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print("regression: " + line)
+        if regressions:
+            return 1
+        print("no regressions against %s" % args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,95 @@
-CREATE TABLE insurance(id INTEGER,
-                            type VARCHAR(256) NOT NULL UNIQUE,
+/* Schema version 13, see migrations.py. The tables are created from the models in property.py */
+
+/* free pages are given back by the incremental vacuum steps of the purger */
+PRAGMA auto_vacuum = INCREMENTAL;
+
+CREATE TABLE insurance(id INTEGER NOT NULL,
+                            type VARCHAR(256) NOT NULL,  /* type of insurance/risk */
+                            shard INTEGER,  /* shard database of its insured, NULL for the main database */
                             PRIMARY KEY (id)
                             );
+CREATE UNIQUE INDEX ix_insurance_type ON insurance (type);
 
-CREATE TABLE insuranceAttributes(id INTEGER,
-                            insuranceID INTEGER REFERENCES insuranceID(id),
-                            name VARCHAR(256),   /* Name of the attribute/field */
-                            dataType INTEGER, /* type of the data  for this attribute */ 
+CREATE TABLE iattributes(id INTEGER NOT NULL,
+                            insuranceID INTEGER REFERENCES insurance(id),
+                            name VARCHAR(256) NOT NULL,  /* Name of the attribute/field */
+                            dataType VARCHAR(256) NOT NULL,  /* type of the data for this attribute: int, enum, string */
+                            mandatory VARCHAR(3) NOT NULL,  /* yes or no */
+                            enumValues VARCHAR(4096),  /* allowed values of an enum attribute, json list */
                             PRIMARY KEY (id)
                             );
- 
-CREATE TABLE insured(id INTEGER,
+CREATE UNIQUE INDEX ix_iattributes_insurance_name ON iattributes (insuranceID, name);
+
+CREATE TABLE insured(id INTEGER NOT NULL,
                             insuranceID INTEGER REFERENCES insurance(id), /*Insurance type to which this attribute belongs to*/
+                            document TEXT, /* attribute values as one json object, with the document storage */
+                            deleted DATETIME, /* time of a soft delete, the row is removed later by the purger */
+                            PRIMARY KEY (id)
+                            );
+CREATE INDEX ix_insured_insuranceID ON insured (insuranceID, deleted);
+CREATE INDEX ix_insured_deleted ON insured (deleted) WHERE deleted IS NOT NULL;
+
+CREATE TABLE insured_data(id INTEGER NOT NULL,
+                            insuredID INTEGER REFERENCES insured(id), /* Insured ID to whome/which this data belongs to*/
+                            name VARCHAR(256), /*Attribuete/Field name */
+                            value VARCHAR(4096), /*Attribute value, in opaque format */
+                            intValue INTEGER, /* typed copy of the value of an int attribute */
+                            PRIMARY KEY (id)
+                            );
+CREATE UNIQUE INDEX ix_insured_data_insured_name ON insured_data (insuredID, name);
+CREATE INDEX ix_insured_data_name_int ON insured_data (name, intValue);
+CREATE INDEX ix_insured_data_name_value ON insured_data (name, value);
+
+CREATE TABLE jobs(id INTEGER NOT NULL,
+                            kind VARCHAR(64) NOT NULL,  /* deleteAttribute, deleteType */
+                            insuranceType VARCHAR(256) NOT NULL,
+                            params VARCHAR(4096),  /* job parameters, json */
+                            status VARCHAR(16) NOT NULL,  /* queued, running, done, failed */
+                            processed INTEGER NOT NULL,
+                            total INTEGER,
+                            message VARCHAR(4096),
+                            created DATETIME NOT NULL,
+                            updated DATETIME NOT NULL,
+                            PRIMARY KEY (id)
+                            );
+
+CREATE TABLE load_checkpoints(id INTEGER NOT NULL,
+                            source VARCHAR(4096) NOT NULL,  /* absolute path of the input file */
+                            insuranceType VARCHAR(256) NOT NULL,
+                            records INTEGER NOT NULL,  /* input records done, loaded or rejected */
+                            loaded INTEGER NOT NULL,
+                            rejected INTEGER NOT NULL,
+                            updated DATETIME NOT NULL,
+                            PRIMARY KEY (id)
+                            );
+CREATE UNIQUE INDEX ix_load_checkpoints_source_type ON load_checkpoints (source, insuranceType);
+
+CREATE TABLE settings(name VARCHAR(64) NOT NULL,
+                            value VARCHAR(4096),  /* storage: eav or document, the layout of the insured values */
+                            PRIMARY KEY (name)
+                            );
+/* nextInsuredID: next insured id given by the database, reserved by the insured writes */
+INSERT INTO settings (name, value) VALUES ('nextInsuredID', '1');
+/* Shard databases (INSURANCE_SHARDS) hold insured, insured_data and settings, with their
+   own nextInsuredID, from (shard + 1) << 40, and the changes and attribute_stats of their
+   insured, with their own change sequence */
+
+CREATE TABLE changes(id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,  /* sequence of the change, read by the change feed */
+                            kind VARCHAR(32) NOT NULL,  /* typeCreated, typeDeleted, attributeAdded, attributeDeleted, insuredAdded, insuredUpdated, insuredDeleted */
+                            insuranceType VARCHAR(256) NOT NULL,
+                            insuredID INTEGER,
+                            data TEXT,  /* json: attribute values written, attribute added or deleted */
+                            created DATETIME NOT NULL
+                            );
+CREATE INDEX ix_changes_type ON changes (insuranceType, id);
+
+CREATE TABLE attribute_stats(id INTEGER NOT NULL,
+                            insuranceID INTEGER NOT NULL REFERENCES insurance(id),
+                            name VARCHAR(256),  /* attribute, null for the row counting the insured of the type */
+                            count INTEGER NOT NULL,  /* insured having the attribute */
+                            total INTEGER NOT NULL,  /* sum of the values of an int attribute */
                             PRIMARY KEY (id)
-                            ); 
+                            );
+CREATE UNIQUE INDEX ix_attribute_stats_insurance_name ON attribute_stats (insuranceID, name);
 
-CREATE TABLE insuredData(id INTEGER, insuredID INTEGER REFERENCES insured(id), /* Insured ID to whome/which this data belongs to*/
-			name VARCHAR(256), /*Attribuete/Field name */
-                        opaqueValue VARCHAR(4096)); /*Attribute value, in opaque format */  	
+PRAGMA user_version = 13;
@@ -0,0 +1,115 @@
+"""
+Export all insured of an insurance type in wide format: one row per insured,
+one column per attribute, from a single ordered scan of the configured storage.
+
+csv and ndjson are written in chunks, parquet (needs pyarrow) in row groups
+of STREAM_CHUNK_SIZE insured, so memory stays constant whatever the size.
+Values of int attributes kept as text that is not a number (stored before the
+int values were checked) are written to parquet as null, and counted on stderr.
+
+usage: python export.py health [--format csv|ndjson|parquet] [--output health.csv] [--db sqlite:///propertyInsurance.db]
+"""
+import argparse
+import sys
+
+from sqlalchemy.orm.exc import NoResultFound
+
+import property
+
+
+# an int column value of parquet, None when the stored text is not a number
+def _parquetInt(value):
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return property._coerceInt(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _writeParquet(session, insurance, output):
+    """
+    Write the insured of insurance to the parquet file output,
+    returns the number of int values written as null because they are not numbers
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit("parquet export needs pyarrow (pip install pyarrow)")
+
+    columns = list(insurance.attributes)
+    fields = [pyarrow.field("insuredID", pyarrow.int64())] + \
+             [pyarrow.field(name, pyarrow.int64() if attr.dataType == "int" else pyarrow.string())
+              for name, attr in insurance.attributes.items()]
+    schema = pyarrow.schema(fields)
+
+    def flush(rows):
+        arrays, invalid = [pyarrow.array([row[0] for row in rows], pyarrow.int64())], 0
+        for name, field in zip(columns, fields[1:]):
+            values = [row[1].get(name) for row in rows]
+            if field.type == pyarrow.int64():
+                numbers = [_parquetInt(value) for value in values]
+                invalid += sum(number is None and value is not None for number, value in zip(numbers, values))
+                values = numbers
+            arrays.append(pyarrow.array(values, field.type))
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        return invalid
+
+    writer = pyarrow.parquet.ParquetWriter(output, schema)
+    try:
+        rows, invalid = [], 0
+        for row in property.storage.scan(session, insurance, chunkSize=property.STREAM_CHUNK_SIZE):
+            rows.append(row)
+            if len(rows) == property.STREAM_CHUNK_SIZE:
+                invalid += flush(rows)
+                rows = []
+        if rows:
+            invalid += flush(rows)
+    finally:
+        writer.close()
+    return invalid
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the insured of an insurance type, one row per insured")
+    parser.add_argument("type", help="insurance type")
+    parser.add_argument("--format", default="csv", choices=list(property.EXPORT_FORMATS) + ["parquet"])
+    parser.add_argument("--output", help="output file, defaults to stdout (required for parquet)")
+    parser.add_argument("--db", help="database url, defaults to the application database")
+    args = parser.parse_args(argv)
+
+    if args.format == "parquet" and not args.output:
+        parser.error("--output is required for parquet")
+    if args.db:
+        property.useEngine(property.createEngine({"url": args.db}))
+    property.checkStorage()
+
+    session = property.SessionFactory()
+    try:
+        try:
+            insurance = property.schemaCache.get(session, args.type)
+        except NoResultFound:
+            print("insurance type %s not found" % args.type, file=sys.stderr)
+            return 1
+
+        if args.format == "parquet":
+            invalid = _writeParquet(session, insurance, args.output)
+            if invalid:
+                print("%d int values that are not numbers written as null" % invalid, file=sys.stderr)
+            return 0
+
+        output = open(args.output, "w", newline="") if args.output else sys.stdout
+        try:
+            for chunk in property._exportLines(session, insurance, args.format):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        return 0
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
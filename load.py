@@ -0,0 +1,277 @@
+"""
+Offline bulk loader of insured records, for migrations from legacy systems.
+
+Records are read from a CSV file (a header row of attribute names, one insured
+per row, empty cells are absent attributes) or an NDJSON file (one insured per
+line, either {"attributes": [...]} as for addInsured or {"attributeName": value}).
+They are validated against the insurance type in a process pool and written
+with the bulk inserts of the configured storage, in large transactions, and
+appended to the change log. The checkpoint of the load is updated in the same
+transaction as each chunk, so an interrupted load resumes after the last
+committed chunk when run again.
+
+Rejected records go to a report file, one json line per record with its
+number, the reason and the input record.
+
+usage: python load.py health insured.csv [--chunk-size 10000] [--workers 4] [--defer-indexes]
+                      [--rejected insured.csv.rejected.ndjson] [--db sqlite:///propertyInsurance.db]
+"""
+import argparse
+import collections
+import csv
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from sqlalchemy.orm.exc import NoResultFound
+
+import migrations
+import property
+
+
+# validator of the insurance type in a pool process
+_validator = None
+
+def _initWorker(attributes):
+    global _validator
+    _validator = property.RiskValidator(attributes)
+
+
+# attributes list of an input record, as sent to addInsured
+def _attributes(inputFormat, header, item):
+    if inputFormat == "csv":
+        if len(item) != len(header):
+            raise ValueError("columns")
+        return [{"attributeName": name, "attributeValue": value} for name, value in zip(header, item) if value != ""]
+
+    record = json.loads(item)
+    if not isinstance(record, dict):
+        raise ValueError("record")
+    if "attributes" in record:
+        return record["attributes"]
+    return [{"attributeName": name, "attributeValue": value} for name, value in record.items()]
+
+
+# validate a chunk of input records, returns [(values, None) or (None, error message)]
+def _validateChunk(task):
+    inputFormat, header, items = task
+    results = []
+    for item in items:
+        try:
+            attributes = _attributes(inputFormat, header, item)
+        except ValueError:
+            results.append((None, "Invalid request"))
+            continue
+        values, message, code = _validator.validate(attributes)
+        results.append((values, message))
+    return results
+
+
+def _readRecords(path, inputFormat):
+    """
+    (header, iterator of records) of an input file, records are csv rows or ndjson lines
+    """
+    stream = open(path, newline="") if inputFormat == "csv" else open(path)
+    if inputFormat == "csv":
+        reader = csv.reader(stream)
+        header = next(reader, [])
+        return header, reader
+    return None, (line for line in stream if line.strip())
+
+
+def _chunks(records, size):
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# secondary indexes rebuilt once at the end when --defer-indexes is set, unique indexes stay
+def _deferredIndexes():
+    return [index for name in ("insured", "insured_data")
+            for index in property.Base.metadata.tables[name].indexes if not index.unique]
+
+
+def _hasIndex(engine, name):
+    with engine.connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name = ?",
+                            (name,)).scalar() > 0
+
+
+# create the deferred indexes missing from the database of engine, returns their number
+def _rebuildIndexes(engine, log=print):
+    started = time.time()
+    missing = [index for index in _deferredIndexes() if not _hasIndex(engine, index.name)]
+    for index in missing:
+        index.create(engine)
+    if missing:
+        log("rebuilt %d indexes in %.1fs" % (len(missing), time.time() - started))
+    return len(missing)
+
+
+# write the valid records of a chunk and move the checkpoint, in one transaction
+def _writeChunk(session, insurance, checkpoint, records, results):
+    valid = [values for values, message in results if values is not None]
+    # the ids come from the counter of the database of the type, like the ones of the server
+    insuredIDs = property._reserveInsuredIDs(session, len(valid)) if valid else []
+    insured = list(zip(insuredIDs, valid))
+    rows = property.storage.insert(session, insurance, insured) if insured else 0
+    property._logChanges(session, [("insuredAdded", insurance.type, insuredID, values) for insuredID, values in insured])
+    property._countStats(session, insurance, added=valid, insured=len(valid))
+    checkpoint.records += records
+    checkpoint.loaded += len(insured)
+    checkpoint.rejected += records - len(insured)
+    checkpoint.updated = datetime.datetime.utcnow()
+    session.commit()
+    return len(insured), rows
+
+
+# keep the report lines of the records before the checkpoint, from an interrupted run
+def _openReport(path, records):
+    kept = []
+    if records and os.path.exists(path):
+        with open(path) as report:
+            kept = [line for line in report if json.loads(line)["record"] < records]
+    report = open(path, "w")
+    report.writelines(kept)
+    return report
+
+
+def _reasons(path):
+    reasons = collections.Counter()
+    with open(path) as report:
+        for line in report:
+            reasons[json.loads(line)["message"]] += 1
+    return reasons
+
+
+def load(insuranceType, path, inputFormat, chunkSize, workers, deferIndexes, reportPath, log=print):
+    """
+    Load the records of path into an insurance type, resuming from its checkpoint,
+    returns the checkpoint at the end
+    """
+    source = os.path.abspath(path)
+    session = property.SessionFactory()
+    try:
+        try:
+            insurance = property.schemaCache.get(session, insuranceType)
+        except NoResultFound:
+            raise SystemExit("insurance type %s not found" % insuranceType)
+
+        checkpoint = session.query(property.LoadCheckpoint) \
+                    .filter(property.LoadCheckpoint.source == source,
+                            property.LoadCheckpoint.insuranceType == insuranceType).one_or_none()
+        if checkpoint is None:
+            checkpoint = property.LoadCheckpoint(source=source, insuranceType=insuranceType,
+                                                 records=0, loaded=0, rejected=0)
+            session.add(checkpoint)
+            session.commit()
+        elif checkpoint.records:
+            log("resuming %s after record %d" % (source, checkpoint.records))
+
+        # database of the insured of the type, the main one or its shard
+        engine = property.engine if insurance.shard is None else property.shardEngine(insurance.shard)
+        if deferIndexes:
+            for index in _deferredIndexes():
+                session.execute("DROP INDEX IF EXISTS %s" % index.name, mapper=property.Insured)
+            session.commit()
+        else:
+            # indexes dropped by a deferred load that was killed before rebuilding them
+            _rebuildIndexes(engine, log)
+
+        try:
+            header, records = _readRecords(path, inputFormat)
+            records = itertools.islice(records, checkpoint.records, None)
+            report = _openReport(reportPath, checkpoint.records)
+
+            started = time.time()
+            loadedRecords, loadedRows = 0, 0
+            pool = multiprocessing.Pool(workers, _initWorker, (insurance.attributes,))
+            try:
+                # validate ahead of the writes, a bounded number of chunks at a time
+                pending = collections.deque()
+                chunks = _chunks(records, chunkSize)
+                while True:
+                    for chunk in itertools.islice(chunks, workers * 2 - len(pending)):
+                        pending.append((chunk, pool.apply_async(_validateChunk, ((inputFormat, header, chunk),))))
+                    if not pending:
+                        break
+
+                    chunk, results = pending.popleft()
+                    results = results.get()
+                    first = checkpoint.records
+                    for offset, (item, (values, message)) in enumerate(zip(chunk, results)):
+                        if values is None:
+                            data = dict(zip(header, item)) if inputFormat == "csv" else item.rstrip("\n")
+                            report.write(json.dumps({"record": first + offset, "message": message,
+                                                     "data": data}) + "\n")
+                    report.flush()
+
+                    insured, rows = _writeChunk(session, insurance, checkpoint, len(chunk), results)
+                    loadedRecords += insured
+                    loadedRows += rows
+                    log("%d records done, %d loaded, %d rejected" % (checkpoint.records, checkpoint.loaded,
+                                                                     checkpoint.rejected))
+            except KeyboardInterrupt:
+                pool.terminate()
+                session.rollback()
+                raise SystemExit("interrupted after record %d, run again to resume" % checkpoint.records)
+            finally:
+                pool.terminate()
+                report.close()
+
+            elapsed = max(time.time() - started, 1e-9)
+            log("loaded %d insured (%d attribute rows) in %.1fs: %.0f records/s, %.0f rows/s"
+                % (loadedRecords, loadedRows, elapsed, loadedRecords / elapsed, loadedRows / elapsed))
+        except Exception:
+            # the write lock of a failed chunk is given back before the indexes are rebuilt
+            session.rollback()
+            raise
+        finally:
+            if deferIndexes:
+                # the indexes come back when the load fails or is interrupted too
+                _rebuildIndexes(engine, log)
+
+        return checkpoint
+    finally:
+        session.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load insured records from a csv or ndjson file")
+    parser.add_argument("type", help="insurance type")
+    parser.add_argument("input", help="csv or ndjson file")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="input format, by default from the file extension")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="records per transaction")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="validation processes")
+    parser.add_argument("--defer-indexes", action="store_true",
+                        help="drop the secondary indexes during the load and rebuild them at the end")
+    parser.add_argument("--rejected", help="report of the rejected records, defaults to <input>.rejected.ndjson")
+    parser.add_argument("--db", help="database url, defaults to the application database")
+    args = parser.parse_args(argv)
+
+    inputFormat = args.format or ("csv" if args.input.lower().endswith(".csv") else "ndjson")
+    reportPath = args.rejected or args.input + ".rejected.ndjson"
+    if args.db:
+        property.useEngine(property.createEngine({"url": args.db}))
+    migrations.upgrade(property.engine, property.Base.metadata, log=print)
+    property.checkStorage()
+
+    checkpoint = load(args.type, args.input, inputFormat, args.chunk_size, max(args.workers, 1),
+                      args.defer_indexes, reportPath)
+
+    print("%d records: %d loaded, %d rejected" % (checkpoint.records, checkpoint.loaded, checkpoint.rejected))
+    if checkpoint.rejected:
+        for message, count in _reasons(reportPath).most_common():
+            print("%10d  %s" % (count, message))
+        print("rejected records written to %s" % reportPath)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+"""
+Per-route request metrics for the Flask app, exposed in Prometheus text format.
+
+instrument(app, engine) records for every route a latency histogram, status
+code counts and in-flight requests, and through SQLAlchemy engine events the
+number of SQL statements and the time spent in the database per request.
+Everything is kept in process with plain dicts under one lock. The SQL counts
+of a request live in flask.g, so they stay per request when several requests
+share a thread, as in the asyncio serving mode of asgi.py.
+"""
+import bisect
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, g, has_app_context, request
+from sqlalchemy import event
+
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    """
+    Counters, gauges and histograms keyed by metric name and label values
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = OrderedDict()   # name -> (type, help, {labels: value})
+        self.collectors = []           # callables returning [(name, type, help, labels, value)]
+
+    def _series(self, name, kind, help):
+        if name not in self.metrics:
+            self.metrics[name] = (kind, help, {})
+        return self.metrics[name][2]
+
+    def inc(self, name, help, labels, value=1):
+        with self.lock:
+            series = self._series(name, "counter", help)
+            series[labels] = series.get(labels, 0) + value
+
+    def add(self, name, help, labels, value):
+        with self.lock:
+            series = self._series(name, "gauge", help)
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, help, labels, value, buckets):
+        with self.lock:
+            series = self._series(name, "histogram", help)
+            if labels not in series:
+                series[labels] = Histogram(buckets)
+            series[labels].observe(value)
+
+    def render(self):
+        """
+        All metrics in Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for name, (kind, help, series) in self.metrics.items():
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for labels, value in series.items():
+                    if kind == "histogram":
+                        cumulative = 0
+                        for bound, count in zip(value.buckets + ("+Inf",), value.counts):
+                            cumulative += count
+                            lines.append("%s_bucket%s %s" % (name, _labels(labels + (("le", str(bound)),)), cumulative))
+                        lines.append("%s_sum%s %s" % (name, _labels(labels), _number(value.sum)))
+                        lines.append("%s_count%s %s" % (name, _labels(labels), value.count))
+                    else:
+                        lines.append("%s%s %s" % (name, _labels(labels), _number(value)))
+
+        for collector in self.collectors:
+            for name, kind, help, labels, value in collector():
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, kind))
+                lines.append("%s%s %s" % (name, _labels(labels), _number(value)))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+
+def _routeLabels():
+    rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    return (("method", request.method), ("route", rule))
+
+
+def _beforeRequest():
+    labels = _routeLabels()
+    g.metricsLabels = labels
+    g.metricsStart = time.perf_counter()
+    g.metricsStatements = 0
+    g.metricsDbSeconds = 0.0
+    registry.add("insurance_http_requests_in_flight", "Requests being served", labels, 1)
+
+
+def _afterRequest(response):
+    g.metricsStatus = response.status_code
+    return response
+
+
+def _teardownRequest(exception=None):
+    labels = getattr(g, "metricsLabels", None)
+    if labels is None:
+        return
+    elapsed = time.perf_counter() - g.metricsStart
+    status = getattr(g, "metricsStatus", 500)
+
+    registry.add("insurance_http_requests_in_flight", "Requests being served", labels, -1)
+    registry.inc("insurance_http_requests_total", "Requests by status code", labels + (("status", status),))
+    registry.observe("insurance_http_request_duration_seconds", "Request latency", labels, elapsed, LATENCY_BUCKETS)
+    registry.observe("insurance_sql_statements_per_request", "SQL statements per request", labels,
+                     g.metricsStatements, STATEMENT_BUCKETS)
+    registry.inc("insurance_sql_statements_total", "SQL statements executed", labels, g.metricsStatements)
+    registry.inc("insurance_sql_duration_seconds_total", "Time spent executing SQL", labels, g.metricsDbSeconds)
+    g.metricsStatements = None
+
+
+def _beforeCursorExecute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metricsStart", []).append(time.perf_counter())
+
+
+def _afterCursorExecute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metricsStart"].pop()
+    # statements outside of a request, like background jobs, are not attributed
+    if has_app_context() and getattr(g, "metricsStatements", None) is not None:
+        g.metricsStatements += 1
+        g.metricsDbSeconds += elapsed
+
+
+def _handleError(context):
+    if context.connection is not None and context.connection.info.get("metricsStart"):
+        context.connection.info["metricsStart"].pop()
+
+
+def instrument(app, engine, path="/metrics"):
+    """
+    Record request and SQL metrics of app and engine, served at path
+    """
+    app.before_request(_beforeRequest)
+    app.after_request(_afterRequest)
+    app.teardown_request(_teardownRequest)
+    instrumentEngine(engine)
+
+    def getMetrics():
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule(path, "metrics", getMetrics, methods=["GET"])
+    return registry
+
+
+def instrumentEngine(engine):
+    """
+    Record the SQL statements of a (sync) engine in the metrics of the current request
+    """
+    event.listen(engine, "before_cursor_execute", _beforeCursorExecute)
+    event.listen(engine, "after_cursor_execute", _afterCursorExecute)
+    event.listen(engine, "handle_error", _handleError)
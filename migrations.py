@@ -0,0 +1,407 @@
+"""
+Versioned schema migrations for the insurance database.
+
+The schema version is kept in SQLite's "PRAGMA user_version". A new database
+is created straight from the models, an existing one is upgraded in place by
+running every migration newer than its version, each in its own transaction.
+
+Insured attribute values are moved between the storage backends (eav, document)
+with the convert command; stop the application and set INSURANCE_STORAGE to match.
+
+Shard databases (INSURANCE_SHARDS) only hold the insured tables, with the change log
+and the summary counters of their insured. They are created by createShard() at the
+latest version when first opened, and upgraded by the migrations of SHARD_MIGRATIONS.
+
+New databases give their free pages back with incremental vacuum steps (the purger
+of property.py); the vacuum command switches existing ones, with the application
+stopped, by rebuilding the database files.
+
+usage: python migrations.py [--db sqlite:///propertyInsurance.db] [status|upgrade|convert eav|document|vacuum]
+"""
+import argparse
+import sys
+
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+
+def _hasTable(cursor, name):
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cursor.fetchone()[0] > 0
+
+
+def _hasColumn(cursor, table, column):
+    cursor.execute("PRAGMA table_info(%s)" % table)
+    return column in [row[1] for row in cursor.fetchall()]
+
+
+# create a table and its indexes from the models, unless it exists
+def _createTable(cursor, metadata, engine, name):
+    table = metadata.tables[name]
+    if _hasTable(cursor, table.name):
+        return
+    cursor.execute(str(CreateTable(table).compile(dialect=engine.dialect)))
+    for index in table.indexes:
+        cursor.execute(str(CreateIndex(index).compile(dialect=engine.dialect)))
+
+
+# version 1: tables as created by the first releases (Base.metadata.create_all)
+def _baseline(cursor, metadata, engine):
+    for name in ("insurance", "iattributes", "insured", "insured_data"):
+        _createTable(cursor, metadata, engine, name)
+
+
+# attributes stored twice listed in the error of version 2
+DUPLICATES_SHOWN = 10
+
+
+# version 2: indexes and unique constraints for the handler lookups
+def _addIndexes(cursor, metadata, engine):
+    # an attribute stored twice for an insured is left to the operator, which value is right is not known here
+    cursor.execute("SELECT insuredID, name FROM insured_data GROUP BY insuredID, name HAVING COUNT(*) > 1 "
+                   "ORDER BY insuredID, name")
+    duplicates = cursor.fetchall()
+    if duplicates:
+        shown = ", ".join("insured %s %s" % (insuredID, name) for insuredID, name in duplicates[:DUPLICATES_SHOWN])
+        if len(duplicates) > DUPLICATES_SHOWN:
+            shown += " and %d more" % (len(duplicates) - DUPLICATES_SHOWN)
+        raise RuntimeError("attributes stored more than once: %s; keep one value of each, the latest with: "
+                           "DELETE FROM insured_data WHERE id NOT IN (SELECT MAX(id) FROM insured_data "
+                           "GROUP BY insuredID, name), then run python migrations.py upgrade again" % shown)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_insurance_type ON insurance (type)")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_iattributes_insurance_name "
+                   "ON iattributes (insuranceID, name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_insured_insuranceID ON insured (insuranceID)")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_insured_data_insured_name "
+                   "ON insured_data (insuredID, name)")
+
+
+# version 3: typed copy of int attribute values, indexed for range queries
+def _addIntValues(cursor, metadata, engine):
+    if not _hasColumn(cursor, "insured_data", "intValue"):
+        cursor.execute("ALTER TABLE insured_data ADD COLUMN intValue INTEGER")
+    cursor.execute("UPDATE insured_data SET intValue = CAST(value AS INTEGER) WHERE EXISTS "
+                   "(SELECT 1 FROM insured JOIN iattributes ON iattributes.insuranceID = insured.insuranceID "
+                   "WHERE insured.id = insured_data.insuredID AND iattributes.name = insured_data.name "
+                   "AND iattributes.dataType = 'int') "
+                   "AND CAST(CAST(value AS INTEGER) AS TEXT) = value")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_insured_data_name_int ON insured_data (name, intValue)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_insured_data_name_value ON insured_data (name, value)")
+
+
+# version 4: background jobs for schema changes
+def _addJobs(cursor, metadata, engine):
+    _createTable(cursor, metadata, engine, "jobs")
+
+
+# version 5: allowed values of enum attributes
+def _addEnumValues(cursor, metadata, engine):
+    if not _hasColumn(cursor, "iattributes", "enumValues"):
+        cursor.execute("ALTER TABLE iattributes ADD COLUMN enumValues VARCHAR(4096)")
+
+
+# version 6: checkpoints of offline loads
+def _addLoadCheckpoints(cursor, metadata, engine):
+    _createTable(cursor, metadata, engine, "load_checkpoints")
+
+
+# version 7: json document of the attribute values of an insured, for the document storage
+def _addDocuments(cursor, metadata, engine):
+    if not _hasColumn(cursor, "insured", "document"):
+        cursor.execute("ALTER TABLE insured ADD COLUMN document TEXT")
+    _createTable(cursor, metadata, engine, "settings")
+
+
+# version 8: change log read by the change feed
+def _addChanges(cursor, metadata, engine):
+    _createTable(cursor, metadata, engine, "changes")
+
+
+# version 9: summary counters of the attribute values
+def _addAttributeStats(cursor, metadata, engine):
+    _createTable(cursor, metadata, engine, "attribute_stats")
+
+
+# version 10: shard database of the insured of each insurance type
+def _addShards(cursor, metadata, engine):
+    if not _hasColumn(cursor, "insurance", "shard"):
+        cursor.execute("ALTER TABLE insurance ADD COLUMN shard INTEGER")
+
+
+# version 11: soft deleted insured, removed later by the purger
+def _addSoftDelete(cursor, metadata, engine):
+    if not _hasColumn(cursor, "insured", "deleted"):
+        cursor.execute("ALTER TABLE insured ADD COLUMN deleted DATETIME")
+    # the live insured of a type are looked up by (insuranceID, deleted IS NULL)
+    cursor.execute("DROP INDEX IF EXISTS ix_insured_insuranceID")
+    cursor.execute("CREATE INDEX ix_insured_insuranceID ON insured (insuranceID, deleted)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_insured_deleted ON insured (deleted) WHERE deleted IS NOT NULL")
+
+
+# version 12: insured ids of the main database reserved from a counter, like the ones of a shard
+def _addInsuredIDCounter(cursor, metadata, engine):
+    cursor.execute("INSERT OR IGNORE INTO settings (name, value) "
+                   "SELECT 'nextInsuredID', COALESCE(MAX(id), 0) + 1 FROM insured")
+
+
+# version 13: change log and summary counters of the insured kept in their shard database; the
+# counters of the sharded types are counted there again on start-up, their changes logged so far
+# stay in the main database
+def _addShardChanges(cursor, metadata, engine):
+    _createTable(cursor, metadata, engine, "changes")
+    _createTable(cursor, metadata, engine, "attribute_stats")
+    if _hasTable(cursor, "insurance"):
+        cursor.execute("DELETE FROM attribute_stats WHERE insuranceID IN "
+                       "(SELECT id FROM insurance WHERE shard IS NOT NULL)")
+        cursor.execute("UPDATE settings SET value = 'off' WHERE name = 'statsCounters' "
+                       "AND EXISTS (SELECT 1 FROM insurance WHERE shard IS NOT NULL)")
+
+
+# (version, description, migration), in order
+MIGRATIONS = [
+    (1, "baseline tables", _baseline),
+    (2, "indexes and unique constraints", _addIndexes),
+    (3, "typed int values", _addIntValues),
+    (4, "background jobs", _addJobs),
+    (5, "enum values", _addEnumValues),
+    (6, "load checkpoints", _addLoadCheckpoints),
+    (7, "insured documents", _addDocuments),
+    (8, "change log", _addChanges),
+    (9, "attribute summary counters", _addAttributeStats),
+    (10, "insured shards", _addShards),
+    (11, "soft deleted insured", _addSoftDelete),
+    (12, "insured id counter", _addInsuredIDCounter),
+    (13, "change log and counters in the shards", _addShardChanges),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def getVersion(engine):
+    """
+    Get the schema version of the database
+    """
+    with engine.connect() as conn:
+        return conn.execute("PRAGMA user_version").scalar()
+
+
+def _hasTables(engine):
+    with engine.connect() as conn:
+        return conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").scalar() > 0
+
+
+# run work(cursor) in one explicit transaction of a raw connection
+def _inTransaction(engine, work, begin="BEGIN"):
+    raw = engine.raw_connection()
+    dbapi_conn = raw.connection
+    isolation_level = dbapi_conn.isolation_level
+    dbapi_conn.isolation_level = None
+    cursor = dbapi_conn.cursor()
+    try:
+        cursor.execute(begin)
+        result = work(cursor)
+        cursor.execute("COMMIT")
+        return result
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        cursor.close()
+        dbapi_conn.isolation_level = isolation_level
+        raw.close()
+
+
+# free pages of a new database are given back by incremental vacuum steps, set before its
+# first table; the journal mode already wrote the header of the file, VACUUM rewrites it
+def _setIncrementalVacuum(conn):
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def upgrade(engine, metadata, log=None):
+    """
+    Upgrade the database to the latest schema version,
+    returns the list of applied migration versions
+    """
+    if not _hasTables(engine):
+        # new database, the models are already at the latest version
+        with engine.connect() as conn:
+            _setIncrementalVacuum(conn)
+        metadata.create_all(engine)
+        with engine.connect() as conn:
+            conn.execute("INSERT INTO settings (name, value) VALUES ('nextInsuredID', '1')")
+            conn.execute("PRAGMA user_version = %d" % LATEST_VERSION)
+        return []
+
+    applied = []
+    current = getVersion(engine)
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        if log:
+            log("applying migration %d: %s" % (version, description))
+
+        # run the migration and the version bump in one explicit transaction
+        def work(cursor):
+            migration(cursor, metadata, engine)
+            cursor.execute("PRAGMA user_version = %d" % version)
+        _inTransaction(engine, work)
+        applied.append(version)
+
+    return applied
+
+
+# tables of a shard database
+SHARD_TABLES = ("insured", "insured_data", "settings", "changes", "attribute_stats")
+
+# versions of the migrations of the shard tables, also run on the shard databases
+SHARD_MIGRATIONS = (11, 13)
+
+# insured ids of a shard database start at (shard + 1) << SHARD_ID_BITS, above the ids of the main database
+SHARD_ID_BITS = 40
+
+
+def createShard(engine, metadata, shard):
+    """
+    Create the insured tables of a shard database unless it has them, else upgrade
+    them, returns the list of applied migration versions
+    """
+    if not _hasTables(engine):
+        with engine.connect() as conn:
+            _setIncrementalVacuum(conn)
+
+    # immediate, so processes opening the same new shard create it once
+    def work(cursor):
+        applied = []
+        if _hasTable(cursor, "insured"):
+            cursor.execute("PRAGMA user_version")
+            current = cursor.fetchone()[0]
+            for version, description, migration in MIGRATIONS:
+                if version > current and version in SHARD_MIGRATIONS:
+                    migration(cursor, metadata, engine)
+                    applied.append(version)
+        else:
+            for name in SHARD_TABLES:
+                _createTable(cursor, metadata, engine, name)
+            cursor.execute("INSERT OR IGNORE INTO settings (name, value) VALUES ('nextInsuredID', ?)",
+                           (str((shard + 1) << SHARD_ID_BITS),))
+        cursor.execute("PRAGMA user_version = %d" % LATEST_VERSION)
+        return applied
+    return _inTransaction(engine, work, begin="BEGIN IMMEDIATE")
+
+
+# rebuild the attribute values of all insured in the layout of a storage backend
+STORAGE_CONVERSIONS = {
+    "document": [
+        # one json object per insured, in the order the attributes were added, int values as numbers
+        "UPDATE insured SET document = (SELECT json_group_object(name, CASE WHEN intValue IS NOT NULL "
+        "THEN intValue ELSE value END) FROM (SELECT name, value, intValue FROM insured_data "
+        "WHERE insured_data.insuredID = insured.id ORDER BY insured_data.id))",
+        "DELETE FROM insured_data",
+    ],
+    "eav": [
+        "INSERT INTO insured_data (insuredID, name, value, intValue) "
+        "SELECT insured.id, item.key, item.value, CASE WHEN item.type = 'integer' THEN item.value END "
+        "FROM insured, json_each(insured.document) AS item WHERE insured.document IS NOT NULL "
+        "ORDER BY insured.id, item.id",
+        "UPDATE insured SET document = NULL",
+    ],
+}
+
+
+# convert the insured of one database in one transaction, unless its storage setting,
+# by default stored, is the target already
+def _convert(engine, stored, target):
+    def work(cursor):
+        cursor.execute("SELECT value FROM settings WHERE name = 'storage'")
+        row = cursor.fetchone()
+        if (row[0] if row else stored) == target:
+            return
+        for statement in STORAGE_CONVERSIONS[target]:
+            cursor.execute(statement)
+        cursor.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('storage', ?)", (target,))
+    _inTransaction(engine, work)
+
+
+def vacuum(engine, log=None, shards=()):
+    """
+    Switch the main and the shard databases to incremental auto_vacuum, rebuilding their
+    files, returns the number of databases switched; run with the application stopped
+    """
+    switched = 0
+    for vacuumEngine in list(shards) + [engine]:
+        with vacuumEngine.connect() as conn:
+            if conn.execute("PRAGMA auto_vacuum").scalar() == 2:
+                continue
+            if log:
+                log("vacuuming %s" % vacuumEngine.url.database)
+            _setIncrementalVacuum(conn)
+        switched += 1
+    return switched
+
+
+def convertStorage(engine, target, log=None, shards=()):
+    """
+    Move the attribute values of all insured to the layout of the target storage backend,
+    one transaction per shard database and one for the main database, returns False when
+    they already are
+    """
+    with engine.connect() as conn:
+        row = conn.execute("SELECT value FROM settings WHERE name = 'storage'").fetchone()
+    stored = row[0] if row else "eav"
+    if stored == target:
+        return False
+    if log:
+        log("converting insured to %s storage" % target)
+
+    # the shards keep their own setting until the main database is converted, so an
+    # interrupted conversion skips them when run again
+    for shardEngine in shards:
+        _convert(shardEngine, stored, target)
+    _convert(engine, stored, target)
+    for shardEngine in shards:
+        with shardEngine.connect() as conn:
+            conn.execute("DELETE FROM settings WHERE name = 'storage'")
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Insurance database schema migrations")
+    parser.add_argument("--db", help="database url, defaults to the application database")
+    parser.add_argument("command", nargs="?", default="upgrade", choices=["status", "upgrade", "convert", "vacuum"])
+    parser.add_argument("storage", nargs="?", choices=sorted(STORAGE_CONVERSIONS),
+                        help="storage backend to convert the insured to")
+    args = parser.parse_args(argv)
+    if args.command == "convert" and not args.storage:
+        parser.error("convert needs the storage backend, eav or document")
+
+    import property
+    if args.db:
+        property.useEngine(property.createEngine({"url": args.db}))
+    engine = property.engine
+
+    if args.command == "status":
+        print("schema version %d, latest %d" % (getVersion(engine), LATEST_VERSION))
+        return 0
+
+    applied = upgrade(engine, property.Base.metadata, log=print)
+    if args.command in ("convert", "vacuum"):
+        session = property.SessionFactory()
+        try:
+            shards = [property.shardEngine(shard) for shard in property.shardsInUse(session)]
+        finally:
+            session.close()
+    if args.command == "convert":
+        if not convertStorage(engine, args.storage, log=print, shards=shards):
+            print("insured are already stored as %s" % args.storage)
+        return 0
+    if args.command == "vacuum":
+        if not vacuum(engine, log=print, shards=shards):
+            print("databases already give back their free pages incrementally")
+        return 0
+    if not applied:
+        print("database is up to date (version %d)" % LATEST_VERSION)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
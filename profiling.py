@@ -0,0 +1,252 @@
+"""
+On-demand profiling of single requests of the Flask app.
+
+A request is captured when it carries the X-Profile header with the value of
+INSURANCE_PROFILE_TOKEN, or when it is drawn by INSURANCE_PROFILE_SAMPLE_RATE.
+A capture holds the cProfile trace of the request, every SQL statement with
+its timing and the SQLite EXPLAIN QUERY PLAN of each distinct statement, run
+after the response. Captures are json files (plus the raw .prof for pstats or
+snakeviz) in INSURANCE_PROFILE_DIR, of which the newest
+INSURANCE_PROFILE_MAX_CAPTURES are kept.
+
+/profiles lists the slowest kept captures, /profiles/<id> returns one of them.
+Statement parameters are used for the plans but never written.
+"""
+import cProfile
+import datetime
+import io
+import itertools
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from flask import Response, g, has_app_context, request
+from sqlalchemy import event
+
+
+PROFILE_DIR = os.environ.get("INSURANCE_PROFILE_DIR", "profiles")
+PROFILE_TOKEN = os.environ.get("INSURANCE_PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.environ.get("INSURANCE_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MAX_CAPTURES = int(os.environ.get("INSURANCE_PROFILE_MAX_CAPTURES", "100"))
+
+# request header asking for a capture, with the profile token as value
+PROFILE_HEADER = "X-Profile"
+
+# functions of the cProfile trace written in the capture, by cumulative time
+PROFILE_LINES = 40
+
+# routes never sampled
+EXCLUDED_PATHS = ("/metrics", "/profiles")
+
+CAPTURE_ID = re.compile(r"^[0-9T]+-[0-9]+-[0-9]+$")
+
+_counter = itertools.count(1)
+_lock = threading.Lock()
+
+# engines the query plans of their statements are explained on
+_explainEngines = weakref.WeakSet()
+
+
+def _wanted():
+    if PROFILE_TOKEN and request.headers.get(PROFILE_HEADER) == PROFILE_TOKEN:
+        return True
+    if PROFILE_SAMPLE_RATE > 0 and not request.path.startswith(EXCLUDED_PATHS):
+        return random.random() < PROFILE_SAMPLE_RATE
+    return False
+
+
+def _beforeRequest():
+    g.profileStatements = None
+    if not _wanted():
+        return
+    g.profileID = "%s-%d-%06d" % (time.strftime("%Y%m%dT%H%M%S"), os.getpid(), next(_counter))
+    g.profileStarted = datetime.datetime.utcnow()
+    g.profileStart = time.perf_counter()
+    g.profileStatements = []
+    g.profiler = cProfile.Profile()
+    try:
+        g.profiler.enable()
+    except ValueError:
+        # another profiler is active in this thread, like a concurrent capture in asgi.py
+        g.profiler = None
+
+
+def _afterRequest(response):
+    if getattr(g, "profileStatements", None) is not None:
+        response.headers["X-Profile-Capture"] = g.profileID
+        g.profileStatus = response.status_code
+    return response
+
+
+def _teardownRequest(exception=None):
+    statements = getattr(g, "profileStatements", None)
+    if statements is None:
+        return
+    g.profileStatements = None
+    if g.profiler is not None:
+        g.profiler.disable()
+    seconds = time.perf_counter() - g.profileStart
+
+    capture = OrderedDict([
+        ("id", g.profileID),
+        ("method", request.method),
+        ("path", request.full_path.rstrip("?")),
+        ("route", request.url_rule.rule if request.url_rule is not None else None),
+        ("status", getattr(g, "profileStatus", 500)),
+        ("started", g.profileStarted.isoformat()),
+        ("seconds", seconds),
+        ("statements", len(statements)),
+        ("sqlSeconds", sum(elapsed for statement, parameters, elapsed, many, engine in statements)),
+        ("sql", _explain(statements)),
+        ("profile", None),
+    ])
+    if g.profiler is not None:
+        stream = io.StringIO()
+        pstats.Stats(g.profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        capture["profile"] = stream.getvalue()
+    _write(capture, g.profiler)
+
+
+# the statements with their query plan, computed once per distinct statement of each database
+def _explain(statements):
+    plans = {}
+    sql = []
+    for statement, parameters, elapsed, many, engine in statements:
+        if (engine, statement) not in plans:
+            plans[engine, statement] = _plan(engine, statement, parameters[0] if many and parameters else parameters)
+        sql.append(OrderedDict([("statement", statement), ("seconds", elapsed), ("executemany", many), \
+                                ("plan", plans[engine, statement])]))
+    return sql
+
+
+# explained on the engine that ran the statement, a shard's statements on the shard database
+def _plan(engine, statement, parameters):
+    if engine not in _explainEngines or engine.dialect.name != "sqlite" or \
+            not statement.lstrip().upper().startswith(("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")):
+        return None
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters or ())
+        return [row[-1] for row in cursor.fetchall()]
+    except Exception as e:
+        return ["not explained: %s" % e]
+    finally:
+        raw.close()
+
+
+def _write(capture, profiler):
+    with _lock:
+        if not os.path.isdir(PROFILE_DIR):
+            os.makedirs(PROFILE_DIR)
+        path = os.path.join(PROFILE_DIR, capture["id"])
+        with open(path + ".json.tmp", "w") as f:
+            json.dump(capture, f, indent=1)
+        os.rename(path + ".json.tmp", path + ".json")
+        if profiler is not None:
+            profiler.dump_stats(path + ".prof")
+
+        # keep the newest captures, ids start with their time
+        captureIDs = _captureIDs()
+        for captureID in captureIDs[:max(len(captureIDs) - PROFILE_MAX_CAPTURES, 0)]:
+            for extension in (".json", ".prof"):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, captureID + extension))
+                except OSError:
+                    pass
+
+
+def _captureIDs():
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    return sorted(name[:-len(".json")] for name in os.listdir(PROFILE_DIR) if name.endswith(".json"))
+
+
+def _beforeCursorExecute(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and getattr(g, "profileStatements", None) is not None:
+        conn.info.setdefault("profileStart", []).append(time.perf_counter())
+
+
+def _afterCursorExecute(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and getattr(g, "profileStatements", None) is not None and conn.info.get("profileStart"):
+        g.profileStatements.append((statement, parameters, time.perf_counter() - conn.info["profileStart"].pop(),
+                                    executemany, conn.engine))
+
+
+def _handleError(context):
+    if context.connection is not None and context.connection.info.get("profileStart"):
+        context.connection.info["profileStart"].pop()
+
+
+def getProfiles():
+    """
+    Summary of the slowest kept captures, ?limit=20
+    """
+    try:
+        limit = int(request.args.get("limit", 20))
+    except ValueError:
+        return json.dumps({"status":"error", "message":"Invalid request"}), 400
+
+    captures = []
+    for captureID in _captureIDs():
+        try:
+            with open(os.path.join(PROFILE_DIR, captureID + ".json")) as f:
+                capture = json.load(f, object_pairs_hook=OrderedDict)
+        except (IOError, OSError, ValueError):
+            # removed or written by another worker meanwhile
+            continue
+        for name in ("sql", "profile"):
+            capture.pop(name, None)
+        captures.append(capture)
+    captures.sort(key=lambda capture: capture["seconds"], reverse=True)
+
+    return json.dumps(OrderedDict([("status", "success"), ("profiles", captures[:max(limit, 0)])])), 200
+
+
+def getProfile(captureID):
+    """
+    One capture, as json or with ?format=pstats as the raw cProfile file
+    """
+    pstatsFormat = request.args.get("format") == "pstats"
+    path = os.path.join(PROFILE_DIR, captureID + (".prof" if pstatsFormat else ".json"))
+    if not CAPTURE_ID.match(captureID) or not os.path.exists(path):
+        return json.dumps({"status":"error", "message":"Profile not found"}), 404
+
+    with open(path, "rb") as f:
+        data = f.read()
+    if pstatsFormat:
+        response = Response(data, status=200, mimetype="application/octet-stream")
+        response.headers["Content-Disposition"] = "attachment; filename=%s.prof" % captureID
+        return response
+    return Response(data, status=200, mimetype="application/json")
+
+
+def instrument(app, engine):
+    """
+    Capture the chosen requests of app and the SQL statements of engine, served at /profiles
+    """
+    app.before_request(_beforeRequest)
+    app.after_request(_afterRequest)
+    app.teardown_request(_teardownRequest)
+    instrumentEngine(engine, explain=True)
+
+    app.add_url_rule("/profiles", "profiles", getProfiles, methods=["GET"])
+    app.add_url_rule("/profiles/<captureID>", "profile", getProfile, methods=["GET"])
+
+
+def instrumentEngine(engine, explain=False):
+    """
+    Record the SQL statements of a (sync) engine in the captures, and explain
+    their query plans on it when explain is set
+    """
+    if explain:
+        _explainEngines.add(engine)
+    event.listen(engine, "before_cursor_execute", _beforeCursorExecute)
+    event.listen(engine, "after_cursor_execute", _afterCursorExecute)
+    event.listen(engine, "handle_error", _handleError)
@@ -1,15 +1,40 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event
+from sqlalchemy.orm import Session as BaseSession, aliased, scoped_session, sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.util import LRUCache
+from sqlalchemy.sql.util import find_tables
 from sqlalchemy import exc
+import calendar
+import csv
+import datetime
+import io
 import json
+import mmap
+import multiprocessing
+import os
+import queue
+import random
+import struct
+import threading
+import time
+import zlib
 from sqlalchemy import and_
+from sqlalchemy import bindparam, func, inspect, literal_column, select, text, type_coerce
 from sqlalchemy import or_
 
 from flask import Flask
 from flask import request
-from collections import OrderedDict
+from flask import Response
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future
+
+import metrics
+import migrations
+import profiling
 
 
 app = Flask(__name__)
@@ -24,6 +49,9 @@ class Insurance(Base):
     __tablename__ = 'insurance'
     id = Column(Integer, primary_key=True)
     type = Column(String(256), nullable=False) #type of insurance/risk
+    shard = Column(Integer)     #shard database of its insured, NULL for the main database
+
+    __table_args__ = (Index('ix_insurance_type', 'type', unique=True),)
 
 class InsuranceAttribute(Base):
     __tablename__ = 'iattributes'
@@ -32,11 +60,20 @@ class InsuranceAttribute(Base):
     name = Column(String(256), nullable=False)     #name of the attribute/field
     dataType = Column(String(256), nullable=False)
     mandatory = Column(String(3), nullable=False)
+    enumValues = Column(String(4096))   #allowed values of an enum attribute, json list
+
+    __table_args__ = (Index('ix_iattributes_insurance_name', 'insuranceID', 'name', unique=True),)
 
 class Insured(Base):
     __tablename__ = 'insured'
     id = Column(Integer, primary_key=True)
     insuranceID = Column(Integer, ForeignKey('insurance.id'))
+    document = Column(Text)     #attribute values as one json object, with the document storage
+    deleted = Column(DateTime)  #time of a soft delete, the row is removed later by the purger
+
+    # the live insured of a type are looked up by (insuranceID, deleted IS NULL)
+    __table_args__ = (Index('ix_insured_insuranceID', 'insuranceID', 'deleted'),
+                      Index('ix_insured_deleted', 'deleted', sqlite_where=text('deleted IS NOT NULL')),)
 
 class insuredData(Base):
     __tablename__ = 'insured_data'
@@ -44,15 +81,1453 @@ class insuredData(Base):
     insuredID = Column(Integer, ForeignKey('insured.id'))
     name = Column(String(256))     #name of the attribute/field
     value = Column(String(4096))   #attribute/field value, opaque
+    intValue = Column(Integer)     #typed copy of the value of an int attribute, for range queries
+
+    # also serves the lookups by insuredID alone
+    __table_args__ = (Index('ix_insured_data_insured_name', 'insuredID', 'name', unique=True),
+                      Index('ix_insured_data_name_int', 'name', 'intValue'),
+                      Index('ix_insured_data_name_value', 'name', 'value'),)
+
+# background job for schema changes on large insurance types
+class Job(Base):
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(64), nullable=False)           #deleteAttribute, deleteType
+    insuranceType = Column(String(256), nullable=False)
+    params = Column(String(4096))                       #job parameters, json
+    status = Column(String(16), nullable=False)         #queued, running, done, failed
+    processed = Column(Integer, nullable=False, default=0)
+    total = Column(Integer)
+    message = Column(String(4096))
+    created = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+# progress of an offline load of insured records (load.py), by input file and insurance type
+class LoadCheckpoint(Base):
+    __tablename__ = 'load_checkpoints'
+    id = Column(Integer, primary_key=True)
+    source = Column(String(4096), nullable=False)       #absolute path of the input file
+    insuranceType = Column(String(256), nullable=False)
+    records = Column(Integer, nullable=False, default=0)   #input records done, loaded or rejected
+    loaded = Column(Integer, nullable=False, default=0)
+    rejected = Column(Integer, nullable=False, default=0)
+    updated = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (Index('ix_load_checkpoints_source_type', 'source', 'insuranceType', unique=True),)
+
+# append-only log of the changes of insurance types and insured, the id is the sequence read by the change feed
+class Change(Base):
+    __tablename__ = 'changes'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(32), nullable=False)           #typeCreated, attributeAdded, insuredAdded, ... see CHANGE_KINDS
+    insuranceType = Column(String(256), nullable=False)
+    insuredID = Column(Integer)
+    data = Column(Text)                                 #json: attribute values written, attribute added or deleted
+    created = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    # sequences are never reused, even after the latest change is deleted
+    __table_args__ = (Index('ix_changes_type', 'insuranceType', 'id'), {'sqlite_autoincrement': True})
+
+# summary counters of the attribute values of an insurance type, kept up to date by the write
+# handlers when STATS_COUNTERS is set, the row without a name counts the insured of the type
+class AttributeStats(Base):
+    __tablename__ = 'attribute_stats'
+    id = Column(Integer, primary_key=True)
+    insuranceID = Column(Integer, ForeignKey('insurance.id'), nullable=False)
+    name = Column(String(256))
+    count = Column(Integer, nullable=False, default=0)  #insured having the attribute
+    total = Column(Integer, nullable=False, default=0)  #sum of the values of an int attribute
+
+    __table_args__ = (Index('ix_attribute_stats_insurance_name', 'insuranceID', 'name', unique=True),)
+
+# settings kept with the data, like the storage backend of the insured attribute values
+class Setting(Base):
+    __tablename__ = 'settings'
+    name = Column(String(64), primary_key=True)
+    value = Column(String(4096))
 
 DataTypes = {"int": 1,
              "enum" : 2,
              "string":3,
 }
 
- # Create the engine that create in Memory DB
+# database settings, overridden by INSURANCE_* environment variables
+DB_CONFIG = {
+    "url": os.environ.get("INSURANCE_DB_URL", "sqlite:///propertyInsurance.db"),
+    "pool_size": int(os.environ.get("INSURANCE_DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.environ.get("INSURANCE_DB_MAX_OVERFLOW", "10")),
+    "pool_timeout": int(os.environ.get("INSURANCE_DB_POOL_TIMEOUT", "30")),
+    "pool_recycle": int(os.environ.get("INSURANCE_DB_POOL_RECYCLE", "3600")),
+}
+
+# SQLite pragmas applied on every new connection
+SQLITE_PRAGMAS = OrderedDict([
+    ("journal_mode", os.environ.get("INSURANCE_SQLITE_JOURNAL_MODE", "WAL")),
+    ("synchronous", os.environ.get("INSURANCE_SQLITE_SYNCHRONOUS", "NORMAL")),
+    ("cache_size", os.environ.get("INSURANCE_SQLITE_CACHE_SIZE", "-64000")),   # negative value is in KiB
+    ("mmap_size", os.environ.get("INSURANCE_SQLITE_MMAP_SIZE", "268435456")),
+    ("busy_timeout", os.environ.get("INSURANCE_SQLITE_BUSY_TIMEOUT", "5000")),  # milliseconds
+])
+
+# the statements of the hot paths are built once (below), their SQL is compiled once per
+# engine and kept in its compiled cache, INSURANCE_QUERY_CACHE=0 compiles every statement run
+QUERY_CACHE = os.environ.get("INSURANCE_QUERY_CACHE", "1").lower() in ("1", "true", "yes")
+QUERY_CACHE_SIZE = int(os.environ.get("INSURANCE_QUERY_CACHE_SIZE", "500"))
+
+
+def createEngine(config=None, pragmas=None):
+    """
+    Create a pooled engine, sqlite connections get the configured pragmas
+    """
+    config = dict(DB_CONFIG, **(config or {}))
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+    url = config.pop("url")
+
+    if not url.startswith("sqlite"):
+        newEngine = create_engine(url, **config)
+    else:
+        # a file database shares its connections across threads through the pool
+        newEngine = create_engine(url, poolclass=QueuePool, connect_args={"check_same_thread": False}, **config)
+        setSqlitePragmas(newEngine, pragmas)
+    setQueryCache(newEngine)
+    return newEngine
+
+
+def setQueryCache(queryEngine, enabled=None):
+    """
+    Give a (sync) engine a compiled cache of QUERY_CACHE_SIZE statements, or none at all
+    """
+    enabled = QUERY_CACHE if enabled is None else enabled
+    queryEngine.update_execution_options(compiled_cache=LRUCache(QUERY_CACHE_SIZE) if enabled else None)
+
+
+def setSqlitePragmas(engine, pragmas=None):
+    """
+    Apply the sqlite pragmas on every new connection of a (sync) engine
+    """
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+
+    @event.listens_for(engine, "connect")
+    def applyPragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if value:
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+
+# Create the engine shared by all requests
+engine = createEngine()
+
+# sessions are scoped to the request being served and removed on teardown: the
+# thread in the threaded server, the greenlet of the request in asgi.py
+try:
+    from greenlet import getcurrent as _sessionScope
+except ImportError:
+    from threading import get_ident as _sessionScope
+
+
+# number of shard databases the insured of new insurance types are spread over by a hash of
+# the type, 0 keeps them in the main database; the catalog, jobs and change log stay there
+SHARDS = int(os.environ.get("INSURANCE_SHARDS", "0"))
+
+# url template of the shard databases, {shard} is the number of the shard
+SHARD_URL = os.environ.get("INSURANCE_SHARD_URL", "")
+
+# tables of the insured, kept in the shard database of their insurance type with the
+# changes of its insured and its summary counters, so an insured write touches one database
+SHARDED_TABLES = frozenset([Insured.__table__, insuredData.__table__, Change.__table__, AttributeStats.__table__])
+
+
+def shardOf(insuranceType, shards=None):
+    """
+    Shard of the insured of a new insurance type, None for the main database
+    """
+    shards = SHARDS if shards is None else shards
+    return zlib.crc32(insuranceType.encode("utf-8")) % shards if shards else None
+
+
+# url of a shard database, by default <main database>-shard<n>.db
+def shardURL(shard):
+    if SHARD_URL:
+        return SHARD_URL.format(shard=shard)
+    base, extension = os.path.splitext(engine.url.database)
+    return "sqlite:///%s-shard%d%s" % (base, shard, extension or ".db")
+
+
+# engines of the shard databases of this process, opened on first use
+shardEngines = {}
+_shardLock = threading.Lock()
+
+def shardEngine(shard):
+    """
+    Engine of a shard database, created with its insured tables when it does not exist
+    """
+    newEngine = shardEngines.get(shard)
+    if newEngine is None:
+        with _shardLock:
+            newEngine = shardEngines.get(shard)
+            if newEngine is None:
+                newEngine = createEngine({"url": shardURL(shard)})
+                migrations.createShard(newEngine, Base.metadata, shard)
+                metrics.instrumentEngine(newEngine)
+                profiling.instrumentEngine(newEngine, explain=True)
+                shardEngines[shard] = newEngine
+    return newEngine
+
+
+def _onShard(mapper, clause):
+    if mapper is not None:
+        return inspect(mapper).local_table in SHARDED_TABLES
+    # insert, update and delete statements name their table
+    table = getattr(clause, "table", None)
+    if table is not None:
+        return table in SHARDED_TABLES
+    return clause is not None and any(table in SHARDED_TABLES for table in find_tables(clause, include_crud=True))
+
+
+class RoutingSession(BaseSession):
+    """
+    Session sending the statements on the insured tables to the shard database of the
+    insurance type it is routed to (_route), everything else to the main database
+    """
+    def get_bind(self, mapper=None, clause=None, **kw):
+        shard = self.info.get("shard")
+        # a statement given its bind, like the changes of types, runs there
+        if kw.get("bind") is not None:
+            return kw["bind"]
+        if shard is not None and _onShard(mapper, clause):
+            return self.info.get("shardEngine", shardEngine)(shard)
+        return BaseSession.get_bind(self, mapper, clause=clause, **kw)
+
+
+# send the statements of session on the insured tables to the database of an insurance type
+def _route(session, insurance):
+    session.info["shard"] = insurance.shard
+
+
+SessionFactory = sessionmaker(bind=engine, class_=RoutingSession)
+Session = scoped_session(SessionFactory, scopefunc=_sessionScope)
+
+
+def shardsInUse(session):
+    """
+    Shard databases configured or holding the insured of an insurance type
+    """
+    shards = set(range(SHARDS))
+    shards.update(shard for shard, in session.query(Insurance.shard).filter(Insurance.shard.isnot(None)).distinct())
+    return sorted(shards)
+
+
+def useEngine(newEngine):
+    """
+    Serve the requests from now on with newEngine, like a worker process after fork
+    """
+    global engine
+    engine = newEngine
+    SessionFactory.configure(bind=newEngine)
+    metrics.instrumentEngine(newEngine)
+    profiling.instrumentEngine(newEngine, explain=True)
+    # shard engines are opened again for newEngine, and by a worker process for itself
+    shardEngines.clear()
+
+
+@app.teardown_appcontext
+def removeSession(exception=None):
+    Session.remove()
+
+
+
+# cached schema of an insurance type
+RiskAttribute = namedtuple("RiskAttribute", ["name", "dataType", "mandatory", "values"])
+RiskSchema = namedtuple("RiskSchema", ["id", "type", "attributes", "mandatory", "validator", "shard"])
+
+
+# range of the int values, the signed 64 bit integers of SQLite
+INT_MIN, INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+def _coerceInt(value):
+    # true and false are not numbers, a float only when it has no fraction
+    if isinstance(value, bool):
+        raise TypeError(value)
+    try:
+        number = int(value)
+    except OverflowError:
+        raise ValueError(value)
+    if isinstance(value, float) and number != value:
+        raise ValueError(value)
+    value = number
+    if not INT_MIN <= value <= INT_MAX:
+        raise ValueError(value)
+    return value
+
+
+# string and enum values, numbers are kept as their text like insured_data.value stores them
+def _coerceString(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    if not isinstance(value, str):
+        raise TypeError(value)
+    return value
+
+
+# converter of an attribute value to its data type, raises ValueError/TypeError for an invalid value
+def _compileCoercer(attribute):
+    if attribute.dataType == "int":
+        return _coerceInt
+    if attribute.dataType == "enum" and attribute.values is not None:
+        allowed = frozenset(attribute.values)
+        def coerceEnum(value):
+            value = _coerceString(value)
+            if value not in allowed:
+                raise ValueError(value)
+            return value
+        return coerceEnum
+    if attribute.dataType in ("enum", "string"):
+        return _coerceString
+    def unknown(value):
+        raise ValueError(attribute.dataType)
+    return unknown
+
+
+class RiskValidator(object):
+    """
+    Attribute checks of an insurance type, compiled once per schema version
+    """
+    def __init__(self, attributes):
+        self.mandatory = frozenset(attr.name for attr in attributes.values() if attr.mandatory.upper() == "YES")
+        self.coercers = dict((name, _compileCoercer(attr)) for name, attr in attributes.items())
+
+    def coerce(self, name, value):
+        """
+        Value of an attribute converted to its data type,
+        raises KeyError for an unknown attribute and ValueError/TypeError for an invalid value
+        """
+        return self.coercers[name](value)
+
+    def validate(self, attributes):
+        """
+        Validate the attributes of an insured record,
+        returns ({attributeName: value}, None, None) or (None, error message, status code)
+        """
+        if not isinstance(attributes, list):
+            return None, "Invalid request", 400
+
+        values = OrderedDict()
+        for attr in attributes:
+            if not isinstance(attr, dict) or "attributeName" not in attr or "attributeValue" not in attr:
+                return None, "Invalid request", 400
+
+            name = attr["attributeName"]
+            if not isinstance(name, str):
+                return None, "Invalid request", 400
+            coercer = self.coercers.get(name)
+            if coercer is None:
+                return None, str(name) + " attribute not exist for Inurance type", 404
+            try:
+                values[name] = coercer(attr["attributeValue"])
+            except (TypeError, ValueError):
+                return None, "Invalid request", 400
+
+        # check for all mandatory attributes exists in the attributes
+        if not self.mandatory.issubset(values):
+            return None, "Invalid request", 400
+
+        return values, None, None
+
+class VersionTable(object):
+    """
+    Change counters of cached data keyed like ("type", "health"), with the time of the last change
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # tags from another process or an earlier run never match
+        self.epoch = "%08x" % random.getrandbits(32)
+        self._started = time.time()
+        self._versions = {}
+
+    def get(self, key):
+        """
+        (version, time of the last change) of the data behind key
+        """
+        with self._lock:
+            return self._versions.get(key, (0, self._started))
+
+    def bump(self, key):
+        """
+        Record a change of the data behind key
+        """
+        with self._lock:
+            version = self._versions.get(key, (0, self._started))[0]
+            self._versions[key] = (version + 1, time.time())
+
+
+class SharedVersionTable(VersionTable):
+    """
+    Change counters in memory shared with the processes forked after it was created,
+    keys share a fixed number of stripes so a change may also refresh a few other keys
+    """
+    SLOT = struct.Struct("<Qd")
+
+    def __init__(self, stripes):
+        VersionTable.__init__(self)
+        self._lock = multiprocessing.Lock()
+        self._stripes = stripes
+        self._memory = mmap.mmap(-1, stripes * self.SLOT.size)
+
+    def _offset(self, key):
+        return (zlib.crc32(repr(key).encode("utf-8")) % self._stripes) * self.SLOT.size
+
+    def get(self, key):
+        version, modified = self.SLOT.unpack_from(self._memory, self._offset(key))
+        return version, modified or self._started
+
+    def bump(self, key):
+        offset = self._offset(key)
+        with self._lock:
+            version = self.SLOT.unpack_from(self._memory, offset)[0]
+            self.SLOT.pack_into(self._memory, offset, version + 1, time.time())
+
+
+class SchemaCache(object):
+    """
+    In-process cache of insurance types and their attributes, keyed by insurance type
+    """
+    def __init__(self, versions):
+        self._lock = threading.Lock()
+        self._schemas = {}
+        self.versions = versions
+        self.hits = 0
+        self.misses = 0
+
+    # a cached schema is current while neither its type nor all types were invalidated
+    def _version(self, insuranceType):
+        return self.versions.get(("schema",))[0], self.versions.get(("schema", insuranceType))[0]
+
+    def get(self, session, insuranceType):
+        """
+        Get the schema of an insurance type, raises NoResultFound like Query.one(),
+        and route session to the database of its insured
+        """
+        version = self._version(insuranceType)
+        with self._lock:
+            cached = self._schemas.get(insuranceType)
+            if cached is not None and cached[0] == version:
+                self.hits += 1
+                _route(session, cached[1])
+                return cached[1]
+            self.misses += 1
+
+        insurance = _one(session.execute(SELECT_INSURANCE, {"insuranceType": insuranceType}))
+        insurance_attr_data = session.execute(SELECT_ATTRIBUTES, {"insuranceID": insurance.id}).fetchall()
+
+        attributes = OrderedDict()
+        for insurance_attr in insurance_attr_data:
+            values = tuple(json.loads(insurance_attr.enumValues)) if insurance_attr.enumValues else None
+            attributes[insurance_attr.name] = RiskAttribute(insurance_attr.name, \
+                        insurance_attr.dataType, insurance_attr.mandatory, values)
+        validator = RiskValidator(attributes)
+        schema = RiskSchema(insurance.id, insurance.type, attributes, validator.mandatory, validator, insurance.shard)
+        _route(session, schema)
+
+        # a schema loaded while it was being invalidated is stored with the older version
+        with self._lock:
+            self._schemas[insuranceType] = (version, schema)
+        return schema
+
+    def invalidate(self, insuranceType=None):
+        """
+        Drop the cached schema of an insurance type, or of all types
+        """
+        self.versions.bump(("schema",) if insuranceType is None else ("schema", insuranceType))
+        with self._lock:
+            if insuranceType is None:
+                self._schemas.clear()
+            else:
+                self._schemas.pop(insuranceType, None)
+
+    def stats(self):
+        with self._lock:
+            return OrderedDict([("hits", self.hits), ("misses", self.misses), ("size", len(self._schemas))])
+
+
+# version counters of the cached schemas and responses
+versions = VersionTable()
+
+schemaCache = SchemaCache(versions)
+
+# number of serialized responses kept for the read endpoints, 0 disables the cache
+RESPONSE_CACHE_SIZE = int(os.environ.get("INSURANCE_RESPONSE_CACHE_SIZE", "1024"))
+
+class ResponseCache(object):
+    """
+    Version counters of the read endpoints for ETag/Last-Modified,
+    with a bounded LRU cache of their serialized responses
+    """
+    def __init__(self, size, versions):
+        self._lock = threading.Lock()
+        self._responses = OrderedDict()
+        self.versions = versions
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.notModified = 0
+
+    def bump(self, key):
+        """
+        Record a change of the data behind key, like ("type", "health")
+        """
+        self.versions.bump(key)
+
+    def _validator(self, keys):
+        versions = [self.versions.get(key) for key in keys]
+        etag = "%s-%s" % (self.versions.epoch, "-".join(str(version) for version, _ in versions))
+        return etag, max(modified for _, modified in versions)
+
+    def serve(self, keys, produce, cacheKey=None):
+        """
+        Response of produce() for the current request, which depends on the data behind keys,
+        304 when the client copy is current and from the cache when possible
+        """
+        etag, lastModified = self._validator(keys)
+
+        # conditional GET is answered without touching the database
+        if request.if_none_match:
+            fresh = etag in request.if_none_match
+        else:
+            fresh = request.if_modified_since is not None and \
+                    lastModified < calendar.timegm(request.if_modified_since.utctimetuple()) + 1
+        if fresh:
+            with self._lock:
+                self.notModified += 1
+            response = Response(status=304)
+        else:
+            cacheKey = cacheKey or tuple(keys)
+            with self._lock:
+                cached = self._responses.get(cacheKey)
+                if cached is not None and cached[0] == etag:
+                    self._responses.move_to_end(cacheKey)
+                    self.hits += 1
+                else:
+                    cached = None
+                    self.misses += 1
+
+            if cached is not None:
+                response = Response(cached[1], status=200, mimetype=cached[2])
+            else:
+                response = app.make_response(produce())
+                if response.status_code != 200:
+                    return response
+                if self.size > 0:
+                    with self._lock:
+                        self._responses[cacheKey] = (etag, response.get_data(), response.mimetype)
+                        self._responses.move_to_end(cacheKey)
+                        while len(self._responses) > self.size:
+                            self._responses.popitem(last=False)
+
+        response.set_etag(etag)
+        response.last_modified = datetime.datetime.utcfromtimestamp(int(lastModified))
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    def stats(self):
+        with self._lock:
+            return OrderedDict([("hits", self.hits), ("misses", self.misses), \
+                    ("notModified", self.notModified), ("size", len(self._responses))])
+
+responseCache = ResponseCache(RESPONSE_CACHE_SIZE, versions)
+
+
+# number of shared version counters of the caches in a multi-process server
+SHARED_VERSION_STRIPES = int(os.environ.get("INSURANCE_SHARED_VERSION_STRIPES", "65536"))
+
+def shareCaches(stripes=None):
+    """
+    Keep the version counters of the caches in shared memory, so the worker
+    processes forked after this call see each other's changes
+    """
+    table = SharedVersionTable(stripes or SHARED_VERSION_STRIPES)
+    schemaCache.invalidate()
+    schemaCache.versions = table
+    responseCache.versions = table
+    return table
+
+
+# invalidate the caches after a change of an insurance type or its attributes
+def _schemaChanged(insuranceType, typeList=False):
+    schemaCache.invalidate(insuranceType)
+    responseCache.bump(("type", insuranceType))
+    if typeList:
+        responseCache.bump(("types",))
+
+
+# insured share a bounded number of version counters, a change may also refresh a few others
+INSURED_VERSION_STRIPES = 65536
+
+# insured id of a url as a number, so /get/01 and /get/1 share their cache entry and version
+def _insuredNumber(insuredID):
+    try:
+        return int(insuredID)
+    except (TypeError, ValueError):
+        return insuredID
+
+def _insuredKey(insuranceType, insuredID):
+    insuredID = _insuredNumber(insuredID)
+    return ("insured", insuranceType, zlib.crc32(str(insuredID).encode("utf-8")) % INSURED_VERSION_STRIPES)
+
+
+# invalidate the cached responses of an insured after a change
+def _insuredChanged(insuranceType, insuredID):
+    responseCache.bump(_insuredKey(insuranceType, insuredID))
+
+
+CHANGE_KINDS = ("typeCreated", "typeDeleted", "attributeAdded", "attributeDeleted",
+                "insuredAdded", "insuredUpdated", "insuredDeleted")
+
+# append changes to the change log in the transaction of session,
+# changes are (kind, insuranceType, insuredID or None, data or None)
+def _logChanges(session, changes):
+    created = datetime.datetime.utcnow()
+    rows = [{"kind": kind, "insuranceType": insuranceType, "insuredID": insuredID,
+             "data": json.dumps(data) if data is not None else None, "created": created}
+            for kind, insuranceType, insuredID, data in changes]
+    # the changes of insured are logged in their database, the ones of types in the main database
+    insured = [row for row in rows if row["insuredID"] is not None]
+    types = [row for row in rows if row["insuredID"] is None]
+    if insured:
+        session.execute(Change.__table__.insert(), insured)
+    if types:
+        session.execute(Change.__table__.insert(), types, bind=session.bind)
+
+
+
+# request and SQL metrics, served at /metrics
+metrics.instrument(app, engine)
+
+# profiles of the requests asked for or sampled, served at /profiles
+profiling.instrument(app, engine)
+metrics.registry.collectors.append(lambda: [
+    ("insurance_schema_cache_hits_total", "counter", "Schema cache hits", (), schemaCache.hits),
+    ("insurance_schema_cache_misses_total", "counter", "Schema cache misses", (), schemaCache.misses),
+    ("insurance_response_cache_hits_total", "counter", "Response cache hits", (), responseCache.hits),
+    ("insurance_response_cache_misses_total", "counter", "Response cache misses", (), responseCache.misses),
+    ("insurance_response_not_modified_total", "counter", "Conditional GETs answered with 304", (), responseCache.notModified),
+])
+
+
+
+def useQueryCache(enabled):
+    """
+    Run the statements from the compiled cache of the engines, or compile them on every call
+    """
+    global QUERY_CACHE
+    QUERY_CACHE = enabled
+    for queryEngine in [engine] + list(shardEngines.values()):
+        setQueryCache(queryEngine, enabled)
+
+
+# a single row of a result, raises NoResultFound like Query.one()
+def _one(result):
+    row = result.first()
+    if row is None:
+        raise NoResultFound("No row was found for one()")
+    return row
+
+
+# (id, insuranceID, document) of a live insured as a plain row, raises NoResultFound like Query.one()
+def _insuredRow(session, insuredID):
+    return _one(session.execute(SELECT_INSURED, {"insuredID": insuredID}, mapper=Insured))
+
+
+# statements of the hot path reads, built once and run with their parameters
+_insured = Insured.__table__
+_insuredData = insuredData.__table__
+_attribute = InsuranceAttribute.__table__
+_liveInsured = and_(_insured.c.insuranceID == bindparam("insuranceID"), _insured.c.deleted.is_(None))
+# insured among insuredIDs, or with an id between first and last
+_insuredIn = _insured.c.id.in_(bindparam("insuredIDs", expanding=True))
+_insuredBetween = _insured.c.id.between(bindparam("first"), bindparam("last"))
+
+SELECT_INSURANCE = select([Insurance.__table__.c.id, Insurance.__table__.c.type, Insurance.__table__.c.shard]) \
+                        .where(Insurance.__table__.c.type == bindparam("insuranceType"))
+SELECT_ATTRIBUTES = select([_attribute.c.name, _attribute.c.dataType, _attribute.c.mandatory, \
+                        _attribute.c.enumValues]).where(_attribute.c.insuranceID == bindparam("insuranceID")) \
+                        .order_by(_attribute.c.id)
+SELECT_INSURED = select([_insured.c.id, _insured.c.insuranceID, _insured.c.document]) \
+                        .where(and_(_insured.c.id == bindparam("insuredID"), _insured.c.deleted.is_(None)))
+SELECT_TYPE_IN_USE = select([_insured.c.id]).where(_liveInsured).limit(1)
+
+# a keyset page of the insured ids of a type, after an id and of a limited size or not
+def _insuredIDPageStatement(after, limit):
+    statement = select([_insured.c.id]).where(_liveInsured)
+    if after:
+        statement = statement.where(_insured.c.id > bindparam("after"))
+    statement = statement.order_by(_insured.c.id)
+    return statement.limit(bindparam("limit")) if limit else statement
+
+SELECT_INSURED_IDS = dict(((after, limit), _insuredIDPageStatement(after, limit)) \
+                        for after in (False, True) for limit in (False, True))
+
+# values of the EAV storage, by insured among ids or in a range
+SELECT_VALUES_MANY = dict((among, select([_insured.c.id, _insuredData.c.name, _insuredData.c.value, \
+                        _insuredData.c.intValue]).select_from(_insured.outerjoin(_insuredData, \
+                        _insuredData.c.insuredID == _insured.c.id)).where(and_(_liveInsured, where)) \
+                        .order_by(_insured.c.id, _insuredData.c.id)) \
+                        for among, where in ((True, _insuredIn), (False, _insuredBetween)))
+SELECT_VALUES = select([_insuredData.c.name, _insuredData.c.value, _insuredData.c.intValue]) \
+                        .where(_insuredData.c.insuredID == bindparam("insuredID")).order_by(_insuredData.c.id)
+SELECT_VALUE_IDS = select([_insuredData.c.name, _insuredData.c.id]) \
+                        .where(and_(_insuredData.c.insuredID == bindparam("insuredID"), \
+                                    _insuredData.c.name.in_(bindparam("names", expanding=True))))
+# documents of the document storage, by insured among ids or in a range
+SELECT_DOCUMENTS = dict((among, select([_insured.c.id, _insured.c.document]).where(and_(_liveInsured, where)) \
+                        .order_by(_insured.c.id)) for among, where in ((True, _insuredIn), (False, _insuredBetween)))
+SELECT_DOCUMENT = select([_insured.c.document]).where(_insured.c.id == bindparam("insuredID"))
+
+
+# statements of the insured writes, built once and run with their parameters
+INSERT_INSURED = Insured.__table__.insert()
+INSERT_INSURED_DATA = insuredData.__table__.insert()
+UPDATE_INSURED_DATA = insuredData.__table__.update() \
+                        .where(insuredData.__table__.c.id == bindparam("dataID")) \
+                        .values(value=bindparam("newValue"), intValue=bindparam("newIntValue"))
+UPDATE_DOCUMENT = Insured.__table__.update().where(Insured.__table__.c.id == bindparam("insuredID")) \
+                        .values(document=func.json_patch(func.coalesce(Insured.__table__.c.document, "{}"), \
+                                                         bindparam("patch")))
+DELETE_INSURED = Insured.__table__.delete().where(Insured.__table__.c.id == bindparam("insuredID"))
+MARK_DELETED = Insured.__table__.update().where(and_(Insured.__table__.c.id == bindparam("insuredID"), \
+                                                    Insured.__table__.c.deleted.is_(None))) \
+                        .values(deleted=bindparam("deletedAt"))
+DELETE_INSURED_DATA = insuredData.__table__.delete().where(insuredData.__table__.c.insuredID == bindparam("insuredID"))
+UPDATE_STATS = AttributeStats.__table__.update() \
+                        .where(and_(AttributeStats.__table__.c.insuranceID == bindparam("statInsuranceID"), \
+                                    AttributeStats.__table__.c.name == bindparam("statName"))) \
+                        .values(count=AttributeStats.__table__.c.count + bindparam("countDelta"), \
+                                total=AttributeStats.__table__.c.total + bindparam("totalDelta"))
+UPDATE_TYPE_STATS = AttributeStats.__table__.update() \
+                        .where(and_(AttributeStats.__table__.c.insuranceID == bindparam("statInsuranceID"), \
+                                    AttributeStats.__table__.c.name.is_(None))) \
+                        .values(count=AttributeStats.__table__.c.count + bindparam("countDelta"))
+
+
+# ids of count new insured, reserved from the id range of the database of their type (settings
+# nextInsuredID): ids are never given twice, so they stay unique across the databases a type can
+# move to and the change log never refers to two insured by one id
+def _reserveInsuredIDs(session, count):
+    session.execute("UPDATE settings SET value = CAST(value AS INTEGER) + :count WHERE name = 'nextInsuredID'", \
+                    {"count": count}, mapper=Insured)
+    last = int(session.execute("SELECT value FROM settings WHERE name = 'nextInsuredID'", mapper=Insured).scalar())
+    return list(range(last - count, last))
+
+
+# insert insured rows with reserved ids in one executemany, returns their ids
+def _insertInsured(session, insurance, rows):
+    if not rows:
+        return []
+    insuredIDs = _reserveInsuredIDs(session, len(rows))
+    session.execute(INSERT_INSURED, [dict(row, id=insuredID) for insuredID, row in zip(insuredIDs, rows)])
+    return insuredIDs
+
+
+
+class EAVStorage(object):
+    """
+    Attribute values of insured as one insured_data row per attribute
+    """
+    name = "eav"
+
+    def _rows(self, insurance, insuredID, values):
+        return [{"insuredID": insuredID, "name": name, "value": value, \
+                 "intValue": _intValue(insurance.attributes[name].dataType, value)} for name, value in values.items()]
+
+    def add(self, session, insurance, records):
+        """
+        Add one insured per dict of attribute values, returns the ids of the new insured
+        """
+        insuredIDs = _insertInsured(session, insurance, [{"insuranceID": insurance.id} for _ in records])
+        rows = [row for insuredID, values in zip(insuredIDs, records) for row in self._rows(insurance, insuredID, values)]
+        if rows:
+            # every row has the same keys, so the rows go in one executemany
+            session.execute(INSERT_INSURED_DATA, rows)
+        return insuredIDs
+
+    def insert(self, session, insurance, records):
+        """
+        Insert [(insuredID, values)] with the ids given, in one executemany per table,
+        returns the number of attribute values
+        """
+        session.execute(INSERT_INSURED, [{"id": insuredID, "insuranceID": insurance.id} \
+                        for insuredID, values in records])
+        rows = [row for insuredID, values in records for row in self._rows(insurance, insuredID, values)]
+        if rows:
+            session.execute(INSERT_INSURED_DATA, rows)
+        return len(rows)
+
+    def scan(self, session, insurance, criterion=None, chunkSize=None):
+        """
+        (insuredID, {attributeName: value}) of the insured of a type matching criterion,
+        ordered by insured id, values of int attributes as int
+        """
+        query = session.query(Insured.id, insuredData.name, insuredData.value, insuredData.intValue) \
+                    .outerjoin(insuredData, insuredData.insuredID == Insured.id) \
+                    .filter(and_(Insured.insuranceID == insurance.id, Insured.deleted.is_(None)))
+        if criterion is not None:
+            query = query.filter(criterion)
+        query = query.order_by(Insured.id, insuredData.id)
+        if chunkSize:
+            query = query.yield_per(chunkSize)
+        return self._pivot(query)
+
+    # (insuredID, {attributeName: value}) of rows ordered by insured, pivoted on the fly
+    def _pivot(self, rows):
+        currentID, values = None, OrderedDict()
+        for insuredID, name, value, intValue in rows:
+            if insuredID != currentID:
+                if currentID is not None:
+                    yield currentID, values
+                currentID, values = insuredID, OrderedDict()
+            # insured without any attribute come with a null name
+            if name is not None:
+                values[name] = intValue if intValue is not None else value
+        if currentID is not None:
+            yield currentID, values
+
+    def many(self, session, insurance, insuredIDs=None, first=None, last=None):
+        """
+        (insuredID, {attributeName: value}) of the insured of a type among insuredIDs,
+        or with an id between first and last, ordered by insured id
+        """
+        rows = session.execute(SELECT_VALUES_MANY[insuredIDs is not None], {"insuranceID": insurance.id, \
+                    "insuredIDs": insuredIDs, "first": first, "last": last}, mapper=Insured)
+        return self._pivot(rows)
+
+    def values(self, session, insurance, insured):
+        """
+        {attributeName: value} of one insured
+        """
+        rows = session.execute(SELECT_VALUES, {"insuredID": insured.id}, mapper=insuredData)
+        return OrderedDict((name, intValue if intValue is not None else value) for name, value, intValue in rows)
+
+    def update(self, session, insurance, insuredID, values):
+        """
+        Set attribute values of an insured, returns the names it already had
+        """
+        existing = dict(session.execute(SELECT_VALUE_IDS, {"insuredID": insuredID, "names": list(values.keys())}, \
+                    mapper=insuredData).fetchall())
+
+        updates = []
+        inserts = []
+        for row in self._rows(insurance, int(insuredID), values):
+            if row["name"] in existing:
+                updates.append({"dataID": existing[row["name"]], "newValue": row["value"], \
+                                "newIntValue": row["intValue"]})
+            else:
+                inserts.append(row)
+        if updates:
+            session.execute(UPDATE_INSURED_DATA, updates)
+        if inserts:
+            session.execute(INSERT_INSURED_DATA, inserts)
+        return set(existing)
+
+    def delete(self, session, insuredID):
+        """
+        Delete an insured and its values, returns the number of insured deleted
+        """
+        session.execute(DELETE_INSURED_DATA, {"insuredID": insuredID})
+        return session.execute(DELETE_INSURED, {"insuredID": insuredID}).rowcount
+
+    def filter(self, query, insurance, name, op, value):
+        """
+        Search query narrowed to the insured whose attribute name matches op and value,
+        with one indexed join on insured_data
+        """
+        iData = aliased(insuredData)
+        column = iData.intValue if insurance.attributes[name].dataType == "int" else iData.value
+        return query.join(iData, and_(iData.insuredID == Insured.id, iData.name == name, \
+                    SEARCH_OPERATORS[op](column, value)))
+
+    def attributeInUse(self, session, insuranceID, name):
+        return session.query(insuredData.id).join(Insured, Insured.id == insuredData.insuredID) \
+                    .filter(and_(Insured.insuranceID == insuranceID, Insured.deleted.is_(None), \
+                                 insuredData.name == name)).first() is not None
+
+    def valueQuery(self, session, insurance, name):
+        """
+        (value column, query of the values of attribute name of the insured of a type), values of
+        int attributes as numbers, aggregated with query.with_entities()
+        """
+        value = insuredData.intValue if insurance.attributes[name].dataType == "int" else insuredData.value
+        query = session.query(insuredData.id).select_from(insuredData) \
+                    .join(Insured, Insured.id == insuredData.insuredID) \
+                    .filter(and_(Insured.insuranceID == insurance.id, Insured.deleted.is_(None), \
+                                 insuredData.name == name, value.isnot(None)))
+        return value, query
+
+    def summary(self, session, insurance):
+        """
+        {attributeName: (insured having it, sum of its int values)} of the insured of a type, in one GROUP BY
+        """
+        query = session.query(insuredData.name, func.count(insuredData.id), func.sum(insuredData.intValue)) \
+                    .join(Insured, Insured.id == insuredData.insuredID) \
+                    .filter(and_(Insured.insuranceID == insurance.id, Insured.deleted.is_(None))).group_by(insuredData.name)
+        return dict((name, (count, total or 0)) for name, count, total in query)
+
+    def purgeType(self, session, job, insuranceID):
+        dataQuery = session.query(insuredData.id).join(Insured, Insured.id == insuredData.insuredID) \
+                        .filter(Insured.insuranceID == insuranceID)
+        insuredQuery = session.query(Insured.id).filter(Insured.insuranceID == insuranceID)
+        job.total = dataQuery.count() + insuredQuery.count()
+        session.commit()
+        _purgeRows(session, job, insuredData, dataQuery)
+        _purgeRows(session, job, Insured, insuredQuery)
+
+    def purgeAttribute(self, session, job, insuranceID, name):
+        dataQuery = session.query(insuredData.id).join(Insured, Insured.id == insuredData.insuredID) \
+                        .filter(and_(Insured.insuranceID == insuranceID, insuredData.name == name))
+        job.total = dataQuery.count()
+        session.commit()
+        _purgeRows(session, job, insuredData, dataQuery)
+
+    def createIndexes(self, session):
+        pass
+
+
+# sql string literal, for the expressions that must match an index
+def _sqlString(value):
+    return "'%s'" % value.replace("'", "''")
+
+
+# attributes whose document values get an expression index, comma separated
+DOCUMENT_INDEXES = [name for name in os.environ.get("INSURANCE_DOCUMENT_INDEXES", "").split(",") if name]
+
+class DocumentStorage(object):
+    """
+    Attribute values of insured as one json object in insured.document, int values as
+    json numbers, queried with the SQLite JSON1 functions
+    """
+    name = "document"
+
+    def _document(self, insurance, values):
+        return json.dumps(OrderedDict((name, value if insurance.attributes[name].dataType == "int" else \
+                    value if isinstance(value, str) else str(value)) for name, value in values.items()))
+
+    def _value(self, name):
+        # the same expression as the index of the attribute, a name with a quote has no json path
+        if '"' in name:
+            return literal_column("(SELECT value FROM json_each(insured.document) WHERE key = %s)" % _sqlString(name))
+        return func.json_extract(Insured.document, literal_column(_sqlString('$."%s"' % name)))
+
+    def _load(self, document):
+        return json.loads(document, object_pairs_hook=OrderedDict) if document else OrderedDict()
+
+    def add(self, session, insurance, records):
+        """
+        Add one insured per dict of attribute values, returns the ids of the new insured
+        """
+        return _insertInsured(session, insurance, [{"insuranceID": insurance.id, \
+                    "document": self._document(insurance, values)} for values in records])
+
+    def insert(self, session, insurance, records):
+        """
+        Insert [(insuredID, values)] with the ids given, in one executemany,
+        returns the number of attribute values
+        """
+        session.execute(INSERT_INSURED, [{"id": insuredID, "insuranceID": insurance.id, \
+                        "document": self._document(insurance, values)} for insuredID, values in records])
+        return sum(len(values) for insuredID, values in records)
+
+    def scan(self, session, insurance, criterion=None, chunkSize=None):
+        """
+        (insuredID, {attributeName: value}) of the insured of a type matching criterion,
+        ordered by insured id, values of int attributes as int
+        """
+        query = session.query(Insured.id, Insured.document).filter(and_(Insured.insuranceID == insurance.id, \
+                    Insured.deleted.is_(None)))
+        if criterion is not None:
+            query = query.filter(criterion)
+        query = query.order_by(Insured.id)
+        if chunkSize:
+            query = query.yield_per(chunkSize)
+        for insuredID, document in query:
+            yield insuredID, self._load(document)
+
+    def many(self, session, insurance, insuredIDs=None, first=None, last=None):
+        """
+        (insuredID, {attributeName: value}) of the insured of a type among insuredIDs,
+        or with an id between first and last, ordered by insured id
+        """
+        for insuredID, document in session.execute(SELECT_DOCUMENTS[insuredIDs is not None], {"insuranceID": \
+                    insurance.id, "insuredIDs": insuredIDs, "first": first, "last": last}, mapper=Insured):
+            yield insuredID, self._load(document)
+
+    def values(self, session, insurance, insured):
+        """
+        {attributeName: value} of one insured
+        """
+        return self._load(insured.document)
+
+    def update(self, session, insurance, insuredID, values):
+        """
+        Set attribute values of an insured, returns the names it already had
+        """
+        document = session.execute(SELECT_DOCUMENT, {"insuredID": insuredID}, mapper=Insured).scalar()
+        # merged by SQLite, so concurrent updates of other attributes are kept
+        session.execute(UPDATE_DOCUMENT, {"insuredID": insuredID, "patch": self._document(insurance, values)})
+        return set(self._load(document)) & set(values)
+
+    def delete(self, session, insuredID):
+        """
+        Delete an insured, returns the number of insured deleted
+        """
+        return session.execute(DELETE_INSURED, {"insuredID": insuredID}).rowcount
+
+    def filter(self, query, insurance, name, op, value):
+        """
+        Search query narrowed to the insured whose attribute name matches op and value
+        """
+        return query.filter(SEARCH_OPERATORS[op](self._value(name), value))
+
+    def attributeInUse(self, session, insuranceID, name):
+        return session.query(Insured.id).filter(and_(Insured.insuranceID == insuranceID, \
+                    Insured.deleted.is_(None), self._value(name).isnot(None))).first() is not None
+
+    def valueQuery(self, session, insurance, name):
+        """
+        (value column, query of the values of attribute name of the insured of a type), values of
+        int attributes as numbers, aggregated with query.with_entities()
+        """
+        value = self._value(name)
+        query = session.query(Insured.id).filter(and_(Insured.insuranceID == insurance.id, Insured.deleted.is_(None), \
+                    value.isnot(None)))
+        return value, query
+
+    def summary(self, session, insurance):
+        """
+        {attributeName: (insured having it, sum of its int values)} of the insured of a type, in one GROUP BY
+        """
+        rows = session.execute("SELECT item.key, COUNT(*), SUM(CASE WHEN item.type = 'integer' THEN item.value END) "
+                               "FROM insured, json_each(insured.document) AS item "
+                               "WHERE insured.insuranceID = :insuranceID AND insured.deleted IS NULL GROUP BY item.key", \
+                               {"insuranceID": insurance.id}, mapper=Insured)
+        return dict((name, (count, total or 0)) for name, count, total in rows)
+
+    def purgeType(self, session, job, insuranceID):
+        insuredQuery = session.query(Insured.id).filter(Insured.insuranceID == insuranceID)
+        job.total = insuredQuery.count()
+        session.commit()
+        _purgeRows(session, job, Insured, insuredQuery)
+
+    def purgeAttribute(self, session, job, insuranceID, name):
+        idQuery = session.query(Insured.id, Insured.document).filter(and_(Insured.insuranceID == insuranceID, \
+                        self._value(name).isnot(None)))
+        job.total = idQuery.count()
+        session.commit()
+        while True:
+            rows = idQuery.limit(PURGE_CHUNK_SIZE).all()
+            if not rows:
+                break
+            updates = []
+            for insuredID, document in rows:
+                values = self._load(document)
+                values.pop(name, None)
+                updates.append({"id": insuredID, "document": json.dumps(values)})
+            session.bulk_update_mappings(Insured, updates)
+            job.processed += len(rows)
+            job.updated = datetime.datetime.utcnow()
+            session.commit()
+
+    def createIndexes(self, session):
+        """
+        Create the expression indexes of DOCUMENT_INDEXES, by insurance type and value
+        """
+        for name in DOCUMENT_INDEXES:
+            if '"' in name:
+                continue
+            session.execute("CREATE INDEX IF NOT EXISTS ix_insured_document_%08x ON insured (insuranceID, json_extract(document, %s))" \
+                            % (zlib.crc32(name.encode("utf-8")), _sqlString('$."%s"' % name)), mapper=Insured)
+        session.commit()
+
+
+STORAGES = {"eav": EAVStorage, "document": DocumentStorage}
+
+# storage of the attribute values of insured
+storage = STORAGES[os.environ.get("INSURANCE_STORAGE", "eav")]()
+
+
+# summary counters of the attribute values, updated with every insured write
+STATS_COUNTERS = os.environ.get("INSURANCE_STATS_COUNTERS", "0").lower() in ("1", "true", "yes")
+
+# take the write lock of the database of the insured in the transaction of session, so the values
+# read next are the ones the write replaces: SQLite only locks at the first write of a transaction
+LOCK_INSURED = text("UPDATE settings SET value = value WHERE name = 'nextInsuredID'")
+
+def _lockInsured(session):
+    session.execute(LOCK_INSURED, mapper=Insured)
+
+
+# {attributeName: value} of an insured, from the storage
+def _storedValues(session, insurance, insuredID):
+    for ID, values in storage.many(session, insurance, [int(insuredID)]):
+        return values
+    return OrderedDict()
+
+
+# move the summary counters of a type by the values of insured added and removed, and
+# by the number of insured, in the transaction of session
+def _countStats(session, insurance, added=(), removed=(), insured=0):
+    if not STATS_COUNTERS:
+        return
+    deltas = OrderedDict()
+    if insured:
+        deltas[None] = [insured, 0]
+    for sign, records in ((1, added), (-1, removed)):
+        for values in records:
+            for name, value in values.items():
+                delta = deltas.setdefault(name, [0, 0])
+                delta[0] += sign
+                if isinstance(value, int):
+                    delta[1] += sign * value
+
+    for name, (count, total) in deltas.items():
+        if not count and not total:
+            continue
+        if name is None:
+            updated = session.execute(UPDATE_TYPE_STATS, {"statInsuranceID": insurance.id, "countDelta": count})
+        else:
+            updated = session.execute(UPDATE_STATS, {"statInsuranceID": insurance.id, "statName": name, \
+                        "countDelta": count, "totalDelta": total})
+        if not updated.rowcount:
+            session.execute(AttributeStats.__table__.insert(), {"insuranceID": insurance.id, "name": name, \
+                        "count": count, "total": total})
+
+
+# drop the summary counters of a deleted type, or of one of its deleted attributes
+def _dropStats(session, insuranceID, name=None):
+    query = session.query(AttributeStats).filter(AttributeStats.insuranceID == insuranceID)
+    if name is not None:
+        query = query.filter(AttributeStats.name == name)
+    query.delete(synchronize_session=False)
+
+
+# count the summary counters of every type from the stored values, in the database of its insured
+def _rebuildStats(session):
+    for shard in [None] + shardsInUse(session):
+        session.info["shard"] = shard
+        session.query(AttributeStats).delete(synchronize_session=False)
+    for insuranceType, in session.query(Insurance.type).all():
+        insurance = schemaCache.get(session, insuranceType)
+        insured = session.query(func.count(Insured.id)).filter(and_(Insured.insuranceID == insurance.id, \
+                    Insured.deleted.is_(None))).scalar()
+        rows = [{"insuranceID": insurance.id, "name": None, "count": insured, "total": 0}] + \
+               [{"insuranceID": insurance.id, "name": name, "count": count, "total": total} \
+                for name, (count, total) in storage.summary(session, insurance).items()]
+        session.execute(AttributeStats.__table__.insert(), rows)
+
+
+def checkStorage():
+    """
+    Check the insured of the database and its shards are kept by the configured storage,
+    an empty database is taken over, create the indexes of the storage, and count the
+    summary counters when they are kept but were not up to date
+    """
+    session = SessionFactory()
+    try:
+        setting = session.query(Setting).get("storage")
+        stored = setting.value if setting is not None else "eav"
+        shards = [None] + shardsInUse(session)
+        for shard in shards:
+            session.info["shard"] = shard
+            if stored != storage.name and session.query(Insured.id).first() is not None:
+                raise RuntimeError("insured are stored as %s, convert them with: python migrations.py convert %s" \
+                                   % (stored, storage.name))
+        if setting is None or stored != storage.name:
+            session.merge(Setting(name="storage", value=storage.name))
+            session.commit()
+        for shard in shards:
+            session.info["shard"] = shard
+            storage.createIndexes(session)
+
+        # writes made while the counters were off are only counted by a rebuild
+        setting = session.query(Setting).get("statsCounters")
+        counting = setting is not None and setting.value == "on"
+        if STATS_COUNTERS and not counting:
+            _rebuildStats(session)
+        if STATS_COUNTERS != counting:
+            session.merge(Setting(name="statsCounters", value="on" if STATS_COUNTERS else "off"))
+            session.commit()
+    finally:
+        session.close()
+
+
+
+# group commit of the insured writes, a delay of 0 ms writes every request in its own transaction
+GROUP_COMMIT_DELAY = float(os.environ.get("INSURANCE_GROUP_COMMIT_DELAY", "0"))    # milliseconds
+GROUP_COMMIT_SIZE = int(os.environ.get("INSURANCE_GROUP_COMMIT_SIZE", "64"))
+
+class WriteQueue(object):
+    """
+    Writes of concurrent requests, run by one writer thread and committed
+    together once size writes are pending or delay seconds after the first
+    one, in a single transaction per database they write to (the main one or
+    a shard). When a transaction fails, its writes are replayed one
+    transaction each, so only the failing write gets the error.
+    """
+    def __init__(self, delay, size):
+        self.delay = delay
+        self.size = size
+        self.queue = queue.Queue()
+        self.commits = 0
+        self.writes = 0
+        self.replays = 0
+        self.thread = threading.Thread(target=self._run, name="write-queue")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, write, shard=None):
+        """
+        Run write(session) in the next group transaction, routed to shard, returns
+        its result once committed or raises its error
+        """
+        future = Future()
+        self.queue.put((write, future, shard))
+        return future.result()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.time() + self.delay
+            while len(batch) < self.size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._commitByShard(batch)
+                    return
+                batch.append(item)
+            self._commitByShard(batch)
+
+    # the writes of a database are committed apart from the others: a transaction holds the
+    # write lock of a single database, and never waits for another one while holding it
+    def _commitByShard(self, batch):
+        shards = OrderedDict()
+        for item in batch:
+            shards.setdefault(item[2], []).append(item)
+        for items in shards.values():
+            self._commit(items)
+
+    def _commit(self, batch):
+        session = SessionFactory()
+        session.info["shard"] = batch[0][2]
+        error = None
+        try:
+            results = []
+            for write, future, shard in batch:
+                results.append(write(session))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            error = e
+        finally:
+            session.close()
+
+        if error is None:
+            self.commits += 1
+            self.writes += len(batch)
+            for (write, future, shard), result in zip(batch, results):
+                future.set_result(result)
+        elif len(batch) > 1:
+            self.replays += 1
+            for item in batch:
+                self._commit([item])
+        else:
+            batch[0][1].set_exception(error)
+
+
+# write queue of the threaded servers, None writes in the request
+writeQueue = None
+
+def startWriteQueue(delay=None, size=None):
+    """
+    Start the group commit of insured writes, unless its delay is 0,
+    returns the write queue or None
+    """
+    global writeQueue
+    delay = GROUP_COMMIT_DELAY if delay is None else delay
+    if writeQueue is None and delay > 0:
+        writeQueue = WriteQueue(delay / 1000.0, size or GROUP_COMMIT_SIZE)
+    return writeQueue
+
+
+# run write(session) and commit, in the group transaction of the write queue when started
+def _write(session, write):
+    if writeQueue is not None:
+        # the writer thread needs a pooled connection, give back the one of the request
+        shard = session.info.get("shard")
+        session.close()
+        return writeQueue.submit(write, shard)
+    try:
+        result = write(session)
+        session.commit()
+    except exc.SQLAlchemyError:
+        session.rollback()
+        raise
+    return result
+
+
+metrics.registry.collectors.append(lambda: [] if writeQueue is None else [
+    ("insurance_group_commits_total", "counter", "Transactions committed by the write queue", (), writeQueue.commits),
+    ("insurance_group_commit_writes_total", "counter", "Writes committed by the write queue", (), writeQueue.writes),
+    ("insurance_group_commit_replays_total", "counter", "Failed group transactions replayed write by write", (), writeQueue.replays),
+    ("insurance_group_commit_pending", "gauge", "Writes waiting in the write queue", (), writeQueue.queue.qsize()),
+])
+
+
+
+# soft delete: deleteInsured and deleteType with purge only mark the insured deleted,
+# the purger removes them and their values afterwards
+SOFT_DELETE = os.environ.get("INSURANCE_SOFT_DELETE", "0").lower() in ("1", "true", "yes")
+
+# rate limits of the purger: insured removed per transaction, insured removed per second at
+# most (0 stops the purger), free pages given back per incremental vacuum step
+PURGE_BATCH_SIZE = int(os.environ.get("INSURANCE_PURGE_BATCH_SIZE", "200"))
+PURGE_RATE = float(os.environ.get("INSURANCE_PURGE_RATE", "1000"))
+PURGE_VACUUM_PAGES = int(os.environ.get("INSURANCE_PURGE_VACUUM_PAGES", "256"))
+
+# seconds between two looks for work when there was none
+PURGE_IDLE = 1.0
+
+try:
+    import fcntl
+except ImportError:
+    # no lock between the processes, each of them purges
+    fcntl = None
+
+
+# remove a batch of soft deleted insured and their values in one transaction, returns their number
+def _purgeDeleted(session, limit):
+    ids = [row[0] for row in session.query(Insured.id).filter(Insured.deleted.isnot(None)).limit(limit)]
+    if ids:
+        session.query(insuredData).filter(insuredData.insuredID.in_(ids)).delete(synchronize_session=False)
+        session.query(Insured).filter(Insured.id.in_(ids)).delete(synchronize_session=False)
+        session.commit()
+    return len(ids)
+
+
+# give back up to pages free pages of a database file with auto_vacuum=INCREMENTAL,
+# returns their number
+def _vacuumStep(vacuumEngine, pages):
+    raw = vacuumEngine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute("PRAGMA auto_vacuum")
+        if cursor.fetchone()[0] != 2:
+            return 0
+        cursor.execute("PRAGMA freelist_count")
+        free = cursor.fetchone()[0]
+        if free:
+            # executescript steps the pragma to its end, execute() frees a single page
+            cursor.executescript("PRAGMA incremental_vacuum(%d)" % pages)
+        return min(free, pages)
+    finally:
+        raw.close()
+
+
+class Purger(object):
+    """
+    Background thread removing the soft deleted insured of the main and the shard
+    databases, batchSize insured per transaction and at most rate insured per second,
+    then giving their free pages back in incremental vacuum steps of vacuumPages.
+    One process of a database purges at a time, the others wait for its lock file.
+    """
+    def __init__(self, batchSize, rate, vacuumPages):
+        self.batchSize = batchSize
+        self.rate = rate
+        self.vacuumPages = vacuumPages
+        self.purged = 0
+        self.vacuumed = 0
+        self.lockFile = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="purger")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                purged, vacuumed = self.purge() if self._locked() else (0, 0)
+            except Exception:
+                # a busy database, tried again after the pause
+                purged, vacuumed = 0, 0
+            # a pause of at least one batch, for the rate and the foreground writes
+            pause = max(purged, self.batchSize) / self.rate if purged or vacuumed else PURGE_IDLE
+            self.stopping.wait(pause)
+
+    # one purger per database across the worker processes, the lock is held until exit
+    def _locked(self):
+        if self.lockFile is not None or fcntl is None or engine.url.database in (None, "", ":memory:"):
+            return True
+        lockFile = open(engine.url.database + ".purge.lock", "a")
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lockFile.close()
+            return False
+        self.lockFile = lockFile
+        return True
+
+    def purge(self):
+        """
+        Remove a batch of soft deleted insured from every database having some, or take a
+        vacuum step on the others, returns (insured removed, pages given back)
+        """
+        session = SessionFactory()
+        purgedTotal, vacuumedTotal = 0, 0
+        try:
+            for shard in [None] + shardsInUse(session):
+                session.info["shard"] = shard
+                purged = _purgeDeleted(session, self.batchSize)
+                if not purged and self.vacuumPages:
+                    vacuumedTotal += _vacuumStep(engine if shard is None else shardEngine(shard), self.vacuumPages)
+                purgedTotal += purged
+        finally:
+            session.close()
+        self.purged += purgedTotal
+        self.vacuumed += vacuumedTotal
+        return purgedTotal, vacuumedTotal
+
+
+# purger of the servers, None until started
+purger = None
+
+def startPurger(batchSize=None, rate=None, vacuumPages=None):
+    """
+    Start the purger of the soft deleted insured and of the free pages, unless its rate is 0,
+    returns the purger or None
+    """
+    global purger
+    rate = PURGE_RATE if rate is None else rate
+    if purger is None and rate > 0:
+        purger = Purger(batchSize or PURGE_BATCH_SIZE, rate, PURGE_VACUUM_PAGES if vacuumPages is None else vacuumPages)
+    return purger
+
+
+metrics.registry.collectors.append(lambda: [] if purger is None else [
+    ("insurance_purged_insured_total", "counter", "Soft deleted insured removed by the purger", (), purger.purged),
+    ("insurance_vacuumed_pages_total", "counter", "Free pages given back by incremental vacuum", (), purger.vacuumed),
+])
 
-engine = create_engine('sqlite:///propertyInsurance.db')
 
 # create a new insurance type
 def createType(jsonObj):
@@ -60,9 +1535,7 @@ def createType(jsonObj):
     Create a new Insurance type
     data: {"type":"health"}
     """
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+    session = Session()
 
     # check for "type", "optional" keyword exist in jsonObj
     if "type" not in jsonObj.keys():
@@ -82,17 +1555,20 @@ def createType(jsonObj):
         return json.dumps({"status":"error", "message":"Insurance type already exists"}), 409
 
 
-    newInsurance = Insurance(type=jsonObj["type"])
+    newInsurance = Insurance(type=jsonObj["type"], shard=shardOf(jsonObj["type"]))
 
     try:
         session.add(newInsurance)
+        _logChanges(session, [("typeCreated", jsonObj["type"], None, None)])
         session.commit()
-    except exc as e:
-        sesion.rollback()
+    except exc.SQLAlchemyError as e:
+        session.rollback()
         return json.dumps({"status":"error", "message":"DB error"})
     finally:
         session.close()
 
+    _schemaChanged(jsonObj["type"], typeList=True)
+
     #return Response(response=json.dumps({"status":"success"}), status=201,mimetype='application/json')
     return json.dumps({"status":"success"}), 201, {'mimetype':'application/json'}
 
@@ -103,9 +1579,7 @@ def getTypes():
     """
     Getting all Insurance Types    
     """
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+    session = Session()
 
     
     try:
@@ -131,13 +1605,12 @@ def addAttribute(insuranceType, jsonObj):
     """
     Create Attributes to new Insurance Type
     Data: {"name":"fullName", "dataType":"String", "mandatory":"Yes"}    
+    enum attributes list their allowed values: {"name":"gender", "dataType":"enum", "mandatory":"no", "values":["male", "female"]}
     """
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+    session = Session()
 
     try:
-        insurance = session.query(Insurance).filter(Insurance.type == insuranceType).one()
+        insurance = schemaCache.get(session, insuranceType)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
 
@@ -153,15 +1626,8 @@ def addAttribute(insuranceType, jsonObj):
         return json.dumps({"status":"error","message":"Invalid request"}), 400
 
     # check for attribute already existed
-    try:
-        insurance_attr_data = session.query(InsuranceAttribute).filter(InsuranceAttribute.insuranceID == insurance.id).all()
-    except exc.SQLAlchemyError as e:
-        return json.dumps({"status":"error", "message":"DB error"})
-
-    if insurance_attr_data:
-        for attr in insurance_attr_data:
-            if attr.name == jsonObj["name"]:
-                return json.dumps({"status":"error", "message":"Attribute already exists"}), 409
+    if jsonObj["name"] in insurance.attributes:
+        return json.dumps({"status":"error", "message":"Attribute already exists"}), 409
 
 
     # check for attribute name lenght exceeds 255 and return proper error
@@ -177,12 +1643,25 @@ def addAttribute(insuranceType, jsonObj):
     if jsonObj["mandatory"].upper() != "YES" and jsonObj["mandatory"].upper() != "NO":
         return json.dumps({"status":"error", "message":"Invalid request"}), 400
 
+    # check for a non empty list of allowed values of an enum
+    if jsonObj["dataType"] == "enum":
+        values = jsonObj.get("values")
+        if not isinstance(values, list) or not values or \
+                not all(isinstance(value, str) for value in values) or len(json.dumps(values)) > 4096:
+            return json.dumps({"status":"error", "message":"Invalid request"}), 400
+        attribute.enumValues = json.dumps(values)
+
     attribute.dataType = jsonObj["dataType"]
     attribute.insuranceID = insurance.id
     attribute.mandatory = jsonObj["mandatory"]
 
+    added = OrderedDict([("name", attribute.name), ("dataType", attribute.dataType), ("mandatory", attribute.mandatory)])
+    if attribute.enumValues is not None:
+        added["values"] = json.loads(attribute.enumValues)
+
     try:
         session.add(attribute)
+        _logChanges(session, [("attributeAdded", insuranceType, None, added)])
         session.commit()
     except exc.SQLAlchemyError as e:
         session.rollback()
@@ -190,6 +1669,7 @@ def addAttribute(insuranceType, jsonObj):
     finally:
         session.close()
 
+    _schemaChanged(insuranceType)
     return json.dumps({"status":"success"}), 201
 
 
@@ -198,28 +1678,23 @@ def getAttributes(insuranceType):
     """
     Get all Attributes of Insurance Type
     """
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+    session = Session()
 
     # check for insurance type
     try:
-        insurance = session.query(Insurance).filter(Insurance.type == insuranceType).one()
+        insurance = schemaCache.get(session, insuranceType)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
-
-    # getting all insurance attributes data
-    try:
-        insurance_attributes = session.query(InsuranceAttribute) \
-                            .filter(InsuranceAttribute.insuranceID == insurance.id).all()
-    except exc.SQLAlchemyError as e:
-        return json.dumps({"status":"error", "message": "DB error"})
+    finally:
+        session.close()
 
     attributes = []
-    for insurance_attribute in insurance_attributes:
+    for insurance_attribute in insurance.attributes.values():
         attribute = OrderedDict([("name", insurance_attribute.name), \
                     ("dataType", insurance_attribute.dataType), \
                     ("mandatory", insurance_attribute.mandatory)])
+        if insurance_attribute.values is not None:
+            attribute["values"] = list(insurance_attribute.values)
         attribute_name = {insurance_attribute.name:attribute}
         attributes.append(attribute_name)
 
@@ -236,13 +1711,11 @@ def addInsured(insuranceType, jsonObj):
     Add Insured for Insurance Type, 
     data: {"attributes":[{"attributeName":"fullName", "attributeValue":"value of attribute"}]}
     """
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+    session = Session()
 
     # check for insurance type
     try:
-        insurance = session.query(Insurance).filter(Insurance.type == insuranceType).one()
+        insurance = schemaCache.get(session, insuranceType)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
 
@@ -250,82 +1723,98 @@ def addInsured(insuranceType, jsonObj):
     if 'attributes' not in jsonObj:
         return json.dumps({"status":"error", "message":"Invalid request"}), 400
 
-    # check for all attribute names exist for insurance type
+    # check attribute names, mandatory attributes and values against the insurance type
+    values, message, code = insurance.validator.validate(jsonObj["attributes"])
+    if message is not None:
+        return json.dumps({"status":"error", "message":message}), code
+
+    #add insured entry with all its attributes and its change in one transaction
+    def write(session):
+        insuredID = storage.add(session, insurance, [values])[0]
+        _logChanges(session, [("insuredAdded", insurance.type, insuredID, values)])
+        _countStats(session, insurance, added=[values], insured=1)
+        return insuredID
+
     try:
-        insurance_attr_data = session.query(InsuranceAttribute).filter(InsuranceAttribute.insuranceID == insurance.id).all()
+        insuredID = _write(session, write)
     except exc.SQLAlchemyError as e:
-        return json.dumps({"status":"error", "message":"DB error"})
+        return json.dumps({"status":"error", "message":"DB error"}), 500
 
-    insurance_attributes = []
-    insurance_mandatory_attributes = []
-    for insurance_attr in insurance_attr_data:
-        insurance_attributes.append(insurance_attr.name)
-        if insurance_attr.mandatory.upper() == "YES":
-            insurance_mandatory_attributes.append(insurance_attr.name)
+    return json.dumps({"status":"success", "insuranceID":insuredID}), 201
 
-    attributes = jsonObj["attributes"]
-    # check for all attributes exist in insurance type attributes
-    for attr in attributes:
-        if attr["attributeName"] not in insurance_attributes:
-            return json.dumps({"status":"error", "message": attr["attributeName"] + " attribute not exist for Inurance type"}), 404
 
 
-    # check for all mandatory attributes exists in the attributes
-    request_attr_names = []
-    for attr in attributes:
-        request_attr_names.append(attr["attributeName"])
+# typed copy of a value stored in insuredData.intValue
+def _intValue(dataType, value):
+    return value if dataType == "int" else None
 
-    for attr in insurance_mandatory_attributes:
-        if attr not in request_attr_names:
-            return json.dumps({"status":"error","message":"Invalid request"}), 400
 
-    #add insured entry
-    ins = Insured()
-    ins.insuranceID = insurance.id;
 
+# number of insured records written in one transaction
+BATCH_CHUNK_SIZE = 500
+
+# write the validated (result, values) of a chunk in one transaction, returns False when it failed
+def _addChunk(session, insurance, chunk):
     try:
-        session.add(ins)
+        insuredIDs = storage.add(session, insurance, [values for result, values in chunk])
+        _logChanges(session, [("insuredAdded", insurance.type, ID, values) \
+                    for ID, (result, values) in zip(insuredIDs, chunk)])
+        _countStats(session, insurance, added=[values for result, values in chunk], insured=len(chunk))
         session.commit()
     except exc.SQLAlchemyError as e:
         session.rollback()
-        return json.dumps({"status":"error", "message":"DB error"})
+        return False
 
+    for ID, (result, values) in zip(insuredIDs, chunk):
+        result["insuredID"] = ID
+    return True
 
+# add many insured to an insurance type
+def addInsuredBatch(insuranceType, records):
+    """
+    Add a batch of Insured for Insurance Type,
+    data: [{"attributes":[{"attributeName":"fullName", "attributeValue":"value of attribute"}]}, ...]
+    """
+    session = Session()
 
-    for attr in attributes:
-        try:
-            iattr = session.query(InsuranceAttribute).filter(and_( \
-                    InsuranceAttribute.insuranceID == insurance.id, \
-                    InsuranceAttribute.name == attr["attributeName"])).one()
-        except exc.SQLAlchemyError as e:
-            return json.dumps({"status":"error", "message": attr["attributeName"] + " " +"Attribute not found"}), 404
-
-        if iattr.dataType=="int":
-            # check for valid integer value, throw error if not valid
-            try:
-                value = int(attr["attributeValue"])
-            except ValueError:
-                return json.dumps({"status":"error", "message":"Invalid request"})
-        elif iattr.dataType=="enum":
-            value = attr["attributeValue"]
-        elif iattr.dataType=="string":
-            value = attr["attributeValue"]
-        else:
-            return  json.dumps({"status":"failed", "message":"Unknown"})
-
-        newAttr = insuredData()
-        newAttr.insuredID = ins.id
-        newAttr.name = attr["attributeName"]
-        newAttr.value = value
-
+    try:
+        # check for insurance type
         try:
-            session.add(newAttr)
-            session.commit()
+            insurance = schemaCache.get(session, insuranceType)
         except exc.SQLAlchemyError as e:
-            return json.dumps({"status":"error", "message":"DB error"})
-
+            return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
+
+        # validate every record before writing anything
+        results = []
+        valid = []
+        for index, record in enumerate(records):
+            if not isinstance(record, dict) or "attributes" not in record:
+                results.append(OrderedDict([("index", index), ("status", "error"), ("message", "Invalid request")]))
+                continue
+            values, message, code = insurance.validator.validate(record["attributes"])
+            if message is not None:
+                results.append(OrderedDict([("index", index), ("status", "error"), ("message", message)]))
+                continue
+            result = OrderedDict([("index", index), ("status", "success"), ("insuredID", None)])
+            results.append(result)
+            valid.append((result, values))
+
+        # write each chunk in a single transaction, a failed chunk is written again record
+        # by record, so only the failing records get the error
+        for start in range(0, len(valid), BATCH_CHUNK_SIZE):
+            chunk = valid[start:start + BATCH_CHUNK_SIZE]
+            if _addChunk(session, insurance, chunk):
+                continue
+            failed = chunk if len(chunk) == 1 else [item for item in chunk if not _addChunk(session, insurance, [item])]
+            for result, values in failed:
+                result["status"] = "error"
+                result["message"] = "DB error"
+                del result["insuredID"]
+    finally:
+        session.close()
 
-    return json.dumps({"status":"success", "insuranceID":ins.id}), 201
+    return json.dumps(OrderedDict([("status", "success"), ("insuranceType", insuranceType), \
+                    ("results", results)])), 201
 
 
 
@@ -335,17 +1824,15 @@ def getOneInsured(insuranceType, insuredID):
     Get One Insured details to an Insurance Type
     """
     
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+    session = Session()
 
     try:
-        insurance = session.query(Insurance).filter(Insurance.type == insuranceType).one()
+        insurance = schemaCache.get(session, insuranceType)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
 
     try:
-        insured = session.query(Insured).filter(Insured.id == insuredID).one()
+        insured = _insuredRow(session, insuredID)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"Insured not found"}), 404
 
@@ -354,53 +1841,515 @@ def getOneInsured(insuranceType, insuredID):
 
 
     try:
-        iData = session.query(insuredData).filter(insuredData.insuredID == insuredID).all()
+        values = storage.values(session, insurance, insured)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"Insured not found"}), 404
 
 
-    list = []
     # TODO Check for maximum number of items can be returned based on the configured value.
-    for i in iData:
-        x = OrderedDict([("name", i.name), ("value", i.value)])
-        attr = {i.name:x}
-        list.append(attr)
+    list = _insuredAttributes(values)
 
-    return json.dumps(OrderedDict([("status", "success"), ("insurediD", insuredID), \
+    # the id as a number in text, /get/001 and /get/1 share the cached response
+    return json.dumps(OrderedDict([("status", "success"), ("insurediD", "%s" % _insuredNumber(insuredID)), \
                     ("insuranceType", insuranceType), ("attributes", list)])), 200
 
 
 
-def getAllInsured(insuranceType):
+# attributes of an insured in the getOneInsured format, values as stored text
+def _insuredAttributes(values):
+    list = []
+    for name, value in values.items():
+        x = OrderedDict([("name", name), ("value", value if isinstance(value, str) or value is None else str(value))])
+        attr = {name:x}
+        list.append(attr)
+    return list
+
+
+
+# maximum number of insured returned by one multi-get request
+MAX_MULTI_GET = 1000
+
+# number of ids bound in one IN clause, below SQLite's variable limit
+IN_CHUNK_SIZE = 500
+
+# get many insured details
+def getManyInsured(insuranceType, jsonObj):
     """
-    Get All Insured for an insurance type
+    Get details of many Insured to an Insurance Type,
+    data: {"insuredIDs":[1, 2, 3]} or {"from":1, "to":100}
     """
-    
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+    session = Session()
 
-    # check for insurance type exist
     try:
-        insurance = session.query(Insurance).filter(Insurance.type == insuranceType).one()
-    except exc.SQLAlchemyError as e:
-        return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
+        try:
+            insurance = schemaCache.get(session, insuranceType)
+        except exc.SQLAlchemyError as e:
+            return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
+
+        # check for a list of ids or an id range in jsonObj
+        try:
+            if "insuredIDs" in jsonObj:
+                insuredIDs = [int(i) for i in jsonObj["insuredIDs"]]
+                ranges = [insuredIDs[i:i + IN_CHUNK_SIZE] for i in range(0, len(insuredIDs), IN_CHUNK_SIZE)]
+            elif "from" in jsonObj and "to" in jsonObj:
+                insuredIDs = None
+                first, last = int(jsonObj["from"]), int(jsonObj["to"])
+                if last < first:
+                    return json.dumps({"status":"error", "message":"Invalid request"}), 400
+                ranges = [(first, last)]
+            else:
+                return json.dumps({"status":"error", "message":"Invalid request"}), 400
+        except (TypeError, ValueError):
+            return json.dumps({"status":"error", "message":"Invalid request"}), 400
+
+        if insuredIDs is not None and len(insuredIDs) > MAX_MULTI_GET:
+            return json.dumps({"status":"error", "message":"Too many insured requested"}), 400
+
+        # getting insured and their data with one query per id chunk
+        insured = OrderedDict()
+        try:
+            for ids in ranges:
+                if insuredIDs is None:
+                    rows = storage.many(session, insurance, first=ids[0], last=ids[1])
+                else:
+                    rows = storage.many(session, insurance, ids)
+                for ID, values in rows:
+                    if ID not in insured and len(insured) == MAX_MULTI_GET:
+                        return json.dumps({"status":"error", "message":"Too many insured requested"}), 400
+                    insured[ID] = values
+        except exc.SQLAlchemyError as e:
+            return json.dumps({"status":"error", "message":"DB error"})
+    finally:
+        session.close()
+
+    results = []
+    for insuredID, values in insured.items():
+        results.append(OrderedDict([("insurediD", insuredID), ("insuranceType", insuranceType), \
+                    ("attributes", _insuredAttributes(values))]))
+
+    response = OrderedDict([("status", "success"), ("insured", results)])
+    if insuredIDs is not None:
+        response["notFound"] = [i for i in OrderedDict.fromkeys(insuredIDs) if i not in insured]
+
+    return json.dumps(response), 200
+
+
+
+# number of insured ids fetched per query when streaming
+STREAM_CHUNK_SIZE = 1000
+
+# search predicates on insured attributes, ranges only apply to int attributes
+SEARCH_OPERATORS = {
+    "=": lambda column, value: column == value,
+    "!=": lambda column, value: column != value,
+    "<": lambda column, value: column < value,
+    "<=": lambda column, value: column <= value,
+    ">": lambda column, value: column > value,
+    ">=": lambda column, value: column >= value,
+    "in": lambda column, values: column.in_(values),
+    "between": lambda column, values: column.between(values[0], values[1]),
+}
+RANGE_OPERATORS = ("<", "<=", ">", ">=", "between")
+
+# default and maximum number of insured ids returned by one search page
+MAX_SEARCH_LIMIT = 1000
+
+# search insured by attribute values
+def searchInsured(insuranceType, jsonObj):
+    """
+    Search Insured of an Insurance Type by attribute values,
+    data: {"filters":[{"attributeName":"age", "op":">", "value":60}], "limit":100, "after":0}
+    op is one of =, !=, <, <=, >, >=, in ([values]) and between ([low, high])
+    """
+    session = Session()
+
+    try:
+        try:
+            insurance = schemaCache.get(session, insuranceType)
+        except exc.SQLAlchemyError as e:
+            return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
+
+        # check for "filters" and the page in jsonObj
+        filters = jsonObj.get("filters")
+        if not isinstance(filters, list) or not filters:
+            return json.dumps({"status":"error", "message":"Invalid request"}), 400
+        try:
+            limit = int(jsonObj.get("limit", MAX_SEARCH_LIMIT))
+            after = int(jsonObj["after"]) if jsonObj.get("after") is not None else None
+        except (TypeError, ValueError):
+            return json.dumps({"status":"error", "message":"Invalid request"}), 400
+        if limit <= 0 or limit > MAX_SEARCH_LIMIT:
+            return json.dumps({"status":"error", "message":"Invalid request"}), 400
+
+        query = session.query(Insured.id).filter(and_(Insured.insuranceID == insurance.id, Insured.deleted.is_(None)))
+
+        # one indexed predicate of the storage per filter
+        for f in filters:
+            if not isinstance(f, dict) or "attributeName" not in f or "value" not in f:
+                return json.dumps({"status":"error", "message":"Invalid request"}), 400
+            name, op = f["attributeName"], f.get("op", "=")
+            # check for attribute names and operators given as strings
+            if not isinstance(name, str) or not isinstance(op, str):
+                return json.dumps({"status":"error", "message":"Invalid request"}), 400
+            if name not in insurance.attributes:
+                return json.dumps({"status":"error", "message":"%s attribute not exist for Inurance type" % name}), 404
+            dataType = insurance.attributes[name].dataType
+            if op not in SEARCH_OPERATORS or (op in RANGE_OPERATORS and dataType != "int"):
+                return json.dumps({"status":"error", "message":"Invalid request"}), 400
+
+            try:
+                if op in ("in", "between"):
+                    value = [insurance.validator.coerce(name, v) for v in f["value"]]
+                    if op == "between" and len(value) != 2:
+                        raise ValueError(op)
+                else:
+                    value = insurance.validator.coerce(name, f["value"])
+            except (TypeError, ValueError):
+                return json.dumps({"status":"error", "message":"Invalid request"}), 400
+
+            query = storage.filter(query, insurance, name, op, value)
+
+        if after is not None:
+            query = query.filter(Insured.id > after)
+
+        try:
+            ID = [row[0] for row in query.order_by(Insured.id).limit(limit)]
+        except exc.SQLAlchemyError as e:
+            return json.dumps({"status":"error", "message":"DB error"})
+    finally:
+        session.close()
+
+    return json.dumps(OrderedDict([("status", "success"), ("type", insurance.type), ("insuredID", ID), \
+                    ("next", ID[-1] if len(ID) == limit else None)])), 200
+
+
+
+# getting one keyset page of insured ids for an insurance type
+def _insuredIDPage(session, insuranceID, after=None, limit=None):
+    rows = session.execute(SELECT_INSURED_IDS[after is not None, limit is not None], {"insuranceID": insuranceID, \
+                    "after": after, "limit": limit}, mapper=Insured)
+    return [row[0] for row in rows]
+
+
+# streaming all insured ids of an insurance type, one chunk at a time
+def _streamInsuredIDs(insurance, after=None):
+    # runs after the request teardown, so it uses its own session
+    session = SessionFactory()
+    _route(session, insurance)
+    try:
+        yield '{"status": "success", "type": %s, "insuredID": [' % json.dumps(insurance.type)
+        separator = ""
+        while True:
+            ID = _insuredIDPage(session, insurance.id, after, STREAM_CHUNK_SIZE)
+            if not ID:
+                break
+            yield separator + ", ".join(str(i) for i in ID)
+            separator = ", "
+            after = ID[-1]
+        yield "]}"
+    finally:
+        session.close()
+
+
+def getAllInsured(insuranceType, limit=None, after=None, stream=False):
+    """
+    Get All Insured for an insurance type,
+    a page of 'limit' ids after the id 'after' when limit is given, streamed in chunks when stream is set
+    """
     
-    # getting all insured for an insurance type
+    session = Session()
+
+    try:
+        # check for insurance type exist
+        try:
+            insurance = schemaCache.get(session, insuranceType)
+        except exc.SQLAlchemyError as e:
+            return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
+
+        if stream:
+            return Response(_streamInsuredIDs(insurance, after), status=200, mimetype='application/json')
+
+        # getting insured ids for an insurance type
+        try:
+            ID = _insuredIDPage(session, insurance.id, after, limit)
+        except exc.SQLAlchemyError as e:
+            return json.dumps({"status":"error", "message":"DB error"})
+    finally:
+        session.close()
+
+    response = OrderedDict([("status", "success"),("type", insurance.type),("insuredID",ID)])
+    if limit is not None:
+        # cursor for the next page, None on the last page
+        response["next"] = ID[-1] if len(ID) == limit else None
+
+    return json.dumps(response), 200
+
+
+# buckets of a histogram and most frequent values of an attribute in the statistics, by default and at most
+STATS_BUCKETS = 10
+STATS_TOP = 20
+MAX_STATS_BUCKETS = 1000
+
+# statistics of the values of one attribute, computed with GROUP BYs over the storage
+def _attributeStats(session, insurance, name, buckets=None, bucketSize=None, top=None):
+    attribute = insurance.attributes[name]
+    value, query = storage.valueQuery(session, insurance, name)
+    stats = OrderedDict([("name", name), ("dataType", attribute.dataType)])
+
+    # most frequent values of string and enum attributes
+    if attribute.dataType != "int":
+        counted = func.count(value)
+        stats["count"], stats["distinct"] = query.with_entities(counted, func.count(value.distinct())).one()
+        stats["top"] = [OrderedDict([("value", v), ("count", c)]) for v, c in \
+                        query.with_entities(value, counted).group_by(value).order_by(counted.desc(), value) \
+                        .limit(top or STATS_TOP)]
+        return stats
+
+    value = type_coerce(value, Integer)
+    count, low, high, total = query.with_entities(func.count(value), func.min(value), func.max(value), \
+                    func.sum(value)).one()
+    stats.update([("count", count), ("min", low), ("max", high), ("sum", total or 0), \
+                  ("avg", float(total) / count if count else None), ("histogram", [])])
+    if not count:
+        return stats
+
+    # buckets of bucketSize values from the minimum, the size of 'buckets' buckets by default
+    if bucketSize is None:
+        bucketSize = max(1, -(-(high - low + 1) // (buckets or STATS_BUCKETS)))
+    if (high - low) // bucketSize + 1 > MAX_STATS_BUCKETS:
+        raise ValueError("buckets")
+    bucket = (value - low) / bucketSize
+    rows = query.with_entities(bucket, func.count(value)).group_by(bucket).order_by(bucket)
+    stats["histogram"] = [OrderedDict([("from", low + b * bucketSize), ("to", low + (b + 1) * bucketSize - 1), \
+                          ("count", c)]) for b, c in rows]
+    return stats
+
+
+def getStats(insuranceType, attribute=None, buckets=None, bucketSize=None, top=None):
+    """
+    Statistics of the insured of an insurance type: their number and, for every attribute, the insured
+    having it and the sum and average of int values, read from the summary counters when they are kept.
+    With an attribute: count, min, max, sum, avg and histogram of an int attribute,
+    count, distinct and most frequent values of a string or enum attribute
+    """
+    session = Session()
+
+    try:
+        try:
+            insurance = schemaCache.get(session, insuranceType)
+        except exc.SQLAlchemyError as e:
+            return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
+
+        # check for attribute exist for insurance type
+        if attribute is not None:
+            if attribute not in insurance.attributes:
+                return json.dumps({"status":"error", "message":attribute + " attribute not found"}), 404
+            try:
+                stats = _attributeStats(session, insurance, attribute, buckets, bucketSize, top)
+            except ValueError:
+                return json.dumps({"status":"error", "message":"Invalid request"}), 400
+            except exc.SQLAlchemyError as e:
+                return json.dumps({"status":"error", "message":"DB error"})
+            return json.dumps(OrderedDict([("status", "success"), ("insuranceType", insurance.type), \
+                            ("attribute", stats)])), 200
+
+        try:
+            if STATS_COUNTERS:
+                counters = dict((name, (count, total)) for name, count, total in \
+                                session.query(AttributeStats.name, AttributeStats.count, AttributeStats.total) \
+                                .filter(AttributeStats.insuranceID == insurance.id))
+                insured = counters.pop(None, (0, 0))[0]
+            else:
+                counters = storage.summary(session, insurance)
+                insured = session.query(func.count(Insured.id)).filter(and_(Insured.insuranceID == insurance.id, \
+                            Insured.deleted.is_(None))).scalar()
+        except exc.SQLAlchemyError as e:
+            return json.dumps({"status":"error", "message":"DB error"})
+    finally:
+        session.close()
+
+    attributes = []
+    for name, attr in insurance.attributes.items():
+        count, total = counters.get(name, (0, 0))
+        item = OrderedDict([("name", name), ("dataType", attr.dataType), ("count", count)])
+        if attr.dataType == "int":
+            item["sum"] = total
+            item["avg"] = float(total) / count if count else None
+        attributes.append(item)
+
+    return json.dumps(OrderedDict([("status", "success"), ("insuranceType", insurance.type), ("insured", insured), \
+                    ("source", "counters" if STATS_COUNTERS else "query"), ("attributes", attributes)])), 200
+
+
+# changes returned in one page of the change feed at most
+CHANGES_PAGE_SIZE = 1000
+
+# a page of 'limit' changes after the position 'since', of an insurance type or all of them: the changes
+# of insured are logged in the database of their type, each database numbers its changes; the page takes
+# the changes of every database in the order of their sequence, so a position never passes an unread
+# change, and only interleaves the databases by time; returns the changes and the position after them
+def _changesPage(session, since, insuranceType=None, limit=CHANGES_PAGE_SIZE):
+    pending = []
+    for shard in [None] + shardsInUse(session):
+        session.info["shard"] = shard
+        # plain rows, the sequences of the databases overlap
+        query = select([Change.__table__]).where(Change.id > since.get(shard, 0))
+        if insuranceType is not None:
+            query = query.where(Change.insuranceType == insuranceType)
+        rows = session.execute(query.order_by(Change.id).limit(limit), mapper=Change).fetchall()
+        if rows:
+            pending.append((shard, deque(rows)))
+
+    position = dict(since)
+    changes = []
+    while pending and len(changes) < limit:
+        # the oldest of the next change of each database, created is stamped before the write lock
+        # so it only orders the databases, never the changes of one of them
+        order = min(range(len(pending)), key=lambda order: (pending[order][1][0].created, order))
+        shard, rows = pending[order]
+        change = rows.popleft()
+        position[shard] = change.id
+        changes.append((shard, change))
+        if not rows:
+            del pending[order]
+    return changes, position
+
+
+# position of the change feed from the 'since' argument: the sequence of the main database,
+# followed by shard:sequence for the shard databases, as in "120,0:55,3:9"
+def _changesPosition(value):
+    parts = value.split(",")
+    position = {None: int(parts[0])}
+    for part in parts[1:]:
+        shard, sequence = part.split(":")
+        position[int(shard)] = int(sequence)
+    if any(sequence < 0 for sequence in position.values()):
+        raise ValueError(value)
+    return position
+
+
+# 'next' of the change feed: the sequence of the main database alone while no shard logged a change
+def _positionJson(position):
+    shards = sorted((shard, sequence) for shard, sequence in position.items() if shard is not None and sequence)
+    if not shards:
+        return position.get(None, 0)
+    return ",".join([str(position.get(None, 0))] + ["%d:%d" % shard for shard in shards])
+
+
+def _changeJson(shard, change):
+    item = OrderedDict([("sequence", change.id), ("kind", change.kind), ("insuranceType", change.insuranceType)])
+    if shard is not None:
+        item["shard"] = shard
+    if change.insuredID is not None:
+        item["insuredID"] = change.insuredID
+    if change.data is not None:
+        item["data"] = json.loads(change.data, object_pairs_hook=OrderedDict)
+    item["created"] = change.created.isoformat()
+    return item
+
+
+# streaming all changes after the position 'since', one page at a time
+def _streamChanges(since, insuranceType=None):
+    # runs after the request teardown, so it uses its own session
+    session = SessionFactory()
+    try:
+        yield '{"status": "success", "changes": ['
+        separator = ""
+        while True:
+            changes, since = _changesPage(session, since, insuranceType, STREAM_CHUNK_SIZE)
+            if not changes:
+                break
+            yield separator + ", ".join(json.dumps(_changeJson(shard, change)) for shard, change in changes)
+            separator = ", "
+        yield '], "next": %s}' % json.dumps(_positionJson(since))
+    finally:
+        session.close()
+
+
+def getChanges(since=None, insuranceType=None, limit=CHANGES_PAGE_SIZE, stream=False):
+    """
+    Get the changes of insurance types and insured after the position 'since', oldest first,
+    "next" is the position to ask the following changes from, streamed in pages when stream is set
+    """
+    since = since or {}
+    if stream:
+        return Response(_streamChanges(since, insuranceType), status=200, mimetype='application/json')
+
+    session = Session()
     try:
-        iData = session.query(Insured).filter(insurance.id == Insured.insuranceID).all()
+        changes, position = _changesPage(session, since, insuranceType, limit)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"DB error"})
+    finally:
+        session.close()
+
+    return json.dumps(OrderedDict([("status", "success"), \
+                    ("changes", [_changeJson(shard, change) for shard, change in changes]), \
+                    ("next", _positionJson(position)), ("more", len(changes) == limit)])), 200
+
 
-    ID = []
-    if not len(iData):
-        return json.dumps(OrderedDict([("status", "success"),("type", insurance.type),("insuredID",ID)])), 200
+# content types of the export formats
+EXPORT_FORMATS = OrderedDict([("csv", "text/csv"), ("ndjson", "application/x-ndjson")])
 
+# size of the chunks an export is written in, in characters
+EXPORT_BUFFER_SIZE = 65536
 
-    for i in iData:
-        ID.append(i.id)
+# one line per insured in csv or ndjson, written in chunks of EXPORT_BUFFER_SIZE
+def _exportLines(session, insurance, exportFormat):
+    columns = list(insurance.attributes)
+    buffer = io.StringIO()
+    if exportFormat == "csv":
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(["insuredID"] + columns)
+        write = lambda insuredID, values: writer.writerow([insuredID] + [values.get(name, "") for name in columns])
+    else:
+        write = lambda insuredID, values: buffer.write(json.dumps(OrderedDict([("insuredID", insuredID)] + \
+                        [(name, values.get(name)) for name in columns])) + "\n")
+
+    # one scan of the insured ordered by id, constant memory
+    for insuredID, values in storage.scan(session, insurance, chunkSize=STREAM_CHUNK_SIZE):
+        write(insuredID, values)
+        if buffer.tell() >= EXPORT_BUFFER_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# streaming the export of an insurance type
+def _streamExport(insurance, exportFormat):
+    # runs after the request teardown, so it uses its own session
+    session = SessionFactory()
+    _route(session, insurance)
+    try:
+        for chunk in _exportLines(session, insurance, exportFormat):
+            yield chunk
+    finally:
+        session.close()
 
-    return json.dumps(OrderedDict([("status", "success"),("type", insurance.type),("insuredID",ID)])), 200
+
+def exportInsured(insuranceType, exportFormat="csv"):
+    """
+    Export all Insured of an insurance type, one row per insured and one column per attribute,
+    streamed as csv or ndjson
+    """
+    if exportFormat not in EXPORT_FORMATS:
+        return json.dumps({"status":"error", "message":"Invalid request"}), 400
+
+    session = Session()
+
+    try:
+        # check for insurance type exist
+        try:
+            insurance = schemaCache.get(session, insuranceType)
+        except exc.SQLAlchemyError as e:
+            return json.dumps({"status":"error", "message":"Insurance Type not found"}), 404
+    finally:
+        session.close()
+
+    response = Response(_streamExport(insurance, exportFormat), status=200, mimetype=EXPORT_FORMATS[exportFormat])
+    response.headers["Content-Disposition"] = "attachment; filename=%s.%s" % (insurance.type, exportFormat)
+    return response
 
 
 def updateInsured(insuranceType, insuredID, jsonObj):
@@ -408,13 +2357,11 @@ def updateInsured(insuranceType, insuredID, jsonObj):
     Update attribute value of insured to an insurance type
     data: {"attributes":{"attributeName":"fullName", "attributeValue":"fullname1_modified"}}
     """
-    Base.metadata.bind = engine
-    DBSession = sessionmaker()
-    session = DBSession()
+    session = Session()
 
     # check for insurance type exists
     try:
-        insurance = session.query(Insurance).filter(Insurance.type == insuranceType).one()
+        insurance = schemaCache.get(session, insuranceType)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"failure", "message":"Insurance Type not found"}), 404
 
@@ -424,92 +2371,134 @@ def updateInsured(insuranceType, insuredID, jsonObj):
     attribute = jsonObj["attributes"]
 
     # check for "attributeName", "attributeValue" in attributes
-    if "attributeName" not in attribute.keys() or "attributeValue" not in attribute.keys():
+    if not isinstance(attribute, dict) or "attributeName" not in attribute.keys() or \
+            "attributeValue" not in attribute.keys() or not isinstance(attribute["attributeName"], str):
         return json.dumps({"status":"error", "message":"Invalid request"}), 400
 
 
     # check for insuredID exists
     try:
-        insured = session.query(Insured).filter(Insured.id == insuredID).one()
+        insured = _insuredRow(session, insuredID)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"failure", "message":"Insured not found"}), 404
 
     if insured.insuranceID != insurance.id:
         return json.dumps({"status":"failure", "message":"Insured not found"}), 404
 
-    # getting insurance attributes
-    try:
-        iattr = session.query(InsuranceAttribute).filter(InsuranceAttribute.insuranceID == insurance.id).all()
-    except exc.SQLAlchemyError as e:
-        return json.dumps({"status":"error", "message": "DB error"})
-
-    insurance_attributes = []
-    for attr in iattr:
-        insurance_attributes.append(attr.name)
-
     # check for attributeName exist for insurance type
-    if attribute["attributeName"] not in insurance_attributes:
+    if attribute["attributeName"] not in insurance.attributes:
         return json.dumps({"status":"error","message":attribute["attributeName"] + " not found for insurance type"}), 404
 
-    # getting all attributes added to insured
+    # check for valid datatype of attribute value
+    try:
+        value = insurance.validator.coerce(attribute["attributeName"], attribute["attributeValue"])
+    except (TypeError, ValueError):
+        return json.dumps({"status":"error", "message":"Invalid data Type"}), 400
+
+    # update the attribute of the insured, or add it
+    insuredID, values = insured.id, {attribute["attributeName"]: value}
+    def write(session):
+        # insured first, then the counters in the same database, the lock order of all writes
+        previous = {}
+        if STATS_COUNTERS:
+            _lockInsured(session)
+            previous = _storedValues(session, insurance, insuredID)
+        storage.update(session, insurance, insuredID, values)
+        _countStats(session, insurance, added=[values], removed=[{name: previous[name] \
+                    for name in values if name in previous}])
+        _logChanges(session, [("insuredUpdated", insurance.type, insuredID, values)])
+
     try:
-        iData = session.query(insuredData).filter(insuredData.insuredID == insured.id).all()
+        _write(session, write)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"DB error"})
 
-    insured_attributes = []
-    for i in iData:
-        insured_attributes.append(i.name)
+    _insuredChanged(insuranceType, insuredID)
+    return json.dumps({"status":"success"}), 200
 
 
-    # getting insurance attribute
+
+# update many attributes of an insured at once
+def updateInsuredAttributes(insuranceType, insuredID, jsonObj):
+    """
+    Update many attribute values of insured to an insurance type in one transaction,
+    data: {"attributes":[{"attributeName":"fullName", "attributeValue":"fullname1_modified"}, ...]}
+    """
+    session = Session()
+
+    # check for insurance type exists
     try:
-        iattr = session.query(InsuranceAttribute).filter(and_(InsuranceAttribute.insuranceID == insurance.id,InsuranceAttribute.name == attribute["attributeName"])).one()
+        insurance = schemaCache.get(session, insuranceType)
     except exc.SQLAlchemyError as e:
-        return json.dumps({"status":"error","message":"DB error"})
+        return json.dumps({"status":"failure", "message":"Insurance Type not found"}), 404
 
+    # check for a list of "attributeName", "attributeValue" in jsonObj
+    if "attributes" not in jsonObj or not isinstance(jsonObj["attributes"], list) or not jsonObj["attributes"]:
+        return json.dumps({"status":"failure", "message":"Invalid request"}), 400
 
-    # check for valid datatype of attribute value
-    if iattr.dataType == "int":
+    # validate every attribute against the cached attribute types before writing
+    values = OrderedDict()
+    results = []
+    seen = set()
+    for attribute in jsonObj["attributes"]:
+        if not isinstance(attribute, dict) or "attributeName" not in attribute or "attributeValue" not in attribute \
+                or not isinstance(attribute["attributeName"], str):
+            return json.dumps({"status":"failure", "message":"Invalid request"}), 400
+
+        name = attribute["attributeName"]
+        result = OrderedDict([("attributeName", name), ("status", "success")])
+        results.append(result)
+        if name in seen:
+            result["status"], result["message"] = "error", "duplicate attribute"
+            continue
+        seen.add(name)
+
+        if name not in insurance.attributes:
+            result["status"], result["message"] = "error", "not found for insurance type"
+            continue
         try:
-            value = int(attribute["attributeValue"])
-        except ValueError:
-            return json.dumps({"status":"error", "message":"Invalid data Type"}), 400
-    elif iattr.dataType == "enum":
-        value = attribute["attributeValue"]
-    elif iattr.dataType == "string":
-        value = attribute["attributeValue"]
-    else:
-        return json.dumps({"status":"error", "message":"data type not found"}), 404
+            values[name] = insurance.validator.coerce(name, attribute["attributeValue"])
+        except (TypeError, ValueError):
+            result["status"], result["message"] = "error", "Invalid data Type"
+
+    # nothing is written unless all attributes are valid
+    if len(values) != len(results):
+        return json.dumps(OrderedDict([("status", "failure"), ("results", results)])), 400
 
-    # if attribute found in insured attributes
-    if attribute["attributeName"] in insured_attributes:
-        # getting insured data
+    try:
+        # check for insuredID exists
         try:
-            iData = session.query(insuredData).filter(and_(insuredData.insuredID == insured.id, insuredData.name == attribute["attributeName"])).one()
+            insured = _insuredRow(session, insuredID)
         except exc.SQLAlchemyError as e:
-            return json.dumps({"status":"error", "message":"Attribute not found"}), 404
+            return json.dumps({"status":"failure", "message":"Insured not found"}), 404
+
+        if insured.insuranceID != insurance.id:
+            return json.dumps({"status":"failure", "message":"Insured not found"}), 404
+
+        # update the attributes already added to insured, add the others
+        def write(session):
+            previous = {}
+            if STATS_COUNTERS:
+                _lockInsured(session)
+                previous = _storedValues(session, insurance, insuredID)
+            existing = storage.update(session, insurance, insuredID, values)
+            _countStats(session, insurance, added=[values], removed=[{name: previous[name] \
+                        for name in values if name in previous}])
+            _logChanges(session, [("insuredUpdated", insurance.type, int(insuredID), values)])
+            return existing
 
         try:
-            iData.value = value
-            session.add(iData)
-            session.commit()
+            existing = _write(session, write)
         except exc.SQLAlchemyError as e:
-            session.rollback()
             return json.dumps({"status":"error", "message":"DB error"})
-    else:
-        newAttr = insuredData()
-        newAttr.insuredID = insured.id
-        newAttr.name = attribute["attributeName"]
-        newAttr.value = value
-        try:
-            session.add(newAttr)
-            session.commit()
-        except exc.SQLAlchemyError as e:
-            session.rollback()
-            return json.dumps({"status":"error","message":"DB error"})
 
-    return json.dumps({"status":"success"}), 200
+        for result in results:
+            result["action"] = "updated" if result["attributeName"] in existing else "added"
+    finally:
+        session.close()
+
+    _insuredChanged(insuranceType, insuredID)
+    return json.dumps(OrderedDict([("status", "success"), ("results", results)])), 200
 
 
 
@@ -518,59 +2507,221 @@ def deleteInsured(insuranceType, insuredID):
     Delete Insured to an Insurance Type
     """
     
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+    session = Session()
 
     try:
-        insurance = session.query(Insurance).filter(Insurance.type == insuranceType).one()
+        insurance = schemaCache.get(session, insuranceType)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"Insurance type not found"}), 404
 
     try:
-        insured = session.query(Insured).filter(Insured.id == insuredID).one()
+        insured = _insuredRow(session, insuredID)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"Insured not found"}), 404
 
     if insured.insuranceID != insurance.id:
         return json.dumps({"status":"failure", "message":"Insured not found for insurance type" + " " + insurance.type}), 404
 
-    # Delete insurenceData and insuedID
+    # Delete insurenceData and insuedID, or only mark the insured deleted for the purger
+    def write(session):
+        removed = []
+        if STATS_COUNTERS:
+            _lockInsured(session)
+            removed = [_storedValues(session, insurance, insuredID)]
+        if SOFT_DELETE:
+            deleted = session.execute(MARK_DELETED, {"insuredID": int(insuredID), \
+                        "deletedAt": datetime.datetime.utcnow()}).rowcount
+        else:
+            deleted = storage.delete(session, insuredID)
+        # deleted meanwhile by a concurrent request, which counted and logged it
+        if not deleted:
+            return
+        _countStats(session, insurance, removed=removed, insured=-1)
+        _logChanges(session, [("insuredDeleted", insurance.type, int(insuredID), None)])
+
     try:
-        iDataDeletedRows = session.query(insuredData).filter(insuredData.insuredID == insuredID).delete()
-        deleteInsuredID = session.query(Insured).filter(Insured.id == insuredID).delete()
-        session.commit()
+        _write(session, write)
     except exc.SQLAlchemyError as e:
-        session.rollback()
         return json.dumps({"status":"failure", "message":"DB Error"})
     finally:
         session.close()
 
+    _insuredChanged(insuranceType, insuredID)
     return json.dumps({"status":"success"}), 200
 
 
 
-def deleteType(insuranceType):
+# check for any insured of an insurance type with one query
+def _typeInUse(session, insuranceID):
+    return session.execute(SELECT_TYPE_IN_USE, {"insuranceID": insuranceID}, mapper=Insured).first() is not None
+
+
+# check for any value of an attribute with one query
+def _attributeInUse(session, insuranceID, name):
+    return storage.attributeInUse(session, insuranceID, name)
+
+
+
+# number of rows deleted in one transaction by a job
+PURGE_CHUNK_SIZE = 1000
+
+class JobError(Exception):
     """
-    Delete Insurance Type
+    A job stopped for a reason reported to the client
     """
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+
+
+# run a job in a background thread, work(session, job) commits its own progress
+def _startJob(kind, insuranceType, params, work):
+    session = Session()
+    job = Job(kind=kind, insuranceType=insuranceType, params=json.dumps(params), status="queued", processed=0)
+    session.add(job)
+    session.commit()
+    jobID = job.id
+
+    thread = threading.Thread(target=_runJob, args=(jobID, work), name="job-%d" % jobID)
+    thread.daemon = True
+    thread.start()
+    return jobID
+
+
+def _runJob(jobID, work):
+    session = SessionFactory()
+    try:
+        job = session.query(Job).get(jobID)
+        job.status, job.updated = "running", datetime.datetime.utcnow()
+        session.commit()
+
+        work(session, job)
+
+        job.status, job.updated = "done", datetime.datetime.utcnow()
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        job = session.query(Job).get(jobID)
+        job.status, job.updated = "failed", datetime.datetime.utcnow()
+        job.message = str(e) if isinstance(e, JobError) else "DB error" if isinstance(e, exc.SQLAlchemyError) else "Unknown"
+        session.commit()
+    finally:
+        session.close()
+
+
+# delete the rows selected by idQuery in chunks, one commit per chunk
+def _purgeRows(session, job, model, idQuery):
+    while True:
+        ids = [row[0] for row in idQuery.limit(PURGE_CHUNK_SIZE)]
+        if not ids:
+            break
+        session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        job.processed += len(ids)
+        job.updated = datetime.datetime.utcnow()
+        session.commit()
+
+
+# mark the live insured of a type deleted for the purger, one commit per chunk
+def _markTypeDeleted(session, job, insuranceID):
+    idQuery = session.query(Insured.id).filter(and_(Insured.insuranceID == insuranceID, Insured.deleted.is_(None)))
+    job.total = idQuery.count()
+    session.commit()
+    while True:
+        ids = [row[0] for row in idQuery.limit(PURGE_CHUNK_SIZE)]
+        if not ids:
+            break
+        session.query(Insured).filter(Insured.id.in_(ids)) \
+                    .update({"deleted": datetime.datetime.utcnow()}, synchronize_session=False)
+        job.processed += len(ids)
+        job.updated = datetime.datetime.utcnow()
+        session.commit()
+
+
+def _deleteTypeJob(insuranceType, insuranceID, shard, purge):
+    def work(session, job):
+        session.info["shard"] = shard
+        if purge and SOFT_DELETE:
+            _markTypeDeleted(session, job, insuranceID)
+        elif purge:
+            storage.purgeType(session, job, insuranceID)
+        elif _typeInUse(session, insuranceID):
+            raise JobError("Insured depends on insurance type")
+
+        session.query(InsuranceAttribute).filter(InsuranceAttribute.insuranceID == insuranceID).delete()
+        session.query(Insurance).filter(Insurance.id == insuranceID).delete()
+        _dropStats(session, insuranceID)
+        _logChanges(session, [("typeDeleted", insuranceType, None, None)])
+        session.commit()
+        _schemaChanged(insuranceType, typeList=True)
+    return work
+
+
+def _deleteAttributeJob(insuranceType, insuranceID, shard, name, purge):
+    def work(session, job):
+        session.info["shard"] = shard
+        if purge:
+            storage.purgeAttribute(session, job, insuranceID, name)
+        elif _attributeInUse(session, insuranceID, name):
+            raise JobError(name + " attribute is busy for an insurance type")
+
+        session.query(InsuranceAttribute).filter(and_(InsuranceAttribute.insuranceID == insuranceID, \
+                    InsuranceAttribute.name == name)).delete()
+        _dropStats(session, insuranceID, name)
+        _logChanges(session, [("attributeDeleted", insuranceType, None, {"name": name})])
+        session.commit()
+        _schemaChanged(insuranceType)
+    return work
+
+
+# get the status of a job
+def getJob(jobID):
+    """
+    Get status and progress of a background job
+    """
+    session = Session()
+
+    try:
+        job = session.query(Job).filter(Job.id == jobID).one()
+    except exc.SQLAlchemyError as e:
+        return json.dumps({"status":"error", "message":"Job not found"}), 404
+    finally:
+        session.close()
+
+    return json.dumps(OrderedDict([("status", "success"), ("job", OrderedDict([ \
+                    ("id", job.id), ("kind", job.kind), ("insuranceType", job.insuranceType), \
+                    ("params", json.loads(job.params or "{}")), ("state", job.status), \
+                    ("processed", job.processed), ("total", job.total), ("message", job.message), \
+                    ("created", job.created.isoformat()), ("updated", job.updated.isoformat())]))])), 200
+
+
+
+def deleteType(insuranceType, runAsync=False, purge=False):
+    """
+    Delete Insurance Type,
+    as a background job when runAsync is set, purge also deletes all insured of the type
+    """
+    session = Session()
 
     # check for insurance type
     try:
-        insurance = session.query(Insurance).filter(Insurance.type == insuranceType).one()
+        insurance = schemaCache.get(session, insuranceType)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"Insurance type not found"}), 404
 
+    # deletes on large insurance types run as chunked background jobs
+    if runAsync or purge:
+        try:
+            jobID = _startJob("deleteType", insuranceType, {"purge": purge}, \
+                        _deleteTypeJob(insuranceType, insurance.id, insurance.shard, purge))
+        except exc.SQLAlchemyError as e:
+            session.rollback()
+            return json.dumps({"status":"error", "message":"DB error"})
+        return json.dumps({"status":"accepted", "jobID":jobID}), 202
+
     # check for weather any insured values for insurance type
     try:
-        iData = session.query(Insured).filter(Insured.insuranceID == insurance.id).all()
+        inUse = _typeInUse(session, insurance.id)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error", "message":"DB error"})
 
-    if iData:
+    if inUse:
         return json.dumps({"status":"error", "message":"Insured depends on insurance type"})
 
 
@@ -578,23 +2729,28 @@ def deleteType(insuranceType):
     try:
         deletedRows = session.query(Insurance).filter(Insurance.type == insuranceType).delete()
         aData = session.query(InsuranceAttribute).filter(InsuranceAttribute.insuranceID == insurance.id).delete()
+        _dropStats(session, insurance.id)
+        _logChanges(session, [("typeDeleted", insuranceType, None, None)])
         session.commit()
     except exc.SQLAlchemyError as e:
         session.rollback()
         return json.dumps({"status":"error", "message":"DB error"})
+    finally:
+        session.close()
+
+    _schemaChanged(insuranceType, typeList=True)
 
     return json.dumps({"status":"success"}), 200
 
 
 
 
-def deleteAttribute(insuranceType, jsonObj):
+def deleteAttribute(insuranceType, jsonObj, runAsync=False, purge=False):
     """
-    Delete Attribute of Insurance Type
+    Delete Attribute of Insurance Type,
+    as a background job when runAsync is set, purge also deletes the values of the attribute
     """
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+    session = Session()
 
     # check for "name" exist in jsonObj
     if "name" not in jsonObj.keys():
@@ -602,42 +2758,45 @@ def deleteAttribute(insuranceType, jsonObj):
 
     # check for insurance type exist
     try:
-        insurance = session.query(Insurance).filter(Insurance.type == insuranceType).one()
+        insurance = schemaCache.get(session, insuranceType)
     except exc.SQLAlchemyError as e:
         return json.dumps({"status":"error","message":"Insurance Type not found"}), 404
 
     # check for attribute exist for insurance type
-    try:
-        iattr = session.query(InsuranceAttribute).filter(and_(InsuranceAttribute.insuranceID == insurance.id, InsuranceAttribute.name == jsonObj["name"])).one()
-    except exc.SQLAlchemyError as e:
+    if jsonObj["name"] not in insurance.attributes:
         return json.dumps({"status":"error","message":jsonObj["name"] + " attribute not found"}), 404
 
-    # getting insured for an insurance type
-    try:
-        insData = session.query(Insured).filter(Insured.insuranceID == insurance.id).all()
-    except exc.SQLAlchemyError as e:
-        return json.dumps({"status":"error","message":"DB error"})
-
-
-    # check for attribute name in insured data for insurance type
-    for ins in insData:
+    # deletes on large insurance types run as chunked background jobs
+    if runAsync or purge:
         try:
-            iData = session.query(insuredData).filter(and_(insuredData.insuredID == ins.id, insuredData.name == jsonObj["name"])).all()
+            jobID = _startJob("deleteAttribute", insuranceType, {"name": jsonObj["name"], "purge": purge}, \
+                        _deleteAttributeJob(insuranceType, insurance.id, insurance.shard, jsonObj["name"], purge))
         except exc.SQLAlchemyError as e:
+            session.rollback()
             return json.dumps({"status":"error", "message":"DB error"})
+        return json.dumps({"status":"accepted", "jobID":jobID}), 202
+
+    # check for attribute name in insured data for insurance type
+    try:
+        inUse = _attributeInUse(session, insurance.id, jsonObj["name"])
+    except exc.SQLAlchemyError as e:
+        return json.dumps({"status":"error", "message":"DB error"})
 
-        if len(iData):
-            return json.dumps({"status":"error","message":jsonObj["name"] + " attribute is busy for an insurance type" })
+    if inUse:
+        return json.dumps({"status":"error","message":jsonObj["name"] + " attribute is busy for an insurance type" })
 
 
     # delete insurnce attrubute
-    if not len(insData) or not len(iData):
-        try:
-            delRows = session.query(InsuranceAttribute).filter(and_(InsuranceAttribute.insuranceID == insurance.id, InsuranceAttribute.name == jsonObj["name"])).delete()
-            session.commit()
-        except exc.SQLAlchemyError as e:
-            session.rollback()
-            return json.dumps({"status":"error", "message":"DB error"})
+    try:
+        delRows = session.query(InsuranceAttribute).filter(and_(InsuranceAttribute.insuranceID == insurance.id, InsuranceAttribute.name == jsonObj["name"])).delete()
+        _dropStats(session, insurance.id, jsonObj["name"])
+        _logChanges(session, [("attributeDeleted", insuranceType, None, {"name": jsonObj["name"]})])
+        session.commit()
+    except exc.SQLAlchemyError as e:
+        session.rollback()
+        return json.dumps({"status":"error", "message":"DB error"})
+
+    _schemaChanged(insuranceType)
 
     return json.dumps({"status":"success"}), 200
 
@@ -650,16 +2809,30 @@ def deleteAttribute(insuranceType, jsonObj):
 def deleteRiskAttribute(riskId):
     args = request.args
     jsonObj = json.loads(request.data)
-    return deleteAttribute(riskId,jsonObj)
+    return deleteAttribute(riskId,jsonObj, _flagArg(args, "async"), _flagArg(args, "purge"))
+
+
+# boolean query string flag, like ?async=1
+def _flagArg(args, name):
+    return args.get(name, "0").lower() in ("1", "true", "yes")
+
+@app.route('/risk/jobs/<jobID>', methods=['GET'])
+def getRiskJob(jobID):
+    return getJob(jobID)
 
 
 @app.route('/risk/getAll',methods=['GET'])
 def getAllRisks():
-    return getTypes()
+    return responseCache.serve([("types",)], getTypes)
+
+@app.route('/risk/schemaCache',methods=['GET'])
+def getSchemaCacheStats():
+    return json.dumps(OrderedDict([("status", "success"), ("schemaCache", schemaCache.stats()), \
+                ("responseCache", responseCache.stats())])), 200
 
 @app.route('/risk/<riskId>/getAttributes',methods=['GET'])
 def getRiskAttributes(riskId):
-    return getAttributes(riskId)
+    return responseCache.serve([("type", riskId)], lambda: getAttributes(riskId))
 
 @app.route('/risk/<riskId>/addAttribute', methods=['POST'])
 def addRiskAttribute(riskId):
@@ -671,9 +2844,42 @@ def addRiskInsured(riskId):
     jsonObj = json.loads(request.data)
     return addInsured(riskId, jsonObj)
 
+@app.route('/risk/<riskId>/addInsuredBatch', methods=['POST'])
+def addRiskInsuredBatch(riskId):
+    # accept a json list, {"insured": [...]} or one json record per line (NDJSON)
+    try:
+        jsonObj = json.loads(request.data)
+        records = jsonObj["insured"] if isinstance(jsonObj, dict) and "insured" in jsonObj else jsonObj
+    except ValueError:
+        records = []
+        for line in request.data.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                records.append(None)
+
+    if isinstance(records, dict):
+        records = [records]
+    if not isinstance(records, list):
+        return json.dumps({"status":"error", "message":"Invalid request"}), 400
+    return addInsuredBatch(riskId, records)
+
+@app.route('/risk/<riskId>/getMany', methods=['POST'])
+def getManyRiskInsured(riskId):
+    jsonObj = json.loads(request.data)
+    return getManyInsured(riskId, jsonObj)
+
+@app.route('/risk/<riskId>/search', methods=['POST'])
+def searchRiskInsured(riskId):
+    jsonObj = json.loads(request.data)
+    return searchInsured(riskId, jsonObj)
+
 @app.route('/risk/<riskId>/get/<insuredID>', methods=['GET'])
 def getRiskInsured(riskId, insuredID):
-    return getOneInsured(riskId, insuredID)
+    return responseCache.serve([("type", riskId), _insuredKey(riskId, insuredID)], \
+                lambda: getOneInsured(riskId, insuredID), cacheKey=("insured", riskId, _insuredNumber(insuredID)))
 
 
 @app.route('/risk/create', methods=['POST'])
@@ -686,7 +2892,49 @@ def addRisk():
 
 @app.route('/risk/<riskId>/getAll')
 def getAllRiskInsured(riskId):
-    return getAllInsured(riskId)
+    # optional keyset pagination: ?limit=100&after=<last insured id>, or ?stream=1
+    try:
+        limit = int(request.args["limit"]) if "limit" in request.args else None
+        after = int(request.args["after"]) if "after" in request.args else None
+    except ValueError:
+        return json.dumps({"status":"error", "message":"Invalid request"}), 400
+    if limit is not None and limit <= 0:
+        return json.dumps({"status":"error", "message":"Invalid request"}), 400
+    stream = _flagArg(request.args, "stream")
+    return getAllInsured(riskId, limit, after, stream)
+
+
+@app.route('/risk/changes')
+def getRiskChanges():
+    # ?since=<next>&limit=1000, optionally &type=<riskId>, or ?since=<next>&stream=1
+    try:
+        since = _changesPosition(request.args.get("since", "0"))
+        limit = int(request.args.get("limit", CHANGES_PAGE_SIZE))
+    except ValueError:
+        return json.dumps({"status":"error", "message":"Invalid request"}), 400
+    if limit <= 0 or limit > CHANGES_PAGE_SIZE:
+        return json.dumps({"status":"error", "message":"Invalid request"}), 400
+    return getChanges(since, request.args.get("type"), limit, _flagArg(request.args, "stream"))
+
+
+@app.route('/risk/<riskId>/stats')
+def getRiskStats(riskId):
+    # ?attribute=age&buckets=10 or &bucketSize=5 for a histogram, ?attribute=color&top=20
+    try:
+        buckets, bucketSize, top = [int(request.args[name]) if name in request.args else None \
+                                    for name in ("buckets", "bucketSize", "top")]
+    except ValueError:
+        return json.dumps({"status":"error", "message":"Invalid request"}), 400
+    if any(value is not None and not 0 < value <= MAX_STATS_BUCKETS for value in (buckets, top)) or \
+            (bucketSize is not None and bucketSize <= 0):
+        return json.dumps({"status":"error", "message":"Invalid request"}), 400
+    return getStats(riskId, request.args.get("attribute"), buckets, bucketSize, top)
+
+
+@app.route('/risk/<riskId>/export')
+def exportRiskInsured(riskId):
+    # ?format=csv (default) or ?format=ndjson
+    return exportInsured(riskId, request.args.get("format", "csv"))
 
 
 @app.route('/risk/<riskId>/update/<insuredID>', methods=['PUT'])
@@ -694,10 +2942,15 @@ def updateRiskInsured(riskId, insuredID):
     jsonObj = json.loads(request.data)
     return updateInsured(riskId, insuredID, jsonObj)
 
+@app.route('/risk/<riskId>/update/<insuredID>', methods=['PATCH'])
+def patchRiskInsured(riskId, insuredID):
+    jsonObj = json.loads(request.data)
+    return updateInsuredAttributes(riskId, insuredID, jsonObj)
+
 
 @app.route('/risk/delete/<riskId>', methods=['POST'])
 def deleteRisk(riskId):
-    return deleteType(riskId)
+    return deleteType(riskId, _flagArg(request.args, "async"), _flagArg(request.args, "purge"))
 
 
 
@@ -709,11 +2962,42 @@ def deleteRiskInsured(riskId, insuredID):
 
 
 
+def warmup(connect=True):
+    """
+    Prepare a worker before it takes traffic: check the schema version,
+    open the pooled connections (unless connect is False, for a worker serving
+    from other engines) and load the schema of every insurance type,
+    returns the number of loaded types
+    """
+    version = migrations.getVersion(engine)
+    if version != migrations.LATEST_VERSION:
+        raise RuntimeError("database schema is at version %d, expected %d (run python migrations.py upgrade)"
+                           % (version, migrations.LATEST_VERSION))
+    checkStorage()
+
+    if connect:
+        connections = [engine.connect() for _ in range(engine.pool.size() if hasattr(engine.pool, "size") else 1)]
+        for connection in connections:
+            connection.close()
+
+    session = SessionFactory()
+    try:
+        types = [insurance.type for insurance in session.query(Insurance).all()]
+        for insuranceType in types:
+            schemaCache.get(session, insuranceType)
+        return len(types)
+    finally:
+        session.close()
+
+
 def main():
 
 
-    # Create all tables
-    Base.metadata.create_all(engine)
+    # Create all tables or upgrade an existing database
+    migrations.upgrade(engine, Base.metadata, log=print)
+    checkStorage()
+    startWriteQueue()
+    startPurger()
 
     app.run(debug=True)
 
@@ -0,0 +1,114 @@
+"""
+Micro-benchmark of the CPU time spent per request by the handlers on the hot paths.
+
+Seeds a scratch SQLite file like bench.py, then serves each request through the
+Flask test client in one thread and reports the process CPU time per request,
+with the compiled cache of the engines on and off (INSURANCE_QUERY_CACHE, off runs
+with compiled_cache=None), so the cost of compiling the statements shows apart
+from the time in SQLite.
+
+usage: python querybench.py --attributes 10 --insured 2000 --requests 2000 [--storage document] [--output querybench.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import bench
+
+
+def _routes(data):
+    """
+    (name, build(index) -> (method, path, body)) of the hot paths
+    """
+    riskType = data["types"][0]
+    attributes = data["attributes"]
+    insured = data["insured"][riskType]
+
+    def pick(i):
+        return insured[i % len(insured)]
+
+    return [
+        ("getOne", lambda i: ("GET", "/risk/%s/get/%d" % (riskType, pick(i)), None)),
+        ("getMany", lambda i: ("POST", "/risk/%s/getMany" % riskType, {"insuredIDs": [pick(i + j) for j in range(20)]})),
+        ("getAll page", lambda i: ("GET", "/risk/%s/getAll?limit=20&after=%d" % (riskType, pick(i)), None)),
+        ("addInsured", lambda i: ("POST", "/risk/%s/addInsured" % riskType, bench._record(i, attributes))),
+        ("update", lambda i: ("PUT", "/risk/%s/update/%d" % (riskType, pick(i)),
+                              {"attributes": {"attributeName": "age", "attributeValue": str(i % 100)}})),
+        ("patch", lambda i: ("PATCH", "/risk/%s/update/%d" % (riskType, pick(i)),
+                             {"attributes": [{"attributeName": name, "attributeValue": bench._attributeValue(i, a, dataType)}
+                                             for a, (name, dataType) in enumerate(attributes[:5])]})),
+        ("delete", lambda i: ("POST", "/risk/%s/delete/%d" % (riskType, insured[-1 - i]), None)),
+    ]
+
+
+def measure(driver, build, requests):
+    """
+    CPU and wall time per request in microseconds, after a warm-up request
+    """
+    driver.request(*build(requests))
+    cpu, wall = time.process_time(), time.perf_counter()
+    for i in range(requests):
+        status, data = driver.request(*build(i))
+        if status >= 400:
+            raise RuntimeError("%s failed with %d: %s" % (build(i)[1], status, data[:200]))
+    return OrderedDict([("cpu_us", (time.process_time() - cpu) * 1e6 / requests),
+                        ("wall_us", (time.perf_counter() - wall) * 1e6 / requests)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CPU per request of the hot paths, query cache on and off")
+    parser.add_argument("--attributes", type=int, default=10, help="attributes of the risk type")
+    parser.add_argument("--insured", type=int, default=2000, help="insured seeded (each run deletes --requests of them)")
+    parser.add_argument("--requests", type=int, default=500, help="requests per route and mode")
+    parser.add_argument("--storage", choices=["eav", "document"], help="storage of the insured values")
+    parser.add_argument("--output", help="json file for the results")
+    args = parser.parse_args(argv)
+    if args.insured < 2 * args.requests + 1:
+        parser.error("--insured must be above twice --requests, the delete route removes insured in both modes")
+
+    # the engine of property.py is created on import from INSURANCE_DB_URL
+    scratch = tempfile.mkdtemp(prefix="insurance-querybench-")
+    os.environ["INSURANCE_DB_URL"] = "sqlite:///" + os.path.join(scratch, "bench.db")
+    if args.storage:
+        os.environ["INSURANCE_STORAGE"] = args.storage
+    # cached responses would hide the handlers
+    os.environ["INSURANCE_RESPONSE_CACHE_SIZE"] = "0"
+    import migrations
+    import property
+
+    results = OrderedDict()
+    try:
+        migrations.upgrade(property.engine, property.Base.metadata)
+        property.checkStorage()
+        driver = bench.TestClientDriver(property.app)
+        data = bench.seed(driver, 1, args.attributes, args.insured)
+
+        print("%-12s %12s %12s %12s %12s %8s" % ("route", "uncached cpu", "cached cpu", "uncached", "cached", "cpu"))
+        for name, build in _routes(data):
+            result = OrderedDict()
+            for mode, cache in (("uncached", False), ("cached", True)):
+                property.useQueryCache(cache)
+                offset = 0 if cache else args.requests
+                result[mode] = measure(driver, lambda i: build(i + offset), args.requests)
+            results[name] = result
+            print("%-12s %10.0fus %10.0fus %10.0fus %10.0fus %7.0f%%" % (name, result["uncached"]["cpu_us"],
+                  result["cached"]["cpu_us"], result["uncached"]["wall_us"], result["cached"]["wall_us"],
+                  100.0 * (result["cached"]["cpu_us"] / result["uncached"]["cpu_us"] - 1)))
+    finally:
+        property.engine.dispose()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(OrderedDict([("config", vars(args)), ("results", results)]), f, indent=2)
+        print("results written to %s" % args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
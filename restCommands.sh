@@ -7,20 +7,65 @@ curl -H "Content-Type: application/json" -X POST -d '{"type":"health"}' http://l
 #add attribute/field to a risk type
 curl -H "Content-Type: application/json" -X POST -d '{"name":"age", "dataType":"int", "mandatory":"yes"}' http://localhost:5000/risk/health/addAttribute
 
+# enum attributes list their allowed values
+curl -H "Content-Type: application/json" -X POST -d '{"name":"gender", "dataType":"enum", "mandatory":"no", "values":["male", "female"]}' http://localhost:5000/risk/health/addAttribute
+
 curl http://localhost:5000/risk/health/getAttributes
 
 # add insured to an insurance type
 curl -H "Content-Type: application/json" -X POST -d '{"attributes":[{"attributeName":"age", "attributeValue":"64"}, {"attributeName":"address", "attributeValue":"flatno4102, hyderabad"}]}' http://localhost:5000/risk/health/addInsured
 
+# add a batch of insured to an insurance type (json list or one record per line)
+curl -H "Content-Type: application/json" -X POST -d '[{"attributes":[{"attributeName":"age", "attributeValue":"64"}]}, {"attributes":[{"attributeName":"age", "attributeValue":"35"}]}]' http://localhost:5000/risk/health/addInsuredBatch
+
 # get one insured data
 curl  http://localhost:5000/risk/health/get/1
 
+# get many insured data in one request, by ids or by id range
+curl -H "Content-Type: application/json" -X POST -d '{"insuredIDs":[1, 2, 3]}' http://localhost:5000/risk/health/getMany
+curl -H "Content-Type: application/json" -X POST -d '{"from":1, "to":100}' http://localhost:5000/risk/health/getMany
+
+# search insured by attribute values, ranges on int attributes
+curl -H "Content-Type: application/json" -X POST -d '{"filters":[{"attributeName":"age", "op":">", "value":60}, {"attributeName":"city", "op":"in", "value":["hyderabad", "pune"]}], "limit":100}' http://localhost:5000/risk/health/search
+
 # get all insured for insurance type
 curl http://localhost:5000/risk/health/getAll
 
+# get insured ids one page at a time, pass the returned "next" as after
+curl "http://localhost:5000/risk/health/getAll?limit=100&after=0"
+
+# stream all insured ids in chunks
+curl "http://localhost:5000/risk/health/getAll?stream=1"
+
+# statistics of a type: insured and per attribute count, sum and average; histogram or most frequent values of one attribute
+curl http://localhost:5000/risk/health/stats
+curl "http://localhost:5000/risk/health/stats?attribute=age&buckets=10"
+curl "http://localhost:5000/risk/health/stats?attribute=age&bucketSize=5"
+curl "http://localhost:5000/risk/health/stats?attribute=gender&top=20"
+
+# changes of insurance types and insured after a sequence, pass "next" as since to get the following ones
+curl "http://localhost:5000/risk/changes?since=0&limit=1000"
+curl "http://localhost:5000/risk/changes?since=0&type=health"
+curl "http://localhost:5000/risk/changes?since=0&stream=1"
+
+# profile a request (server started with INSURANCE_PROFILE_TOKEN=secret), the capture id is in X-Profile-Capture
+curl -i -H "X-Profile: secret" http://localhost:5000/risk/health/getAll
+
+# slowest profiled requests, one capture, its raw cProfile data
+curl "http://localhost:5000/profiles?limit=20"
+curl http://localhost:5000/profiles/20261018T101500-4242-000001
+curl -o capture.prof "http://localhost:5000/profiles/20261018T101500-4242-000001?format=pstats"
+
+# export all insured of a type, one row per insured and one column per attribute
+curl "http://localhost:5000/risk/health/export?format=csv"
+curl "http://localhost:5000/risk/health/export?format=ndjson"
+
 # update insured data 
 curl -i -H "content-type:application/json" -X PUT -d '{"attributes":{"attributeName":"fullName", "attributeValue":"fullname1_modified"}}' http://localhost:5000/risk/health/update/1
 
+# update many attributes of an insured at once
+curl -i -H "content-type:application/json" -X PATCH -d '{"attributes":[{"attributeName":"fullName", "attributeValue":"fullname1_modified"}, {"attributeName":"age", "attributeValue":"65"}]}' http://localhost:5000/risk/health/update/1
+
 # delete insured to an insurance type
 curl -H "Content-Type: application/json" -X POST http://localhost:5000/risk/health/delete/1
 
@@ -30,3 +75,17 @@ curl -H "Content-Type: application/json" -X POST http://localhost:5000/risk/dele
 
 # delete risk attribute
 curl -H "Content-Type: application/json" -X POST -d '{"name":"voterid"}' http://localhost:5000/risk/health/deleteAttribute
+
+
+# risk type schema cache hit/miss counters
+curl http://localhost:5000/risk/schemaCache
+
+# delete risk attribute or risk type as a background job, purge also deletes the stored values
+curl -H "Content-Type: application/json" -X POST -d '{"name":"voterid"}' "http://localhost:5000/risk/health/deleteAttribute?async=1&purge=1"
+curl -H "Content-Type: application/json" -X POST "http://localhost:5000/risk/delete/health?async=1"
+
+# background job status and progress
+curl http://localhost:5000/risk/jobs/1
+
+# per-route request and SQL metrics, prometheus text format
+curl http://localhost:5000/metrics
@@ -0,0 +1,100 @@
+"""
+Production launcher: the insurance API under gunicorn's prefork server.
+
+The master process upgrades the database and loads the app once, then forks
+the workers. Every worker creates its own engine after the fork, so pooled
+SQLite connections are never shared between processes, and warms up (schema
+version check, pooled connections, schema cache) before it takes traffic;
+asyncio workers open the pooled connections of their async engine in the
+startup of asgi.py.
+The cache version counters live in shared memory, so a change served by one
+worker invalidates the cached schemas and responses of all of them.
+
+usage: python server.py [--workers 4] [--threads 1] [--bind 127.0.0.1:5000] [--asgi]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+import migrations
+import property
+
+
+def postFork(server, worker):
+    # connections opened by the master before the fork belong to the master
+    property.useEngine(property.createEngine())
+
+
+def postWorkerInit(worker):
+    # asyncio workers serve from the async engines, warmed up by their startup
+    types = property.warmup(connect=worker.wsgi is property.app)
+    worker.log.info("worker %s warmed up, %d insurance types cached", worker.pid, types)
+    # group commit serves the threads of a worker, asyncio workers write in the request
+    if worker.wsgi is property.app and property.startWriteQueue() is not None:
+        worker.log.info("worker %s commits insured writes in groups", worker.pid)
+    # one worker at a time purges, the others wait for its lock
+    property.startPurger()
+
+
+class Launcher(BaseApplication):
+    """
+    gunicorn application serving property.app (or the asgi.py app) with the given settings
+    """
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        BaseApplication.__init__(self)
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        return self.application
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the insurance API with prefork worker processes")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("INSURANCE_WORKERS", "0")),
+                        help="worker processes, defaults to the number of cores")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("INSURANCE_THREADS", "1")),
+                        help="threads per worker")
+    parser.add_argument("--bind", default=os.environ.get("INSURANCE_BIND", "127.0.0.1:5000"))
+    parser.add_argument("--timeout", type=int, default=30, help="seconds before a silent worker is restarted")
+    parser.add_argument("--asgi", action="store_true", help="serve the asyncio app of asgi.py (uvicorn workers)")
+    args = parser.parse_args(argv)
+
+    # Create all tables or upgrade an existing database, once for all workers
+    migrations.upgrade(property.engine, property.Base.metadata, log=print)
+    property.checkStorage()
+    property.engine.dispose()
+    for shardEngine in property.shardEngines.values():
+        shardEngine.dispose()
+    property.shareCaches()
+
+    options = {
+        "bind": args.bind,
+        "workers": args.workers or multiprocessing.cpu_count(),
+        "threads": args.threads,
+        "timeout": args.timeout,
+        "preload_app": True,
+        "post_fork": postFork,
+        "post_worker_init": postWorkerInit,
+    }
+    if args.asgi:
+        import asgi
+        application = asgi.AsyncApp(upgrade=False)
+        options["worker_class"] = "uvicorn.workers.UvicornWorker"
+    else:
+        application = property.app
+        options["worker_class"] = "gthread" if args.threads > 1 else "sync"
+
+    Launcher(application, options).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
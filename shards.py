@@ -0,0 +1,184 @@
+"""
+Shard databases of the insured, and the rebalance of the insurance types over them.
+
+The insured of an insurance type are kept in the database of insurance.shard: the
+main database when it is NULL, else the shard database of that number
+(INSURANCE_SHARD_URL). New types are placed by a hash of their name over
+INSURANCE_SHARDS. rebalance moves the insured of every type to the shard of that
+hash over --shards (0 moves them all back to the main database), in chunks of
+one copy and one delete transaction, then moves its summary counters and the
+changes of its insured in one transaction and points the type to its new database.
+
+Stop the application while it runs. An interrupted rebalance resumes when run
+again: the copies of the last chunk are replaced.
+
+usage: python shards.py [--db sqlite:///propertyInsurance.db] status
+       python shards.py [--db sqlite:///propertyInsurance.db] rebalance [--shards 4] [--chunk-size 10000]
+"""
+import argparse
+import sys
+
+import migrations
+import property
+
+
+# insured moved in one copy transaction
+MOVE_CHUNK_SIZE = 10000
+
+
+def _engine(shard):
+    return property.engine if shard is None else property.shardEngine(shard)
+
+
+def _name(shard):
+    return "main" if shard is None else "shard %d" % shard
+
+
+def status(log=print):
+    """
+    Log the database and the number of insured of every insurance type
+    """
+    session = property.SessionFactory()
+    try:
+        log("%-32s %-10s %10s" % ("type", "database", "insured"))
+        for insuranceID, insuranceType, shard in session.query(property.Insurance.id, property.Insurance.type,
+                                                               property.Insurance.shard).order_by(property.Insurance.id):
+            with _engine(shard).connect() as conn:
+                insured = conn.execute("SELECT COUNT(*) FROM insured WHERE insuranceID = ? AND deleted IS NULL",
+                                      (insuranceID,)).scalar()
+            log("%-32s %-10s %10d" % (insuranceType, _name(shard), insured))
+    finally:
+        session.close()
+
+
+def moveType(insuranceID, insuranceType, source, target, chunkSize=MOVE_CHUNK_SIZE):
+    """
+    Move the insured of an insurance type, their changes and counters, from the source
+    to the target database, returns the number of insured moved
+    """
+    path = _engine(target).url.database
+    raw = _engine(source).raw_connection()
+    dbapi_conn = raw.connection
+    isolation_level = dbapi_conn.isolation_level
+    dbapi_conn.isolation_level = None
+    cursor = dbapi_conn.cursor()
+    moved = 0
+    try:
+        cursor.execute("ATTACH DATABASE ? AS target", (path,))
+        try:
+            while True:
+                cursor.execute("SELECT MIN(id), MAX(id), COUNT(*) FROM (SELECT id FROM main.insured "
+                               "WHERE insuranceID = ? ORDER BY id LIMIT ?)", (insuranceID, chunkSize))
+                first, last, count = cursor.fetchone()
+                if not count:
+                    break
+                chunk = (insuranceID, first, last)
+
+                # the copies first, committed on their own: WAL databases do not commit
+                # together, so the source rows are only deleted once the target has them
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    cursor.execute("DELETE FROM target.insured_data WHERE insuredID IN (SELECT id FROM target.insured "
+                                   "WHERE insuranceID = ? AND id BETWEEN ? AND ?)", chunk)
+                    cursor.execute("DELETE FROM target.insured WHERE insuranceID = ? AND id BETWEEN ? AND ?", chunk)
+                    cursor.execute("INSERT INTO target.insured (id, insuranceID, document, deleted) SELECT id, "
+                                   "insuranceID, document, deleted FROM main.insured WHERE insuranceID = ? "
+                                   "AND id BETWEEN ? AND ?", chunk)
+                    cursor.execute("INSERT INTO target.insured_data (insuredID, name, value, intValue) "
+                                   "SELECT insuredID, name, value, intValue FROM main.insured_data WHERE insuredID IN "
+                                   "(SELECT id FROM main.insured WHERE insuranceID = ? AND id BETWEEN ? AND ?) "
+                                   "ORDER BY id", chunk)
+                    # the counter of the target is left alone: every id comes from the range of
+                    # the database that gave it, whose counter is already past it, raising the
+                    # target's would move it into the range of another database
+                    cursor.execute("COMMIT")
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    cursor.execute("DELETE FROM main.insured_data WHERE insuredID IN (SELECT id FROM main.insured "
+                                   "WHERE insuranceID = ? AND id BETWEEN ? AND ?)", chunk)
+                    cursor.execute("DELETE FROM main.insured WHERE insuranceID = ? AND id BETWEEN ? AND ?", chunk)
+                    cursor.execute("COMMIT")
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+                moved += count
+
+            # the counters and the changes of the insured go with them, in one transaction; the changes
+            # get the next sequences of the target, so the change feed may give them a second time
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.execute("DELETE FROM target.attribute_stats WHERE insuranceID = ?", (insuranceID,))
+                cursor.execute("INSERT INTO target.attribute_stats (insuranceID, name, count, total) "
+                               "SELECT insuranceID, name, count, total FROM main.attribute_stats "
+                               "WHERE insuranceID = ?", (insuranceID,))
+                cursor.execute("DELETE FROM main.attribute_stats WHERE insuranceID = ?", (insuranceID,))
+                cursor.execute("INSERT INTO target.changes (kind, insuranceType, insuredID, data, created) "
+                               "SELECT kind, insuranceType, insuredID, data, created FROM main.changes "
+                               "WHERE insuranceType = ? AND insuredID IS NOT NULL ORDER BY id", (insuranceType,))
+                cursor.execute("DELETE FROM main.changes WHERE insuranceType = ? AND insuredID IS NOT NULL",
+                               (insuranceType,))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        finally:
+            cursor.execute("DETACH DATABASE target")
+    finally:
+        cursor.close()
+        dbapi_conn.isolation_level = isolation_level
+        raw.close()
+    return moved
+
+
+def rebalance(shards, chunkSize=MOVE_CHUNK_SIZE, log=print):
+    """
+    Move every insurance type to the database of its hash over shards,
+    returns the number of types moved
+    """
+    session = property.SessionFactory()
+    try:
+        types = session.query(property.Insurance.id, property.Insurance.type, property.Insurance.shard) \
+                    .order_by(property.Insurance.id).all()
+        moved = 0
+        for insuranceID, insuranceType, source in types:
+            target = property.shardOf(insuranceType, shards)
+            if source == target:
+                continue
+            insured = moveType(insuranceID, insuranceType, source, target, chunkSize)
+            session.query(property.Insurance).filter(property.Insurance.id == insuranceID) \
+                    .update({"shard": target}, synchronize_session=False)
+            session.commit()
+            log("moved %s from %s to %s, %d insured" % (insuranceType, _name(source), _name(target), insured))
+            moved += 1
+        return moved
+    finally:
+        session.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Status and rebalance of the shard databases of the insured")
+    parser.add_argument("command", nargs="?", default="status", choices=["status", "rebalance"])
+    parser.add_argument("--shards", type=int, default=property.SHARDS,
+                        help="shard databases to spread the types over, 0 for the main database")
+    parser.add_argument("--chunk-size", type=int, default=MOVE_CHUNK_SIZE, help="insured moved per transaction")
+    parser.add_argument("--db", help="database url, defaults to the application database")
+    args = parser.parse_args(argv)
+
+    if args.db:
+        property.useEngine(property.createEngine({"url": args.db}))
+    migrations.upgrade(property.engine, property.Base.metadata, log=print)
+
+    if args.command == "rebalance":
+        moved = rebalance(max(args.shards, 0), max(args.chunk_size, 1))
+        print("%d insurance types moved, set INSURANCE_SHARDS=%d for the new types" % (moved, args.shards))
+        return 0
+    status()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
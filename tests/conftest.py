@@ -0,0 +1,68 @@
+"""
+Fixtures of the tests: the Flask test client of property.py on a scratch SQLite database.
+
+property.py creates its engine on import from INSURANCE_DB_URL, so the scratch
+database is set here, before any test module imports it.
+"""
+import itertools
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+scratch = tempfile.mkdtemp(prefix="insurance-tests-")
+os.environ["INSURANCE_DB_URL"] = "sqlite:///" + os.path.join(scratch, "tests.db")
+os.environ["INSURANCE_SHARD_URL"] = "sqlite:///" + os.path.join(scratch, "tests-shard{shard}.db")
+os.environ["INSURANCE_PROFILE_DIR"] = os.path.join(scratch, "profiles")
+os.environ["INSURANCE_PURGE_RATE"] = "0"
+
+import migrations
+import property
+
+
+_types = itertools.count(1)
+
+
+@pytest.fixture(scope="session")
+def app():
+    migrations.upgrade(property.engine, property.Base.metadata)
+    property.checkStorage()
+    return property.app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def call(client, method, url, body=None):
+    """
+    (status code, json body) of a request
+    """
+    response = getattr(client, method)(url, data=json.dumps(body) if body is not None else None)
+    return response.status_code, json.loads(response.data)
+
+
+@pytest.fixture
+def riskType(client):
+    """
+    A new insurance type with the attributes age (int, mandatory), name (string) and color (enum)
+    """
+    riskType = "type%d" % next(_types)
+    call(client, "post", "/risk/create", {"type": riskType})
+    call(client, "post", "/risk/%s/addAttribute" % riskType, {"name": "age", "dataType": "int", "mandatory": "yes"})
+    call(client, "post", "/risk/%s/addAttribute" % riskType, {"name": "name", "dataType": "string", "mandatory": "no"})
+    call(client, "post", "/risk/%s/addAttribute" % riskType, {"name": "color", "dataType": "enum", "mandatory": "no",
+                                                              "values": ["red", "blue"]})
+    return riskType
+
+
+def attributes(**values):
+    """
+    attributes list of an insured, as sent to addInsured
+    """
+    return [{"attributeName": name, "attributeValue": value} for name, value in values.items()]
@@ -0,0 +1,37 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("aiosqlite")
+
+import asgi
+
+
+async def _request(application, method, path, body=b""):
+    messages = []
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+    async def send(message):
+        messages.append(message)
+    await application({"type": "http", "method": method, "path": path, "query_string": b"", "headers": []},
+                      receive, send)
+    return messages[0]["status"], b"".join(message.get("body", b"") for message in messages[1:])
+
+
+def test_startup_opens_the_async_pool(app):
+    application = asgi.AsyncApp(upgrade=False)
+
+    async def scenario():
+        await application.startup()
+        try:
+            pool = application.engine.sync_engine.pool
+            opened = pool.checkedin()
+            status, body = await _request(application, "GET", "/risk/getAll")
+            return pool.size(), opened, status, json.loads(body)["status"]
+        finally:
+            await application.shutdown()
+
+    size, opened, status, result = asyncio.run(scenario())
+    assert opened == size
+    assert (status, result) == (200, "success")
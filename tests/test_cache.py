@@ -0,0 +1,48 @@
+import json
+
+from conftest import attributes, call
+
+
+def _get(client, url, etag=None):
+    response = client.get(url, headers={"If-None-Match": etag} if etag else {})
+    return response.status_code, response.headers.get("ETag"), response.data
+
+
+def _age(data):
+    return [value["age"]["value"] for value in json.loads(data)["attributes"] if "age" in value]
+
+
+def test_update_refreshes_every_form_of_the_id(client, riskType):
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="30")})
+    insuredID = data["insuranceID"]
+    padded = "/risk/%s/get/0%d" % (riskType, insuredID)
+
+    code, etag, body = _get(client, padded)
+    assert code == 200 and _age(body) == ["30"]
+
+    code, data = call(client, "put", "/risk/%s/update/%d" % (riskType, insuredID),
+                      {"attributes": {"attributeName": "age", "attributeValue": "31"}})
+    assert code == 200
+
+    code, newEtag, body = _get(client, padded)
+    assert code == 200 and _age(body) == ["31"]
+    assert newEtag != etag
+    # the previous version is not answered as unchanged
+    assert _get(client, padded, etag)[0] == 200
+
+
+def test_forms_of_the_id_share_the_cache_entry(client, riskType):
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="30")})
+    insuredID = data["insuranceID"]
+
+    code, etag, body = _get(client, "/risk/%s/get/%d" % (riskType, insuredID))
+    assert _get(client, "/risk/%s/get/00%d" % (riskType, insuredID), etag)[0] == 304
+
+
+def test_cached_response_gives_the_number_of_the_id(client, riskType):
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="30")})
+    insuredID = data["insuranceID"]
+
+    for url in ("/risk/%s/get/00%d", "/risk/%s/get/%d"):
+        code, etag, body = _get(client, url % (riskType, insuredID))
+        assert code == 200 and json.loads(body)["insurediD"] == str(insuredID)
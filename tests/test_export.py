@@ -0,0 +1,29 @@
+import pytest
+
+import export
+import property
+from conftest import attributes, call
+
+
+def test_parquet_writes_int_text_that_is_no_number_as_null(client, riskType, tmp_path, capsys):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    insuredIDs = [call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age=age)})[1]
+                  ["insuranceID"] for age in ("30", "40", "50")]
+    # int values kept as text before they were checked
+    with property.engine.begin() as conn:
+        for insuredID, value in zip(insuredIDs, ("31", "thirty")):
+            if property.storage.name == "eav":
+                conn.execute("UPDATE insured_data SET value = ?, intValue = NULL WHERE insuredID = ? AND name = 'age'",
+                             (value, insuredID))
+            else:
+                conn.execute("UPDATE insured SET document = json_set(document, '$.age', ?) WHERE id = ?",
+                             (value, insuredID))
+
+    output = str(tmp_path / "export.parquet")
+    assert export.main([riskType, "--format", "parquet", "--output", output]) == 0
+
+    table = pyarrow.parquet.read_table(output)
+    assert table.column("insuredID").to_pylist() == insuredIDs
+    assert table.column("age").to_pylist() == [31, None, 50]
+    assert "1 int values that are not numbers written as null" in capsys.readouterr().err
@@ -0,0 +1,61 @@
+from sqlalchemy import event, exc
+
+import property
+from conftest import attributes, call
+
+
+def test_batch_inserts_each_chunk_in_one_statement(client, riskType):
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO insured "):
+            statements.append(executemany)
+    event.listen(property.engine, "before_cursor_execute", record)
+    try:
+        code, data = call(client, "post", "/risk/%s/addInsuredBatch" % riskType,
+                          [{"attributes": attributes(age=str(age))} for age in range(10)])
+    finally:
+        event.remove(property.engine, "before_cursor_execute", record)
+
+    assert code == 201
+    insuredIDs = [result["insuredID"] for result in data["results"]]
+    assert insuredIDs == list(range(insuredIDs[0], insuredIDs[0] + 10))
+    assert statements == [True]
+
+
+def test_batch_failing_record_keeps_the_others(client, riskType, monkeypatch):
+    add = property.storage.add
+    def failing(session, insurance, records):
+        if any(values.get("name") == "fails" for values in records):
+            raise exc.IntegrityError("INSERT", {}, Exception("failing record"))
+        return add(session, insurance, records)
+    monkeypatch.setattr(property.storage, "add", failing)
+
+    records = [{"attributes": attributes(age="1")}, {"attributes": attributes(age="2", name="fails")},
+               {"attributes": attributes(age="3")}]
+    code, data = call(client, "post", "/risk/%s/addInsuredBatch" % riskType, records)
+
+    assert code == 201
+    assert [result["status"] for result in data["results"]] == ["success", "error", "success"]
+    assert data["results"][1]["message"] == "DB error"
+    for result in (data["results"][0], data["results"][2]):
+        assert call(client, "get", "/risk/%s/get/%d" % (riskType, result["insuredID"]))[0] == 200
+
+
+def test_add_db_error_is_an_error_status(client, riskType, monkeypatch):
+    def failing(session, insurance, records):
+        raise exc.OperationalError("INSERT", {}, Exception("database is locked"))
+    monkeypatch.setattr(property.storage, "add", failing)
+
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="1")})
+
+    assert code == 500
+    assert data == {"status": "error", "message": "DB error"}
+
+
+def test_ids_are_not_given_twice(client, riskType):
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="1")})
+    insuredID = data["insuranceID"]
+    assert call(client, "post", "/risk/%s/delete/%d" % (riskType, insuredID))[0] == 200
+
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="2")})
+    assert data["insuranceID"] > insuredID
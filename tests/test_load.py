@@ -0,0 +1,61 @@
+import pytest
+from sqlalchemy import exc
+
+import load
+import property
+from conftest import attributes, call
+
+
+def _csv(tmp_path, ages):
+    path = tmp_path / "insured.csv"
+    path.write_text("age,name\n" + "".join("%d,n%d\n" % (age, age) for age in ages))
+    return str(path)
+
+
+def _missingIndexes():
+    return [index.name for index in load._deferredIndexes() if not load._hasIndex(property.engine, index.name)]
+
+
+def _load(riskType, path, deferIndexes):
+    return load.load(riskType, path, "csv", 2, 1, deferIndexes, path + ".rejected.ndjson", log=lambda line: None)
+
+
+def test_failed_deferred_load_rebuilds_the_indexes(client, riskType, tmp_path, monkeypatch):
+    writeChunk = load._writeChunk
+    def failing(session, insurance, checkpoint, records, results):
+        if checkpoint.records:
+            raise exc.OperationalError("INSERT", {}, Exception("disk I/O error"))
+        return writeChunk(session, insurance, checkpoint, records, results)
+    monkeypatch.setattr(load, "_writeChunk", failing)
+
+    with pytest.raises(exc.OperationalError):
+        _load(riskType, _csv(tmp_path, range(6)), True)
+
+    assert _missingIndexes() == []
+
+
+def test_load_rebuilds_indexes_left_dropped(client, riskType, tmp_path):
+    # a deferred load killed before its rebuild
+    with property.engine.connect() as conn:
+        for index in load._deferredIndexes():
+            conn.execute("DROP INDEX IF EXISTS %s" % index.name)
+    assert _missingIndexes()
+
+    checkpoint = _load(riskType, _csv(tmp_path, range(3)), False)
+
+    assert checkpoint.loaded == 3
+    assert _missingIndexes() == []
+
+
+def test_loaded_ids_come_from_the_server_counter(client, riskType, tmp_path):
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="1")})
+    before = data["insuranceID"]
+    call(client, "post", "/risk/%s/delete/%d" % (riskType, before))
+
+    _load(riskType, _csv(tmp_path, range(3)), False)
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="2")})
+
+    code, page = call(client, "get", "/risk/%s/getAll" % riskType)
+    loaded = [insuredID for insuredID in page["insuredID"] if insuredID != data["insuranceID"]]
+    assert len(loaded) == 3 and min(loaded) > before
+    assert data["insuranceID"] > max(loaded)
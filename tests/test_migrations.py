@@ -0,0 +1,43 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+import migrations
+import property
+
+
+# the tables of the first releases, before the schema versions
+FIRST_RELEASE = """
+CREATE TABLE insurance (id INTEGER PRIMARY KEY, type VARCHAR(256) NOT NULL);
+CREATE TABLE iattributes (id INTEGER PRIMARY KEY, insuranceID INTEGER REFERENCES insurance (id),
+                          name VARCHAR(256) NOT NULL, dataType VARCHAR(256) NOT NULL, mandatory VARCHAR(3) NOT NULL);
+CREATE TABLE insured (id INTEGER PRIMARY KEY, insuranceID INTEGER REFERENCES insurance (id));
+CREATE TABLE insured_data (id INTEGER PRIMARY KEY, insuredID INTEGER REFERENCES insured (id),
+                           name VARCHAR(256), value VARCHAR(4096));
+INSERT INTO insurance (id, type) VALUES (1, 'car');
+INSERT INTO iattributes (insuranceID, name, dataType, mandatory) VALUES (1, 'age', 'int', 'yes');
+INSERT INTO insured (id, insuranceID) VALUES (1, 1);
+INSERT INTO insured_data (insuredID, name, value) VALUES (1, 'age', '30'), (1, 'age', '31');
+"""
+
+
+def test_duplicate_attributes_stop_the_upgrade(tmp_path):
+    path = str(tmp_path / "first.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(FIRST_RELEASE)
+    conn.close()
+    engine = create_engine("sqlite:///" + path)
+
+    with pytest.raises(RuntimeError, match="insured 1 age"):
+        migrations.upgrade(engine, property.Base.metadata)
+    # both values are kept for the operator
+    assert migrations.getVersion(engine) == 1
+    with engine.connect() as conn:
+        assert conn.execute("SELECT value FROM insured_data ORDER BY id").fetchall() == [("30",), ("31",)]
+
+        conn.execute("DELETE FROM insured_data WHERE id NOT IN "
+                     "(SELECT MAX(id) FROM insured_data GROUP BY insuredID, name)")
+    migrations.upgrade(engine, property.Base.metadata)
+    assert migrations.getVersion(engine) == migrations.LATEST_VERSION
+    engine.dispose()
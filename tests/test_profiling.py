@@ -0,0 +1,19 @@
+from flask import g
+
+import profiling
+import property
+
+
+def test_statements_are_explained_on_their_database(app):
+    shardEngine = property.shardEngine(0)
+    with shardEngine.connect() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS profiled (id INTEGER PRIMARY KEY)")
+
+    with app.test_request_context("/"):
+        g.profileStatements = []
+        with shardEngine.connect() as conn:
+            conn.execute("SELECT id FROM profiled WHERE id = ?", (1,))
+        statements, g.profileStatements = g.profileStatements, None
+
+    plan = profiling._explain(statements)[0]["plan"]
+    assert plan and not plan[0].startswith("not explained")
@@ -0,0 +1,45 @@
+import time
+
+import property
+from conftest import attributes, call
+
+
+def _count(sql, insuredIDs):
+    with property.engine.connect() as conn:
+        return conn.execute(sql % ", ".join(str(insuredID) for insuredID in insuredIDs)).scalar()
+
+
+def test_soft_deleted_insured_are_hidden_then_purged(client, riskType, monkeypatch):
+    monkeypatch.setattr(property, "SOFT_DELETE", True)
+    insuredIDs = [call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age=str(age))})[1]
+                  ["insuranceID"] for age in range(5)]
+    deleted, kept = insuredIDs[:3], insuredIDs[3:]
+    for insuredID in deleted:
+        assert call(client, "post", "/risk/%s/delete/%d" % (riskType, insuredID))[0] == 200
+
+    # hidden at once, removed later
+    assert call(client, "get", "/risk/%s/get/%d" % (riskType, deleted[0]))[0] == 404
+    assert call(client, "get", "/risk/%s/getAll" % riskType)[1]["insuredID"] == kept
+    assert _count("SELECT COUNT(*) FROM insured WHERE id IN (%s) AND deleted IS NOT NULL", deleted) == 3
+
+    batches = []
+    purgeDeleted = property._purgeDeleted
+    def recorded(session, limit):
+        purged = purgeDeleted(session, limit)
+        batches.append(purged)
+        return purged
+    monkeypatch.setattr(property, "_purgeDeleted", recorded)
+
+    purger = property.Purger(2, 1000, 0)
+    try:
+        deadline = time.time() + 10
+        while _count("SELECT COUNT(*) FROM insured WHERE id IN (%s)", deleted) and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        purger.stop()
+
+    assert _count("SELECT COUNT(*) FROM insured WHERE id IN (%s)", deleted) == 0
+    assert _count("SELECT COUNT(*) FROM insured_data WHERE insuredID IN (%s)", deleted) == 0
+    assert purger.purged == 3 and max(batches) == 2
+    for insuredID in kept:
+        assert call(client, "get", "/risk/%s/get/%d" % (riskType, insuredID))[0] == 200
@@ -0,0 +1,32 @@
+import property
+from conftest import attributes, call
+
+
+def _compiledCache():
+    return property.engine.get_execution_options()["compiled_cache"]
+
+
+def _addInsured(client, riskType, count):
+    return [call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age=str(age))})[1]
+            ["insuranceID"] for age in range(count)]
+
+
+def test_cached_statements_are_compiled_once(client, riskType):
+    first, second = _addInsured(client, riskType, 2)
+    assert call(client, "get", "/risk/%s/get/%d" % (riskType, first))[0] == 200
+    compiled = len(_compiledCache())
+
+    assert call(client, "get", "/risk/%s/get/%d" % (riskType, second))[0] == 200
+    assert len(_compiledCache()) == compiled
+
+
+def test_uncached_mode_runs_without_compiled_cache(client, riskType):
+    insuredID, = _addInsured(client, riskType, 1)
+    property.useQueryCache(False)
+    try:
+        assert _compiledCache() is None
+        assert call(client, "get", "/risk/%s/get/%d" % (riskType, insuredID))[0] == 200
+        assert _compiledCache() is None
+    finally:
+        property.useQueryCache(True)
+    assert len(_compiledCache()) == 0
@@ -0,0 +1,39 @@
+import pytest
+
+from conftest import attributes, call
+
+
+@pytest.mark.parametrize("attributeName", [7, None, ["age"], {"name": "age"}])
+def test_attribute_name_not_a_string_is_invalid(client, riskType, attributeName):
+    code, data = call(client, "post", "/risk/%s/search" % riskType,
+                      {"filters": [{"attributeName": attributeName, "op": "=", "value": 1}]})
+
+    assert code == 400
+    assert data == {"status": "error", "message": "Invalid request"}
+
+
+@pytest.mark.parametrize("op", [None, 1, ["="]])
+def test_operator_not_a_string_is_invalid(client, riskType, op):
+    code, data = call(client, "post", "/risk/%s/search" % riskType,
+                      {"filters": [{"attributeName": "age", "op": op, "value": 1}]})
+
+    assert code == 400
+
+
+def test_unknown_attribute(client, riskType):
+    code, data = call(client, "post", "/risk/%s/search" % riskType,
+                      {"filters": [{"attributeName": "weight", "value": 1}]})
+
+    assert code == 404
+    assert data["message"] == "weight attribute not exist for Inurance type"
+
+
+def test_search_by_value(client, riskType):
+    call(client, "post", "/risk/%s/addInsuredBatch" % riskType,
+         [{"attributes": attributes(age=str(age))} for age in (20, 40, 60)])
+
+    code, data = call(client, "post", "/risk/%s/search" % riskType,
+                      {"filters": [{"attributeName": "age", "op": ">", "value": 30}]})
+
+    assert code == 200
+    assert len(data["insuredID"]) == 2
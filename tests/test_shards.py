@@ -0,0 +1,138 @@
+import itertools
+import json
+import threading
+
+import pytest
+
+import migrations
+import property
+import shards
+from conftest import attributes, call
+
+
+_types = itertools.count(1)
+
+
+@pytest.fixture
+def shardedType(client, monkeypatch):
+    """
+    A new insurance type kept in a shard database, with summary counters, as (type, shard)
+    """
+    monkeypatch.setattr(property, "SHARDS", 2)
+    monkeypatch.setattr(property, "STATS_COUNTERS", True)
+    riskType = "sharded%d" % next(_types)
+    call(client, "post", "/risk/create", {"type": riskType})
+    call(client, "post", "/risk/%s/addAttribute" % riskType, {"name": "age", "dataType": "int", "mandatory": "yes"})
+    return riskType, property.shardOf(riskType)
+
+
+def _count(engine, sql, *params):
+    with engine.connect() as conn:
+        return conn.execute(sql, params).scalar()
+
+
+def test_insured_writes_stay_in_their_shard(client, shardedType):
+    riskType, shard = shardedType
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="30")})
+    insuredID = data["insuranceID"]
+    call(client, "put", "/risk/%s/update/%d" % (riskType, insuredID),
+         {"attributes": {"attributeName": "age", "attributeValue": "31"}})
+
+    shardEngine = property.shardEngine(shard)
+    assert _count(shardEngine, "SELECT COUNT(*) FROM insured WHERE id = ?", insuredID) == 1
+    assert _count(shardEngine, "SELECT COUNT(*) FROM changes WHERE insuranceType = ?", riskType) == 2
+    assert _count(shardEngine, "SELECT total FROM attribute_stats WHERE name = 'age'") == 31
+    # the main database only has the changes of the type
+    assert _count(property.engine, "SELECT COUNT(*) FROM changes WHERE insuranceType = ? AND insuredID IS NOT NULL",
+                  riskType) == 0
+    assert _count(property.engine, "SELECT COUNT(*) FROM changes WHERE insuranceType = ?", riskType) == 2
+
+
+def test_moving_a_type_back_keeps_the_ids_of_each_database_apart(client, shardedType):
+    riskType, shard = shardedType
+    moved = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="30")})[1]["insuranceID"]
+    nextInsuredID = "SELECT CAST(value AS INTEGER) FROM settings WHERE name = 'nextInsuredID'"
+    mainNext = _count(property.engine, nextInsuredID)
+
+    insuranceID = _count(property.engine, "SELECT id FROM insurance WHERE type = ?", riskType)
+    assert shards.moveType(insuranceID, riskType, shard, None) == 1
+    with property.engine.begin() as conn:
+        conn.execute("UPDATE insurance SET shard = NULL WHERE id = ?", (insuranceID,))
+    property._schemaChanged(riskType)
+
+    # the main counter stays out of the range of the shard
+    assert _count(property.engine, nextInsuredID) == mainNext < 1 << migrations.SHARD_ID_BITS
+    added = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="31")})[1]["insuranceID"]
+    assert added < moved
+    assert call(client, "get", "/risk/%s/getAll" % riskType)[1]["insuredID"] == sorted([moved, added])
+
+
+def test_change_feed_merges_the_databases(client, shardedType):
+    riskType, shard = shardedType
+    for age in range(3):
+        call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age=str(age))})
+
+    code, data = call(client, "get", "/risk/changes?type=%s" % riskType)
+    assert [(change["kind"], change.get("shard")) for change in data["changes"]] == \
+        [("typeCreated", None), ("attributeAdded", None)] + [("insuredAdded", shard)] * 3
+
+    # one change per page, from the position of the previous one
+    paged, since = [], "0"
+    while True:
+        code, page = call(client, "get", "/risk/changes?type=%s&limit=1&since=%s" % (riskType, since))
+        paged.extend(page["changes"])
+        since = page["next"]
+        if not page["more"]:
+            break
+    assert paged == data["changes"]
+    assert call(client, "get", "/risk/changes?type=%s&since=%s" % (riskType, since))[1]["changes"] == []
+
+    stream = json.loads(client.get("/risk/changes?type=%s&stream=1" % riskType).data)
+    assert stream["changes"] == data["changes"] and stream["next"] == data["next"]
+
+
+def test_change_feed_never_passes_an_unread_change(client, shardedType):
+    riskType, shard = shardedType
+    changesType = riskType + "-changes"
+    # created is stamped before the write lock, a later sequence can have an earlier time
+    insert = "INSERT INTO changes (kind, insuranceType, insuredID, data, created) VALUES ('insuredAdded', ?, 1, ?, ?)"
+    with property.engine.connect() as conn:
+        conn.execute(insert, (changesType, '"M1"', "2020-01-01 12:00:10.000000"))
+        conn.execute(insert, (changesType, '"M2"', "2020-01-01 12:00:05.000000"))
+    with property.shardEngine(shard).connect() as conn:
+        conn.execute(insert, (changesType, '"S"', "2020-01-01 12:00:07.000000"))
+
+    paged, since = [], "0"
+    while True:
+        code, page = call(client, "get", "/risk/changes?type=%s&limit=2&since=%s" % (changesType, since))
+        paged.extend(change["data"] for change in page["changes"])
+        since = page["next"]
+        if not page["more"]:
+            break
+    assert paged == ["S", "M1", "M2"]
+
+
+def test_change_feed_rejects_invalid_positions(client):
+    for since in ("-1", "x", "1,2", "1,0:x", "1,0:-1"):
+        assert call(client, "get", "/risk/changes?since=%s" % since)[0] == 400
+
+
+def test_group_commit_runs_one_transaction_per_database():
+    writeQueue = property.WriteQueue(0.5, 2)
+    results = {}
+
+    def submit(shard):
+        results[shard] = writeQueue.submit(lambda session: session.get_bind(mapper=property.Insured).url.database,
+                                           shard)
+    try:
+        threads = [threading.Thread(target=submit, args=(shard,)) for shard in (None, 0)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        writeQueue.stop()
+
+    assert results[None] == property.engine.url.database
+    assert results[0] == property.shardEngine(0).url.database
+    assert (writeQueue.writes, writeQueue.commits) == (2, 2)
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+import property
+from conftest import attributes, call
+
+
+@pytest.fixture
+def counting(monkeypatch):
+    monkeypatch.setattr(property, "STATS_COUNTERS", True)
+
+
+def _counters(riskType):
+    session = property.SessionFactory()
+    try:
+        insurance = property.schemaCache.get(session, riskType)
+        counters = dict((name, (count, total)) for name, count, total in session.query(
+            property.AttributeStats.name, property.AttributeStats.count, property.AttributeStats.total)
+            .filter(property.AttributeStats.insuranceID == insurance.id))
+        summary = property.storage.summary(session, insurance)
+        return counters, summary
+    finally:
+        session.close()
+
+
+def _assertCounted(riskType):
+    counters, summary = _counters(riskType)
+    assert dict((name, value) for name, value in counters.items() if name is not None and value != (0, 0)) == summary
+
+
+def _concurrently(monkeypatch, first, second):
+    """
+    Run first until it read the values it replaces, then second, then let first go on
+    """
+    storedValues = property._storedValues
+    reading, proceed = threading.Event(), threading.Event()
+    def paused(session, insurance, insuredID):
+        values = storedValues(session, insurance, insuredID)
+        if threading.current_thread().name == "first":
+            reading.set()
+            proceed.wait(10)
+        return values
+    monkeypatch.setattr(property, "_storedValues", paused)
+
+    results = {}
+    threads = [threading.Thread(target=lambda: results.setdefault("first", first()), name="first"),
+               threading.Thread(target=lambda: results.setdefault("second", second()), name="second")]
+    threads[0].start()
+    assert reading.wait(10)
+    threads[1].start()
+    # the second write waits for the lock of the first one, or is done when there is none
+    threads[1].join(1)
+    proceed.set()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+@pytest.mark.parametrize("method,body", [
+    ("put", lambda age: {"attributes": {"attributeName": "age", "attributeValue": age}}),
+    ("patch", lambda age: {"attributes": attributes(age=age)}),
+])
+def test_concurrent_updates_keep_the_counters(app, counting, riskType, monkeypatch, method, body):
+    client = app.test_client()
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="30")})
+    url = "/risk/%s/update/%d" % (riskType, data["insuranceID"])
+
+    results = _concurrently(monkeypatch, lambda: call(app.test_client(), method, url, body("40")),
+                            lambda: call(app.test_client(), method, url, body("50")))
+
+    assert [results[name][0] for name in ("first", "second")] == [200, 200]
+    _assertCounted(riskType)
+
+
+def test_concurrent_deletes_count_once(app, counting, riskType, monkeypatch):
+    client = app.test_client()
+    call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="20")})
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="30")})
+    url = "/risk/%s/delete/%d" % (riskType, data["insuranceID"])
+
+    _concurrently(monkeypatch, lambda: call(app.test_client(), "post", url),
+                  lambda: call(app.test_client(), "post", url))
+
+    _assertCounted(riskType)
+    assert _counters(riskType)[0][None] == (1, 0)
@@ -0,0 +1,81 @@
+import pytest
+
+from conftest import attributes, call
+
+
+INVALID_VALUES = [
+    ("name", {"first": "x"}),
+    ("name", ["x"]),
+    ("name", None),
+    ("name", True),
+    ("color", ["red"]),
+    ("color", {"red": 1}),
+    ("color", "green"),
+    ("age", 10 ** 23),
+    ("age", -2 ** 63 - 1),
+    ("age", "12x"),
+    ("age", 1e400),
+    ("age", True),
+    ("age", 3.9),
+    ("age", None),
+]
+
+
+@pytest.mark.parametrize("name,value", INVALID_VALUES)
+def test_add_rejects_invalid_value(client, riskType, name, value):
+    values = {"age": "30", name: value}
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(**values)})
+
+    assert code == 400
+    assert data == {"status": "error", "message": "Invalid request"}
+
+
+@pytest.mark.parametrize("name,value", INVALID_VALUES)
+def test_update_rejects_invalid_value(client, riskType, name, value):
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="30")})
+    url = "/risk/%s/update/%d" % (riskType, data["insuranceID"])
+
+    code, data = call(client, "put", url, {"attributes": {"attributeName": name, "attributeValue": value}})
+    assert code == 400
+    code, data = call(client, "patch", url, {"attributes": attributes(**{name: value})})
+    assert code == 400
+
+
+def test_batch_rejects_only_the_invalid_record(client, riskType):
+    records = [{"attributes": attributes(age="1", name="a")}, {"attributes": attributes(age="2", name={"x": 1})},
+               {"attributes": attributes(age=str(10 ** 23))}, {"attributes": attributes(age="4", color="red")}]
+    code, data = call(client, "post", "/risk/%s/addInsuredBatch" % riskType, records)
+
+    assert code == 201
+    assert [result["status"] for result in data["results"]] == ["success", "error", "error", "success"]
+    assert [result.get("message") for result in data["results"][1:3]] == ["Invalid request"] * 2
+
+
+@pytest.mark.parametrize("attributeName", [7, ["age"], {"age": 1}])
+def test_attribute_name_not_a_string_is_invalid(client, riskType, attributeName):
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType,
+                      {"attributes": attributes(age="30") + [{"attributeName": attributeName, "attributeValue": "x"}]})
+
+    assert code == 400
+
+
+def test_int_range_bounds(client, riskType):
+    for age in (2 ** 63 - 1, -2 ** 63):
+        code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age=age)})
+        assert code == 201
+
+
+def test_int_from_a_float_without_fraction(client, riskType):
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age=3.0)})
+    assert code == 201
+
+    code, data = call(client, "get", "/risk/%s/get/%d" % (riskType, data["insuranceID"]))
+    assert {"age": {"name": "age", "value": "3"}} in data["attributes"]
+
+
+def test_numbers_of_string_attributes_are_kept_as_text(client, riskType):
+    code, data = call(client, "post", "/risk/%s/addInsured" % riskType, {"attributes": attributes(age="30", name=42)})
+    assert code == 201
+
+    code, data = call(client, "get", "/risk/%s/get/%d" % (riskType, data["insuranceID"]))
+    assert {"name": {"name": "name", "value": "42"}} in data["attributes"]